@@ -0,0 +1,4 @@
+#
+#    the tests import pykoa from this tree (the directory of this file is
+#    put on sys.path by pytest)
+#
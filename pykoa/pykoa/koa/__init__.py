@@ -11,17 +11,170 @@ class Conf (_config.ConfigNamespace):
     """
     server = _config.ConfigItem (
         ['https://koa.ipac.caltech.edu/cgi-bin/'],
-        'Name of the KOA server to use.') 
+        'KOA server(s) to use: the primary server, then mirrors.',
+        cfgtype='string_list') 
+
+    probe_interval = _config.ConfigItem (
+        300.,
+        'Seconds between two latency probes of the KOA servers.')
+
+    spread_servers = _config.ConfigItem (
+        False,
+        'Share file downloads between KOA servers of similar latency.')
 
     timeout = _config.ConfigItem (
         60,
         'Time limit for connecting to KOA server.')
 
+    query_timeout = _config.ConfigItem (
+        0.,
+        'Time limit (seconds) of a TAP query job, aborted past it (0: no limit).')
+
+    verbose = _config.ConfigItem (
+        True,
+        'Print the progress messages of queries and downloads.')
+
+    query_workers = _config.ConfigItem (
+        8,
+        'Number of non-blocking queries (block=False) run at once.')
+
+    query_cache_ttl = _config.ConfigItem (
+        0.,
+        'Seconds a query result answers the narrower queries locally (0: no cache).')
+
+    query_cache_size = _config.ConfigItem (
+        16,
+        'Maximum number of query results kept to answer narrower queries.')
+
+    read_timeout = _config.ConfigItem (
+        600,
+        'Time limit (seconds) waiting for data from KOA server.')
+
+    stall_rate = _config.ConfigItem (
+        1000.,
+        'Downloads slower than this (bytes/s) over stall_time are resumed (0: no check).')
+
+    stall_time = _config.ConfigItem (
+        60.,
+        'Stall detection window and download read timeout (seconds).')
+
+    resumes = _config.ConfigItem (
+        10,
+        'Number of times an interrupted download is resumed where it stopped.')
+
+    hedge = _config.ConfigItem (
+        False,
+        'Send a second request for downloads running longer than the 95th percentile.')
+
+    nworker = _config.ConfigItem (
+        4,
+        'Number of files downloaded concurrently.')
+
+    adaptive = _config.ConfigItem (
+        False,
+        'Adapt the number of concurrent downloads to the throughput (AIMD).')
+
+    max_nworker = _config.ConfigItem (
+        16,
+        'Maximum number of concurrent downloads with adaptive concurrency.')
+
+    chunk_size = _config.ConfigItem (
+        1048576,
+        'Read buffer size (bytes) used when streaming downloads to disk.')
+
+    nwriter = _config.ConfigItem (
+        2,
+        'Number of write-behind disk writer threads (0: write inline).')
+
+    nbuffer = _config.ConfigItem (
+        16,
+        'Number of chunk_size buffers shared by the disk writer threads.')
+
+    checksum = _config.ConfigItem (
+        'sha256',
+        'Checksum algorithm (hashlib name) computed for downloaded files.')
+
+    bandwidth = _config.ConfigItem (
+        '0',
+        'Download bandwidth limit, bytes/s with optional K/M/G suffix (0: none).')
+
+    worker_bandwidth = _config.ConfigItem (
+        '0',
+        'Bandwidth limit per download worker, bytes/s (0: none).')
+
+    bandwidth_schedule = _config.ConfigItem (
+        '',
+        'Time-of-day bandwidth windows, e.g. "08:00-20:00=2M, 01:00-02:00=pause".')
+
+    max_per_host = _config.ConfigItem (
+        0,
+        'Maximum concurrent downloads from one host (0: no limit).')
+
+    store = _config.ConfigItem (
+        '',
+        'Directory of the local file store shared by downloads (empty: none).')
+
+    store_max_bytes = _config.ConfigItem (
+        0,
+        'Maximum size (bytes) of the local file store (0: no limit).')
+
+    store_max_age = _config.ConfigItem (
+        0.,
+        'Files of the local store unused for this many days are evicted.')
+
+    failure_ttl = _config.ConfigItem (
+        86400.,
+        'Seconds a file refused by the server stays in a failure cache (0: never).')
+
+    relogin = _config.ConfigItem (
+        True,
+        'Log in again (credentials kept in memory) when the KOA session expires.')
+
+    claim_ttl = _config.ConfigItem (
+        300.0,
+        'Seconds without heartbeat after which a download claim is stale.')
+
+    refetch = _config.ConfigItem (
+        2,
+        'Number of times a file failing verification is re-fetched.')
+
+    retries = _config.ConfigItem (
+        5,
+        'Maximum number of retries of a request on transient errors.')
+
+    backoff = _config.ConfigItem (
+        1.0,
+        'Base delay (seconds) of the exponential retry backoff.')
+
+    backoff_max = _config.ConfigItem (
+        60.0,
+        'Maximum delay (seconds) between two retries.')
+
+    breaker_threshold = _config.ConfigItem (
+        5,
+        'Consecutive failures after which requests to a server are paused.')
+
+    breaker_cooldown = _config.ConfigItem (
+        30.0,
+        'Pause (seconds) before probing a server found to be down.')
+
 
 conf = Conf()
 
 from .core import Koa, Archive, KoaTap, KoaJob
+from .metareader import MetaReader
+from .store import FileStore
+from .failures import FailureCache
+from .sessions import KoaSession
+from .calls import QueryFuture
+from .exceptions import KoaError, KoaParameterError, KoaLoginError, \
+    KoaQueryError, KoaTimeoutError, KoaDownloadError, KoaFileError
+from .results import QueryResult, LoginResult
 
-__all__ = ['Koa', 'Archive', 'KoaTap', 'KoaJob', 
+__all__ = ['Koa', 'Archive', 'KoaTap', 'KoaJob', 'MetaReader', 'FileStore',
+           'FailureCache', 'KoaSession', 'QueryFuture', 'QueryResult',
+           'LoginResult',
+           'KoaError', 'KoaParameterError', 'KoaLoginError', 'KoaQueryError',
+           'KoaTimeoutError', 'KoaDownloadError', 'KoaFileError',
            'Conf', 'conf',
            ] 
@@ -0,0 +1,185 @@
+import copy
+import inspect
+import functools
+import threading
+import concurrent.futures
+
+from . import conf
+
+
+#
+#    serializes the copies of an instance with the publication of a call's
+#    state into it
+#
+state_lock = threading.Lock ()
+
+def new_call (obj):
+
+    """
+    Return the per-call copy of obj: a shallow copy sharing obj's
+    configuration and shared resources (retry policy, servers, store),
+    with its own lock and its own copy of the containers named in the
+    class attribute 'percall_copy'.
+    """
+
+    with state_lock:
+        call = copy.copy (obj)
+
+    call.lock = threading.Lock ()
+
+    for name in getattr (obj, 'percall_copy', ()):
+        setattr (call, name, copy.copy (getattr (obj, name)))
+
+    return (call)
+
+
+def publish (obj, call):
+
+    """
+    Copy the state left by a finished call into obj, so the attributes
+    of the last call (obj.plan, obj.tap, obj.msg, ...) remain available
+    on the instance as before.
+    """
+
+    state = dict (call.__dict__)
+    state.pop ('lock', None)
+
+    with state_lock:
+        obj.__dict__.update (state)
+    return
+
+
+def percall (method):
+
+    """
+    Decorator running a method on a per-call copy of the instance (see
+    new_call): the state a call keeps on 'self' (query, outpath, tap,
+    response, plan, counters, ...) is private to the call, so one
+    instance can serve concurrent calls from several threads.  When the
+    call returns, its state is published to the instance (see publish).
+
+    Generator methods (e.g. download_iter) keep their copy until the
+    generator is exhausted or closed.
+    """
+
+    if inspect.isgeneratorfunction (method):
+
+        @functools.wraps (method)
+        def generator (self, *args, **kwargs):
+
+            call = new_call (self)
+            try:
+                result = yield from method (call, *args, **kwargs)
+            finally:
+                publish (self, call)
+
+            return (result)
+
+        return (generator)
+
+    @functools.wraps (method)
+    def wrapper (self, *args, **kwargs):
+
+        call = new_call (self)
+        try:
+            return (method (call, *args, **kwargs))
+        finally:
+            publish (self, call)
+
+    return (wrapper)
+
+
+class QueryFuture (concurrent.futures.Future):
+
+    """
+    QueryFuture is the handle returned by the non-blocking queries
+    (query_adql, query_criteria, ... with block=False): a
+    concurrent.futures.Future (result, exception, done, cancel,
+    add_done_callback; usable with concurrent.futures.wait and
+    as_completed) wrapping the query's KoaJob.
+
+    result() returns the query's QueryResult once the result table is
+    saved (or raises the query's error, e.g. KoaQueryError);
+    job is the query's KoaJob as soon as the job is created on the server
+    (None before).
+
+    cancel() also cancels a running query: its job is aborted on the
+    server at the next status poll and result() raises CancelledError.
+    """
+
+    def __init__ (self):
+
+        super().__init__ ()
+
+        self.job = None
+        self.cancel_event = threading.Event ()
+        return
+
+
+    def set_job (self, job):
+
+        self.job = job
+        return
+
+
+    def cancel (self):
+
+        if super().cancel ():
+            self.cancel_event.set ()
+            return (True)
+
+        if self.done ():
+            return (False)
+
+        self.cancel_event.set ()
+        return (True)
+
+
+    def cancelled (self):
+
+        if super().cancelled ():
+            return (True)
+
+        return (self.done () and (self.exception () is not None) and \
+            isinstance (self.exception (), concurrent.futures.CancelledError))
+
+
+executor = None
+executor_lock = threading.Lock ()
+
+def submit_query (method, *args, **kwargs):
+
+    """
+    Run the query method(*args, **kwargs) in the background (at most
+    conf.query_workers queries at once) and return its QueryFuture; the
+    method receives the future as the 'future' keyword.
+    """
+
+    global executor
+
+    with executor_lock:
+        if (executor is None):
+            executor = concurrent.futures.ThreadPoolExecutor ( \
+                max_workers=int (conf.query_workers), \
+                thread_name_prefix='koa-query')
+
+    future = QueryFuture ()
+
+    kwargs['block'] = True
+    kwargs['future'] = future
+
+    def run ():
+
+        if (not future.set_running_or_notify_cancel ()):
+            return
+
+        try:
+            result = method (*args, **kwargs)
+        except BaseException as e:
+            future.set_exception (e)
+        else:
+            future.set_result (result)
+        return
+
+    executor.submit (run)
+    return (future)
@@ -0,0 +1,242 @@
+import os
+import zlib
+import socket
+import logging
+import threading
+
+from . import conf
+
+
+def shard_of (key, nshard):
+
+    """
+    Shard (0 .. nshard-1) of key; stable across processes and nodes
+    (unlike hash(), which is randomized per process).
+    """
+
+    return (zlib.crc32 (key.encode ('utf-8')) % nshard)
+
+
+class ClaimDir:
+
+    """
+    ClaimDir class lets several processes (on one or several nodes
+    sharing a file system) drain the same download without fetching a
+    file twice.
+
+    Before downloading a file a worker claims it by creating a claim file
+    in the claim directory with O_CREAT|O_EXCL, which only one process can
+    do.  While the download runs, a heartbeat thread refreshes the mtime
+    of the claims it holds; a claim not refreshed for ttl seconds belongs
+    to a crashed worker and is broken (renamed away, then re-created) by
+    the next worker wanting the file.
+
+    Claim ages are measured against the file system's clock (the mtime of
+    a file touched in the claim directory), not against the local clock,
+    so nodes with skewed clocks agree on which claims are stale.
+
+    Calling Synopsis (example):
+
+    claims = ClaimDir (outdir + '/.koaclaims')
+
+    if claims.claim (relpath):
+        try:
+            ...
+        finally:
+            claims.release (relpath)
+
+    Required input:
+    ---------------
+    claimdir: claim directory (created if it doesn't exist).
+
+    Optional input:
+    ---------------
+    ttl:      seconds without heartbeat after which a claim is stale
+              (default conf.claim_ttl);
+
+    debug:    default is no debug written
+    """
+
+    def __init__ (self, claimdir, **kwargs):
+
+        self.debug = 0
+        if ('debug' in kwargs):
+            self.debug = kwargs.get('debug')
+
+        self.ttl = float (conf.claim_ttl)
+        if ('ttl' in kwargs):
+            self.ttl = float (kwargs.get('ttl'))
+
+        self.claimdir = claimdir
+        os.makedirs (self.claimdir, exist_ok=True)
+
+        self.owner = f'{socket.gethostname():s}:{os.getpid():d}'
+
+        self.held = set()
+        self.lock = threading.Lock ()
+
+        self.stopped = threading.Event ()
+        self.heartbeat = None
+
+        if self.debug:
+            logging.debug ('')
+            logging.debug (f'ClaimDir: {claimdir:s} ttl= {self.ttl:.1f} ' + \
+                f'owner= {self.owner:s}')
+        return
+
+
+    def claim_path (self, relpath):
+
+        name = relpath.replace (os.sep, '%')
+        return (os.path.join (self.claimdir, name + '.claim'))
+
+
+    def claim (self, relpath):
+
+        """
+        Try to claim relpath; returns True if this process now holds the
+        claim, False if a live worker holds it.
+        """
+
+        path = self.claim_path (relpath)
+
+        for attempt in range (0, 2):
+
+            try:
+                fd = os.open (path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, \
+                    0o644)
+            except FileExistsError:
+
+                if (attempt > 0) or (not self.__break_stale (path)):
+                    return (False)
+                continue
+
+            with os.fdopen (fd, 'w') as fp:
+                fp.write (f'{self.owner:s} {relpath:s}\n')
+
+            with self.lock:
+                self.held.add (path)
+                self.__start_heartbeat ()
+
+            if self.debug:
+                logging.debug ('')
+                logging.debug (f'claimed {relpath:s}')
+
+            return (True)
+
+        return (False)
+
+
+    def release (self, relpath):
+
+        path = self.claim_path (relpath)
+
+        with self.lock:
+            self.held.discard (path)
+
+        try:
+            os.remove (path)
+        except FileNotFoundError:
+            pass
+        return
+
+
+    def close (self):
+
+        """
+        Stop the heartbeat and release every claim still held.
+        """
+
+        self.stopped.set ()
+
+        with self.lock:
+            held = list (self.held)
+            self.held.clear ()
+
+        for path in held:
+            try:
+                os.remove (path)
+            except FileNotFoundError:
+                pass
+        return
+
+
+    def __fs_now (self):
+
+#
+#    current time of the (possibly remote) file system
+#
+        clock = os.path.join (self.claimdir, '.clock')
+
+        try:
+            os.utime (clock)
+        except FileNotFoundError:
+            with open (clock, 'a'):
+                pass
+
+        return (os.stat (clock).st_mtime)
+
+
+    def __break_stale (self, path):
+
+#
+#    rename a stale claim away (only one breaker wins the rename), then
+#    check the renamed claim is still stale: if its owner refreshed it in
+#    the meantime, put it back.
+#
+        try:
+            age = self.__fs_now () - os.stat (path).st_mtime
+        except FileNotFoundError:
+            return (True)
+
+        if (age < self.ttl):
+            return (False)
+
+        stale = path + f'.stale.{self.owner:s}.{threading.get_ident():d}'
+
+        try:
+            os.rename (path, stale)
+        except FileNotFoundError:
+            return (True)
+
+        if (self.__fs_now () - os.stat (stale).st_mtime < self.ttl):
+
+            try:
+                os.link (stale, path)
+            except OSError:
+                pass
+            os.remove (stale)
+            return (False)
+
+        os.remove (stale)
+
+        logging.warning (f'Stale download claim broken: {path:s} ' + \
+            f'(no heartbeat for {age:.0f} seconds)')
+        return (True)
+
+
+    def __start_heartbeat (self):
+
+        if ((self.heartbeat is not None) and self.heartbeat.is_alive()):
+            return
+
+        self.stopped.clear ()
+        self.heartbeat = threading.Thread (target=self.__beat, \
+            name='koa-claims', daemon=True)
+        self.heartbeat.start ()
+        return
+
+
+    def __beat (self):
+
+        while (not self.stopped.wait (self.ttl / 4.)):
+
+            with self.lock:
+                held = list (self.held)
+
+            for path in held:
+                try:
+                    os.utime (path)
+                except FileNotFoundError:
+                    pass
+        return
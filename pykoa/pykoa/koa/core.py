@@ -1,10 +1,12 @@
 import os 
-import sys
 import io
 import getpass 
 import logging
 import time
 import json
+import shutil
+import threading
+import concurrent.futures
 #import ijson
 import xmltodict 
 import tempfile
@@ -15,9 +17,26 @@ import urllib
 import http.cookiejar
 
 from astropy.coordinates import name_resolve
-from astropy.table import Table, Column
+from astropy.table import Table
 
 from . import conf
+from .metareader import MetaReader
+from .transfer import stream_to_file, TeeStream
+from .retry import RetryPolicy
+from .download import DownloadPlan, Downloader, Concurrency, OutdirIndex, \
+    get_layout, get_order, run_concurrent, format_size
+from .store import FileStore, clone_file
+from .claims import ClaimDir, shard_of
+from .throttle import get_throttle, host_slot
+from .exceptions import KoaParameterError, KoaQueryError, \
+    KoaTimeoutError, KoaDownloadError, KoaFileError
+from .servers import get_servers
+from .failures import FailureCache, classify
+from .calls import percall, submit_query, new_call
+from .results import QueryResult, LoginResult
+from .sessions import get_session
+from .flights import flights, normalize_adql
+from .querycache import query_cache, parse_criteria, table_formats
 
 class Archive:
 
@@ -56,9 +75,49 @@ class Archive:
     ndnloaded = 0
     ndnloaded_calib = 0
     ncaliblist = 0
+
+    nverified = 0
+    nrefetched = 0
+    nresumed = 0
+
+    hedge = False
+    nhedged = 0
+    nhedge_won = 0
+
+    store = None
+    nstored = 0
+
+    servers = None
+    session = None
+
+    failures = None
+    nskipped = 0
+
+    nworker = 0
+    plan = None
+    throttle = None
+    concurrency = None
+
+    claims = None
+    nother = 0
+    nerror = 0
+    ncoalesced = 0
  
     status = ''
     msg = ''
+
+#
+#    the public methods run on a per-call copy of the instance (see
+#    calls.percall), so one Archive (e.g. Koa) can serve concurrent
+#    queries and downloads; the containers the calls modify are copied
+#    for each call
+#
+    percall_copy = ('verify_failed',)
+
+#
+#    verbose: print the progress messages (None: conf.verbose)
+#
+    verbose = None
     
     debugfname = './koa.debug'    
     debug = 0    
@@ -72,9 +131,15 @@ class Archive:
         Optional inputs:
         ----------------
         debugfile: a file path for the debug output
+
+        verbose:   print the progress messages (True/False); default is
+                   conf.verbose
  
 	"""
  
+        if ('verbose' in kwargs):
+            self.verbose = kwargs.get ('verbose')
+
         if ('debugfile' in kwargs):
             
             self.debug = 1
@@ -92,15 +157,28 @@ class Archive:
             logging.debug ('')
             logging.debug ('Enter koa.init:')
 
+        self.retry = RetryPolicy (debug=self.debug)
+        self.lock = threading.Lock ()
+
+#
+#    files failing verification (path, msg) of the last download
+#
+        self.verify_failed = []
 
 #
-#    retrieve baseurl from conf class;
+#    retrieve baseurl from conf class: the primary of the configured
+#    servers; they are only probed (see ServerPool) when the first query
+#    or download picks the best one, not when the module-level Koa 
+#    instance is created at import;
 #
 #    during dev or test, baseurl will be a keyword input
 #
-        self.baseurl = conf.server
+        self.servers = get_servers (conf.server, debug=self.debug)
         if ('server' in kwargs):
-            self.baseurl = kwargs.get ('server')
+            self.servers = get_servers (kwargs.get ('server'), \
+                debug=self.debug)
+
+        self.baseurl = self.servers.servers[0]
 
         if self.debug:
             logging.debug ('')
@@ -128,6 +206,7 @@ class Archive:
 
 
 
+    @percall
     def login (self, cookiepath, **kwargs):
 
         """
@@ -155,6 +234,13 @@ class Archive:
 
         koa.login (cookiepath): and the program will prompt for 
                                  userid and password 
+
+        The login's cookies are shared in memory by all the queries and 
+        downloads using cookiepath; the session logs in again when it 
+        expires (conf.relogin, see KoaSession).
+
+        A LoginResult is returned; KoaLoginError is raised if the login
+        fails.
         """
 
         if (self.debug == 0):
@@ -184,14 +270,10 @@ class Archive:
             logging.debug (f'cookiepath= [{cookiepath:s}]')
 
         if (len(cookiepath) == 0):
-            print ('A cookiepath is required if you wish to login to KOA')
-            return
+            raise KoaParameterError (\
+                'A cookiepath is required if you wish to login to KOA')
 
-        cookiejar = http.cookiejar.MozillaCookieJar (cookiepath)
-            
-        if self.debug:
-            logging.debug ('')
-            logging.debug ('cookiejar initialized')
+        start = time.monotonic ()
        
         userid= ''
         password = ''
@@ -201,13 +283,6 @@ class Archive:
         if ('password' in kwargs):
             password = kwargs.get ('password')
 
-        url = ''
-        response = ''
-        jsondata = ''
-
-        status = ''
-        msg = ''
-
 #
 #    get userid and password via keyboard input
 #
@@ -217,153 +292,30 @@ class Archive:
         if (len(password) == 0):
             password = getpass.getpass ("Password: ")
 
-        password = urllib.parse.quote (password)
-
-#
-#    retrieve baseurl from conf class;
-#
-        self.baseurl = conf.server
-
-        if self.debug:
-            logging.debug ('')
-            logging.debug (f'baseurl (from conf)= {self.baseurl:s}')
-
 #
-#  url for login
+#    the session of cookiepath logs in, and logs in again with the same
+#    credentials when the session expires (see KoaSession)
 #
+        skwargs = dict()
+        skwargs['debug'] = self.debug
         if ('server' in kwargs):
-            self.baseurl = kwargs.get ('server')
-
-        if self.debug:
-            logging.debug ('')
-            logging.debug (f'baseurl= {self.baseurl:s}')
-
-        self.login_url = self.baseurl + '/KoaAPI/nph-koaLogin?'
-        
-        if self.debug:
-            logging.debug ('')
-            logging.debug (f'login_url= [{self.login_url:s}]')
-	
-        param = dict()
-        param['userid'] = userid
-        param['password'] = password
-    
-        data_encoded = urllib.parse.urlencode (param)
-    
-        url = self.login_url + data_encoded
-
-        if self.debug:
-            logging.debug ('')
-            logging.debug (f'url= [{url:s}]')
-
-#         print (f'url= {url:s}')
-
-#
-#    build url_opener
-#
-        data = None
-
-        try:
-            opener = urllib.request.build_opener (
-                urllib.request.HTTPCookieProcessor (cookiejar))
-            
-            urllib.request.install_opener (opener)
-            
-            request = urllib.request.Request (url)
-            
-            cookiejar.add_cookie_header (request)
-            
-            if self.debug:
-                logging.debug ('')
-                logging.debug (f'send request')
-
-            response = opener.open (request)
-
-            if self.debug:
-                logging.debug ('')
-                logging.debug (f'response returned')
-
-        except urllib.error.URLError as e:
-        
-            status = 'error'
-            msg = 'URLError= ' + e.reason    
-        
-        except urllib.error.HTTPError as e:
-            
-            status = 'error'
-            msg =  'HTTPError= ' +  e.reason 
-            
-        except Exception:
-           
-            status = 'error'
-            msg = 'URL exception'
-             
-        if (status == 'error'):       
-            msg = 'Failed to login: %s' % msg
-            print (msg)
-            return;
-
-        if self.debug:
-            logging.debug ('')
-            logging.debug ('no error')
-
-#
-#    check content-type in response header: 
-#    if it is 'application/json', then it is an error message
-#
-        infostr = dict(response.info())
+            skwargs['server'] = kwargs.get ('server')
 
-        contenttype = infostr.get('Content-type')
+        session = get_session (cookiepath, **skwargs)
 
-        if self.debug:
-            logging.debug ('')
-            logging.debug (f'contenttype= {contenttype:s}')
+        msg = session.login (userid, password)
+        self.cookie_loaded = 1
 
-        data = response.read()
-        sdata = data.decode ("utf-8");
-        jsondata = json.loads (sdata);
-   
-        for key,val in jsondata.items():
-                
-            if (key == 'status'):
-                status = val
-                
-            if (key == 'msg'):
-                msg =  val
-		
         if self.debug:
             logging.debug ('')
-            logging.debug (f'status= {status:s}')
             logging.debug (f'msg= {msg:s}')
 
-
-        if (status == 'ok'):
-            cookiejar.save (cookiepath, ignore_discard=True);
-        
-            msg = 'Successfully login as ' + userid
-            self.cookie_loaded = 1
-
-#
-#    print out cookie values
-#   
-            for cookie in cookiejar:
-                    
-                if self.debug:
-                    logging.debug ('')
-                    logging.debug ('cookie saved:')
-                    logging.debug (cookie)
-                    logging.debug (f'cookie.name= {cookie.name:s}')
-                    logging.debug (f'cookie.value= {cookie.value:s}')
-                    logging.debug (f'cookie.domain= {cookie.domain:s}')
-            
- 
-        else:       
-            msg = 'Failed to login: ' + msg
-
-        print (msg)
-        return;
+        self.__print (msg)
+        return (LoginResult (userid=userid, cookiepath=cookiepath, \
+            elapsed=time.monotonic() - start, msg=msg))
 
 
+    @percall
     def query_datetime (self, instrument, datetime, outpath, **kwargs):
         
         """
@@ -392,6 +344,14 @@ class Archive:
         
 	maxrec:  maximum records to be returned 
 	         default: '0'
+
+        timeout, deadline: time limit of the query, see 
+                           query_criteria
+
+        block: False to run the query in the background, see
+               query_criteria
+
+        A QueryResult is returned, see query_criteria.
         """
  
         if (self.debug == 0):
@@ -419,16 +379,16 @@ class Archive:
             logging.debug ('Enter query_datetime:')
         
         if (len(instrument) == 0):
-            print ('Failed to find required parameter: instrument')
-            return
+            raise KoaParameterError (\
+                'Failed to find required parameter: instrument')
  
         if (len(datetime) == 0):
-            print ('Failed to find required parameter: datetime')
-            return
+            raise KoaParameterError (\
+                'Failed to find required parameter: datetime')
 
         if (len(outpath) == 0):
-            print ('Failed to find required parameter: outpath')
-            return
+            raise KoaParameterError (\
+                'Failed to find required parameter: outpath')
 
         self.instrument = instrument
         self.datetime = datetime
@@ -451,12 +411,11 @@ class Archive:
             logging.debug ('')
             logging.debug ('call query_criteria')
 
-        self.query_criteria (param, outpath, **kwargs)
-
-        return
+        return (self.query_criteria (param, outpath, **kwargs))
 
 
 
+    @percall
     def query_position (self, instrument, pos, outpath, **kwargs):
         
         """
@@ -492,6 +451,14 @@ class Archive:
         format: votable, ipac, csv, etc..  (default: ipac)
 	
 	maxrec:  maximum records to be returned (default: '0')
+
+        timeout, deadline: time limit of the query, see 
+                           query_criteria
+
+        block: False to run the query in the background, see
+               query_criteria
+
+        A QueryResult is returned, see query_criteria.
         """
    
         if (self.debug == 0):
@@ -519,16 +486,16 @@ class Archive:
             logging.debug ('Enter query_position:')
         
         if (len(instrument) == 0):
-            print ('Failed to find required parameter: instrument')
-            return
+            raise KoaParameterError (\
+                'Failed to find required parameter: instrument')
  
         if (len(pos) == 0):
-            print ('Failed to find required parameter: time')
-            return
+            raise KoaParameterError (\
+                'Failed to find required parameter: time')
 
         if (len(outpath) == 0):
-            print ('Failed to find required parameter: outpath')
-            return
+            raise KoaParameterError (\
+                'Failed to find required parameter: outpath')
 
         self.instrument = instrument
         self.pos = pos
@@ -547,11 +514,10 @@ class Archive:
         param['instrument'] = self.instrument
         param['pos'] = self.pos
 
-        self.query_criteria (param, outpath, **kwargs)
-
-        return
+        return (self.query_criteria (param, outpath, **kwargs))
 
 
+    @percall
     def query_object (self, instrument, object, outpath, **kwargs):
         
         """
@@ -585,6 +551,14 @@ class Archive:
 	
 	maxrec:  maximum records to be returned 
 	         default: 0
+
+        timeout, deadline: time limit of the query, see 
+                           query_criteria
+
+        block: False to run the query in the background, see
+               query_criteria
+
+        A QueryResult is returned, see query_criteria.
         """
    
         if (self.debug == 0):
@@ -612,16 +586,16 @@ class Archive:
             logging.debug ('Enter query_object_name:')
 
         if (len(instrument) == 0):
-            print ('Failed to find required parameter: instrument')
-            return
+            raise KoaParameterError (\
+                'Failed to find required parameter: instrument')
  
         if (len(object) == 0):
-            print ('Failed to find required parameter: object')
-            return
+            raise KoaParameterError (\
+                'Failed to find required parameter: object')
 
         if (len(outpath) == 0):
-            print ('Failed to find required parameter: outpath')
-            return
+            raise KoaParameterError (\
+                'Failed to find required parameter: outpath')
 
         self.instrument = instrument
         self.object = object
@@ -635,7 +609,7 @@ class Archive:
 
         radius = 0.5 
         if ('radius' in kwargs):
-            radiusi_str = kwargs.get('radius')
+            radius_str = kwargs.get('radius')
             radius = float(radius_str)
 
         if self.debug:
@@ -644,7 +618,7 @@ class Archive:
 
         coords = None
         try:
-            print (f'resolving object name')
+            self.__print (f'resolving object name')
  
             coords = name_resolve.get_icrs_coordinates (object)
         
@@ -654,8 +628,7 @@ class Archive:
                 logging.debug ('')
                 logging.debug (f'name_resolve error: {str(e):s}')
             
-            print (str(e))
-            return
+            raise KoaParameterError (str(e))
 
         ra = coords.ra.value
         dec = coords.dec.value
@@ -672,7 +645,7 @@ class Archive:
             logging.debug ('')
             logging.debug (f'pos= {self.pos:s}')
        
-        print (f'object name resolved: ra= {ra:f}, dec={dec:f}')
+        self.__print (f'object name resolved: ra= {ra:f}, dec={dec:f}')
  
 #
 #    send url to server to construct the select statement
@@ -682,11 +655,10 @@ class Archive:
         param['instrument'] = self.instrument
         param['pos'] = self.pos
 
-        self.query_criteria (param, outpath, **kwargs)
-
-        return
+        return (self.query_criteria (param, outpath, **kwargs))
 
     
+    @percall
     def query_criteria (self, param, outpath, **kwargs):
         
         """
@@ -723,6 +695,26 @@ class Archive:
 	    format: output table format: votable, ipac, etc.. (default: votable)
 	    
             maxrec: max number of output records
+
+            timeout: time limit (seconds) of the query; past it the job is
+                     aborted and KoaTimeoutError raised (default
+                     conf.query_timeout, 0: no limit)
+
+            deadline: the same as an absolute time (time.time())
+
+            block: False to run the query in the background and return
+                   at once its QueryFuture (result() returns the 
+                   QueryResult, cancel() aborts the job, see 
+                   calls.QueryFuture); default is True
+
+        A QueryResult (outpath, nrows, elapsed, ...) is returned; 
+        KoaQueryError (KoaTimeoutError past the time limit) is raised if
+        the query fails.
+
+        With conf.query_cache_ttl, a query whose datetime range and
+        circle lie within those of a recent result (same instrument,
+        cookiepath, format) is answered by filtering that result locally,
+        no job is submitted (see querycache.QueryCache).
         """
 
         if (self.debug == 0):
@@ -748,6 +740,21 @@ class Archive:
             logging.debug ('')
             logging.debug ('')
             logging.debug ('Enter query_criteria')
+
+#
+#    block=False: run the query in the background, return its future
+#
+        if (('block' in kwargs) and (not kwargs.get('block'))):
+            return (submit_query (self.query_criteria, param, outpath, \
+                **kwargs))
+
+        future = None
+        if ('future' in kwargs):
+            future = kwargs.get('future')
+
+        start = time.monotonic ()
+
+        self.retry = RetryPolicy (debug=self.debug)
 #
 #    send url to server to construct the select statement
 #
@@ -789,14 +796,17 @@ class Archive:
         data = urllib.parse.urlencode (param)
 
 #
-#    retrieve baseurl from conf class;
+#    retrieve baseurl from conf class: the best of the configured
+#    servers (see ServerPool);
 #
 #    during dev or test, baseurl will be a keyword input
 #
-        self.baseurl = conf.server
-
+        self.servers = get_servers (conf.server, debug=self.debug)
         if ('server' in kwargs):
-            self.baseurl = kwargs.get ('server')
+            self.servers = get_servers (kwargs.get ('server'), \
+                debug=self.debug)
+
+        self.baseurl = self.servers.best ()
 
         if self.debug:
             logging.debug ('')
@@ -815,6 +825,17 @@ class Archive:
             logging.debug (f'makequery_url= [{self.makequery_url:s}]')
 
 
+#
+#    a query contained in a cached result (conf.query_cache_ttl) is 
+#    answered by filtering that result locally
+#
+        result = self.__cached_query (param, start)
+        if (result is not None):
+
+            if (future is None):
+                self.__print (result.msg)
+            return (result)
+
         url = self.makequery_url + data            
 
         if self.debug:
@@ -835,8 +856,7 @@ class Archive:
                 logging.debug ('')
                 logging.debug (f'Error: {str(e):s}')
             
-            print (str(e))
-            return ('') 
+            raise KoaQueryError (str(e))
         
         if self.debug:
             logging.debug ('')
@@ -854,6 +874,7 @@ class Archive:
                 format=self.format, \
                 maxrec=self.maxrec, \
                 cookiefile=self.cookiepath, \
+                servers=self.servers, \
 		debug=1)
         
             if self.debug:
@@ -864,7 +885,8 @@ class Archive:
         else: 
             self.tap = KoaTap (self.tap_url, \
                 format=self.format, \
-                maxrec=self.maxrec)
+                maxrec=self.maxrec, \
+                servers=self.servers)
         
             if self.debug:
                 logging.debug ('')
@@ -877,9 +899,10 @@ class Archive:
             logging.debug(f'query= {query:s}')
             logging.debug('call self.tap.send_async')
 
-        print ('submitting request...')
+        if (future is None):
+            self.__print ('submitting request...')
 
-        retstr = self.tap.send_async (query, outpath= self.outpath)
+        retstr = self.__send_query (query, self.__tap_kwargs (kwargs))
         
         if self.debug:
             logging.debug ('')
@@ -895,16 +918,20 @@ class Archive:
 #            logging.debug (f'indx= {indx:d}')
 
         if (indx >= 0):
-            print (retstr)
-            sys.exit()
+            raise KoaQueryError (retstr)
 
 #
 #    no error: 
 #
-        print (retstr)
-        return
+        if (future is None):
+            self.__print (retstr)
+
+        self.__cache_result (param)
+
+        return (self.__query_result (retstr, start))
 
     
+    @percall
     def query_adql (self, query, outpath, **kwargs):
        
         """
@@ -927,6 +954,18 @@ class Archive:
         
 	    maxrec:  maximum records to be returned 
 	             default: 0
+
+            timeout: time limit (seconds) of the query; past it the job 
+                     is aborted and KoaTimeoutError raised 
+                     (default conf.query_timeout, 0: no limit)
+
+            deadline: the same as an absolute time (time.time())
+
+            block:   False to run the query in the background and return
+                     at once its QueryFuture, see query_criteria
+
+        A QueryResult is returned; KoaQueryError is raised if the query
+        fails, see query_criteria.
         """
    
         if (self.debug == 0):
@@ -954,12 +993,24 @@ class Archive:
             logging.debug ('Enter query_adql:')
         
         if (len(query) == 0):
-            print ('Failed to find required parameter: query')
-            return
+            raise KoaParameterError (\
+                'Failed to find required parameter: query')
         
         if (len(outpath) == 0):
-            print ('Failed to find required parameter: outpath')
-            return
+            raise KoaParameterError (\
+                'Failed to find required parameter: outpath')
+
+#
+#    block=False: run the query in the background, return its future
+#
+        if (('block' in kwargs) and (not kwargs.get('block'))):
+            return (submit_query (self.query_adql, query, outpath, **kwargs))
+
+        future = None
+        if ('future' in kwargs):
+            future = kwargs.get('future')
+
+        start = time.monotonic ()
         
         self.query = query
         self.outpath = outpath
@@ -992,12 +1043,15 @@ class Archive:
             logging.debug (f'maxrec= {self.maxrec:s}')
 
 #
-#    retrieve baseurl from conf class;
+#    retrieve baseurl from conf class: the best of the configured
+#    servers (see ServerPool);
 #
-        self.baseurl = conf.server
-
+        self.servers = get_servers (conf.server, debug=self.debug)
         if ('server' in kwargs):
-            self.baseurl = kwargs.get ('server')
+            self.servers = get_servers (kwargs.get ('server'), \
+                debug=self.debug)
+
+        self.baseurl = self.servers.best ()
 
         if self.debug:
             logging.debug ('')
@@ -1022,11 +1076,13 @@ class Archive:
             self.tap = KoaTap (self.tap_url, \
                 format=self.format, \
                 maxrec=self.maxrec, \
-                cookiefile=self.cookiepath)
+                cookiefile=self.cookiepath, \
+                servers=self.servers)
         else: 
             self.tap = KoaTap (self.tap_url, \
                 format=self.format, \
-                maxrec=self.maxrec)
+                maxrec=self.maxrec, \
+                servers=self.servers)
         
         if self.debug:
             logging.debug('')
@@ -1034,12 +1090,10 @@ class Archive:
             logging.debug(f'query= {query:s}')
             logging.debug('call self.tap.send_async')
 
-        print ('submitting request...')
+        if (future is None):
+            self.__print ('submitting request...')
 
-        if (len(self.outpath) > 0):
-            retstr = self.tap.send_async (query, outpath=self.outpath)
-        else:
-            retstr = self.tap.send_async (query)
+        retstr = self.__send_query (query, self.__tap_kwargs (kwargs))
         
         if self.debug:
             logging.debug ('')
@@ -1051,61 +1105,55 @@ class Archive:
         indx = retstr_lower.find ('error')
     
         if (indx >= 0):
-            print (retstr)
-            sys.exit()
+            raise KoaQueryError (retstr)
 
 #
 #    no error: 
 #
-        print (retstr)
-        return
-
+        if (future is None):
+            self.__print (retstr)
 
-    def print_data (self):
+        return (self.__query_result (retstr, start))
 
-        if self.debug:
-            logging.debug ('')
-            logging.debug ('Enter koa.print_data:')
 
-        try:
-            self.tap.print_data ()
-        except Exception as e:
-                
-            msg = 'Error print data: ' + str(e)
-            print (msg)
+    @percall
+    def query_and_download (self, query, outdir, **kwargs):
+       
+        """
+        'query_and_download' method runs an ADQL query and downloads the 
+        FITS files of the returned rows as the result table is read from
+        the TAP service: the first files are downloaded while the rest of
+        the result is still being transferred, and the metadata table 
+        doesn't need to be written to disk.
         
-        return
-
+        Required Inputs:
+        ---------------    
+            query:   a ADQL query
 
-    def download (self, metapath, format, outdir, **kwargs):
-    
-        """
-        The download method allows users to download FITS files (and/or) 
-        associated calibration files shown in their metadata file.
+            outdir:  the directory for depositing the returned files
+        
+        Optional inputs:
+	----------------
+            outpath: also save the returned metadata table to outpath
+                     (default: not saved)
 
-	Required input:
-	-----
-	metapath: a full path metadata table obtained from running
-	          query methods    
+            cookiepath (string): cookie file path for query and download
+                                 of the proprietary KOA data.
         
-	format:   metasata table's format: ipac, votable, csv, or tsv.
-	
-        outdir:   the directory for depositing the returned files      
- 
-	
-        Optional input:
-        ----------------
-        cookiepath (string): cookie file path for downloading the proprietary 
-                             KOA data.
+	    format:  metadata table format: votable, ipac, csv, tsv
+	             (default: ipac)
         
-        start_row,
-	
-        end_row,
+	    maxrec:  maximum records to be returned 
+	             default: 0
 
-        calibfile: whether to download the associated calibration files (0/1);
-                   default is 0.
+            timeout, deadline: time limit of the query, see query_adql
+
+            and the download options (calibfile, nworker, layout, store,
+            claim, ...), see download.
+
+        The download plan (see DownloadPlan) is returned.
         """
-        
+   
         if (self.debug == 0):
 
             if ('debugfile' in kwargs):
@@ -1124,172 +1172,671 @@ class Archive:
             if self.debug:
                 logging.debug ('')
                 logging.debug ('debug turned on')
-    
+        
         if self.debug:
             logging.debug ('')
-            logging.debug ('Enter download:')
+            logging.debug ('')
+            logging.debug ('Enter query_and_download:')
         
-        if (len(metapath) == 0):
-            print ('Failed to find required input parameter: metapath')
-            return
+        if (len(query) == 0):
+            raise KoaParameterError (\
+                'Failed to find required parameter: query')
+        
+        if (len(outdir) == 0):
+            raise KoaParameterError (\
+                'Failed to find required parameter: outdir')
+        
+        self.query = query
 
-        if (len(format) == 0):
-            print ('Failed to find required input parameter: format')
-            return
+        self.outpath = ''
+        if ('outpath' in kwargs): 
+            self.outpath = kwargs.get('outpath')
 
-        if (len(outdir) == 0):
-            print ('Failed to find required input parameter: outdir')
-            return
+        self.cookiepath = '' 
+        if ('cookiepath' in kwargs): 
+            self.cookiepath = kwargs.get('cookiepath')
 
-        self.metapath = metapath
-        self.format = format
-        self.outdir = outdir
+        self.format = 'ipac'
+        if ('format' in kwargs): 
+            self.format = kwargs.get('format')
+
+        self.maxrec = '0'
+        if ('maxrec' in kwargs): 
+            self.maxrec = kwargs.get('maxrec')
 
         if self.debug:
             logging.debug ('')
-            logging.debug (f'metapath= {self.metapath:s}')
+            logging.debug (f'query= {self.query:s}')
+            logging.debug (f'outpath= {self.outpath:s}')
+            logging.debug (f'cookiepath= {self.cookiepath:s}')
             logging.debug (f'format= {self.format:s}')
-            logging.debug (f'outdir= {self.outdir:s}')
+            logging.debug (f'maxrec= {self.maxrec:s}')
 
-        cookiepath = ''
-        cookiejar = None
-        
-        if ('cookiepath' in kwargs): 
-            cookiepath = kwargs.get('cookiepath')
+        self.servers = get_servers (conf.server, debug=self.debug)
+        if ('server' in kwargs):
+            self.servers = get_servers (kwargs.get ('server'), \
+                debug=self.debug)
+
+        self.baseurl = self.servers.best ()
+
+        self.tap_url = self.baseurl + '/TAP/nph-tap.py'
 
         if self.debug:
             logging.debug ('')
-            logging.debug (f'cookiepath= {cookiepath:s}')
-
-        if (len(cookiepath) > 0):
-   
-            cookiejar = http.cookiejar.MozillaCookieJar (cookiepath)
+            logging.debug (f'tap_url= [{self.tap_url:s}]')
 
-            try: 
-                cookiejar.load (ignore_discard=True, ignore_expires=True)
-    
-                if self.debug:
-                    logging.debug (\
-                        f'cookie loaded from file: {cookiepath:s}')
+        if (len(self.cookiepath) > 0):
+            self.tap = KoaTap (self.tap_url, \
+                format=self.format, \
+                maxrec=self.maxrec, \
+                cookiefile=self.cookiepath, \
+                servers=self.servers, \
+                debug=self.debug)
+        else:
+            self.tap = KoaTap (self.tap_url, \
+                format=self.format, \
+                maxrec=self.maxrec, \
+                servers=self.servers, \
+                debug=self.debug)
         
-                for cookie in cookiejar:
-                    
-                    if self.debug:
-                        logging.debug ('')
-                        logging.debug ('cookie=')
-                        logging.debug (cookie)
-                        logging.debug (f'cookie.name= {cookie.name:s}')
-                        logging.debug (f'cookie.value= {cookie.value:s}')
-                        logging.debug (f'cookie.domain= {cookie.domain:s}')
+        self.__print ('submitting request...')
 
-            except Exception as e:
-                if self.debug:
-                    logging.debug ('')
-                    logging.debug (f'loadCookie exception: {str(e):s}')
-                pass
+        retstr = self.tap.send_async (query, stream=True, \
+            **self.__tap_kwargs (kwargs))
         
-        fmt_astropy = self.format
-        if (self.format == 'tsv'):
-            fmt_astropy = 'ascii.tab'
-        if (self.format == 'csv'):
-            fmt_astropy = 'ascii.csv'
-        if (self.format == 'ipac'):
-            fmt_astropy = 'ascii.ipac'
+        if self.debug:
+            logging.debug ('')
+            logging.debug (f'return self.tap.send_async:')
+            logging.debug (f'retstr= {retstr:s}')
+
+        if (retstr.lower().find ('error') >= 0):
+            raise KoaQueryError (retstr)
 
 #
-#    read metadata to astropy table
+#    read the rows straight from the result response (copied to outpath
+#    as they are read when outpath is given)
+#
+        response = self.tap.response_result
+        if (response is None):
+            raise KoaQueryError ( \
+                'Error: the TAP service returned no result stream.')
+
+        response.raw.decode_content = True
+
+        tee = None
+        source = response.raw
+        if (len(self.outpath) > 0):
+            tee = TeeStream (response.raw, self.outpath)
+            source = io.BufferedReader (tee)
+
+        dkwargs = dict (kwargs)
+        for key in ('outpath', 'format', 'maxrec', 'timeout', 'deadline'):
+            dkwargs.pop (key, None)
+        dkwargs['stream'] = True
+
+#
+#    the rest of the result is copied to outpath only when the download
+#    succeeded; on an error (or Ctrl-C) the stream is dropped at once
+#    instead of being read to the end
 #
-        self.astropytbl = None
         try:
-            self.astropytbl = Table.read (self.metapath, format=fmt_astropy)
-        
-        except Exception as e:
-            self.msg = 'Failed to read metadata table to astropy table:' + \
-                str(e) 
-            print (self.msg)
-            sys.exit()
+            plan = self.download (source, self.format, outdir, **dkwargs)
 
-        self.len_tbl = len(self.astropytbl)
+        except BaseException:
+            if (tee is not None):
+                tee.abort ()
+            response.close ()
+            raise
 
-        if self.debug:
+        source.close ()
+        response.close ()
+
+        return (plan)
+
+
+    def __send_query (self, query, tkwargs):
+
+#
+#    send the query and save its result to outpath; an identical query 
+#    in flight (same ADQL, format, maxrec, login and servers) is not sent
+#    again.  The query runs on a thread of its own (see 
+#    SingleFlight.share) with a private copy of self.tap and writes its
+#    result to a temporary file of the flight, copied to the outpath of
+#    every caller still waiting before the flight completes.  A caller's
+#    time limit or cancellation only ends its own wait: the job is 
+#    aborted once no caller is waiting any more.
+#
+        identity = ''
+        if (self.tap.session is not None):
+            identity = os.path.abspath (self.tap.session.cookiepath)
+
+        key = ('query', normalize_adql (query), self.format, \
+            str (self.maxrec), identity, tuple (self.servers.servers))
+
+        tap = new_call (self.tap)
+        tmpdir = os.path.dirname (os.path.abspath (self.outpath))
+
+        def send (abandon, publish):
+
+            (fd, tmppath) = tempfile.mkstemp (prefix='.koaquery.', \
+                dir=tmpdir)
+            os.close (fd)
+            os.chmod (tmppath, 0o644)
+
+            try:
+                retstr = tap.send_async (query, outpath=tmppath, \
+                    timeout=0, cancel=abandon, on_job=publish)
+
+            except BaseException:
+                os.remove (tmppath)
+                raise
+
+            return ((retstr, tmppath, tap.koajob))
+
+        outpath = self.outpath
+
+        def deliver (result, last):
+
+            (retstr, tmppath, job) = result
+
+            if (retstr.lower().find ('error') < 0):
+
+                if last:
+                    os.replace (tmppath, outpath)
+                else:
+                    shutil.copyfile (tmppath, outpath)
+
+                retstr = retstr.replace (tmppath, outpath)
+
+            return ((retstr, job))
+
+        def cleanup (result):
+
+            if (os.path.exists (result[1])):
+                os.remove (result[1])
+            return
+
+        deadline = tkwargs.get ('deadline')
+
+        timeout = tkwargs.get ('timeout', conf.query_timeout)
+        if ((timeout is not None) and (timeout > 0)):
+            if ((deadline is None) or (time.time() + timeout < deadline)):
+                deadline = time.time() + timeout
+
+        ((retstr, job), leader) = flights.share (key, send, \
+            deliver=deliver, cleanup=cleanup, notify=tkwargs.get ('on_job'), \
+            deadline=deadline, cancel=tkwargs.get ('cancel'))
+
+        if ((not leader) and self.debug):
             logging.debug ('')
-            logging.debug ('self.astropytbl read')
-            logging.debug (f'self.len_tbl= {self.len_tbl:d}')
+            logging.debug ('query coalesced with an identical query')
+
+        self.tap.koajob = job
+        return (retstr)
+
+
+    def __cache_scope (self, param):
+
+#
+#    the criteria of a query_criteria query the query cache can answer
+#    and the results they may be answered from: same instrument, login,
+#    servers and format; (None, None) if not cacheable
+#
+        if (not query_cache.enabled ()):
+            return ((None, None))
+
+        if (str (self.maxrec) not in ('', '0')):
+            return ((None, None))
+
+        criteria = parse_criteria (param)
+        if (criteria is None):
+            return ((None, None))
+
+        identity = ''
+        if (len(self.cookiepath) > 0):
+            identity = os.path.abspath (self.cookiepath)
+
+        scope = (param.get ('instrument', '').lower(), identity, \
+            tuple (self.servers.servers), self.format)
+
+        return ((scope, criteria))
+
+
+    def __cached_query (self, param, start):
 
-        self.colnames = self.astropytbl.colnames
+        (scope, criteria) = self.__cache_scope (param)
+        if (scope is None):
+            return (None)
+
+        try:
+            table = query_cache.lookup (scope, criteria)
+            if (table is None):
+                return (None)
+
+            table.write (self.outpath, format=table_formats[self.format], \
+                overwrite=True)
+
+        except Exception as e:
+
+            if self.debug:
+                logging.debug ('')
+                logging.debug (f'query cache not used: {str(e):s}')
+            return (None)
 
         if self.debug:
             logging.debug ('')
-            logging.debug ('self.colnames:')
-            logging.debug (self.colnames)
-  
-        self.len_col = len(self.colnames)
+            logging.debug (f'query answered from the query cache: ' + \
+                f'{len(table):d} rows')
+
+        self.query = ''
+        self.tap = None
+
+        msg = 'Result derived from a cached query result ' + \
+            f'[{self.outpath:s}]'
+
+        return (QueryResult (outpath=self.outpath, format=self.format, \
+            nrows=len(table), elapsed=time.monotonic() - start, msg=msg))
+
+
+    def __cache_result (self, param):
+
+        (scope, criteria) = self.__cache_scope (param)
+        if (scope is None):
+            return
+
+        try:
+            query_cache.add (scope, criteria, self.outpath, self.format)
+
+        except Exception as e:
+
+            if self.debug:
+                logging.debug ('')
+                logging.debug (f'result not cached: {str(e):s}')
+        return
+
+
+    def __tap_kwargs (self, kwargs):
+
+#
+#    the query time limit options passed on to KoaTap.send_async, and the
+#    hooks of a non-blocking query's future
+#
+        tkwargs = dict()
+        for key in ('timeout', 'deadline'):
+            if (key in kwargs):
+                tkwargs[key] = kwargs.get(key)
+
+        if ('future' in kwargs):
+            future = kwargs.get('future')
+            tkwargs['cancel'] = future.cancel_event
+            tkwargs['on_job'] = future.set_job
+
+        return (tkwargs)
+
+
+    def __query_result (self, msg, start):
+
+#
+#    the QueryResult of a query whose table was saved to outpath; the
+#    rows are counted by reading the table back (only the row structure
+#    is parsed, see MetaReader)
+#
+        nrows = -1
+        try:
+            reader = MetaReader (self.outpath, self.format, columns=[])
+            for row in reader:
+                pass
+            nrows = reader.nrow
+
+        except Exception as e:
+
+            if self.debug:
+                logging.debug ('')
+                logging.debug (f'rows not counted: {str(e):s}')
+
+        return (QueryResult (outpath=self.outpath, format=self.format, \
+            query=self.query, nrows=nrows, job=self.tap.koajob, \
+            elapsed=time.monotonic() - start, msg=msg))
+
+
+    def __print (self, msg):
+
+#
+#    progress and report messages, silent when verbose is off
+#
+        verbose = conf.verbose
+        if (self.verbose is not None):
+            verbose = self.verbose
+
+        if verbose:
+            print (msg)
+        return
+
+
+    def print_data (self):
 
         if self.debug:
             logging.debug ('')
-            logging.debug (f'self.len_col= {self.len_col:d}')
+            logging.debug ('Enter koa.print_data:')
+
+        try:
+            self.tap.print_data ()
+        except Exception as e:
+                
+            msg = 'Error print data: ' + str(e)
+            print (msg)
+        
+        return
+
+
+    @percall
+    def download (self, metapath, format, outdir, **kwargs):
+    
+        """
+        The download method allows users to download FITS files (and/or) 
+        associated calibration files shown in their metadata file.
 
+	Required input:
+	-----
+	metapath: a full path metadata table obtained from running
+	          query methods, or an open (binary) file object reading 
+                  one
+        
+	format:   metasata table's format: ipac, votable, csv, or tsv.
+	
+        outdir:   the directory for depositing the returned files      
  
-        self.ind_instrume = -1
-        self.ind_koaid = -1
-        self.ind_filehand = -1
-        for i in range (0, self.len_col):
+	
+        Optional input:
+        ----------------
+        cookiepath (string): cookie file path for downloading the proprietary 
+                             KOA data.
+        
+        start_row,
+	
+        end_row,
 
-            if (self.colnames[i].lower() == 'instrume'):
-                self.ind_instrume = i
+        calibfile: whether to download the associated calibration files (0/1);
+                   default is 0.
 
-            if (self.colnames[i].lower() == 'koaid'):
-                self.ind_koaid = i
+        nworker:   number of files downloaded concurrently;
+                   default is conf.nworker.
+
+        adaptive:  adapt the number of concurrent downloads to the 
+                   observed throughput, starting from nworker, up to
+                   max_nworker (see Concurrency); default is 
+                   conf.adaptive.
+
+        max_nworker: default is conf.max_nworker.
+
+        hedge:     send a second request for a file still downloading
+                   after the 95th percentile of the download times so
+                   far; the first copy to complete is kept (see 
+                   Downloader); default is conf.hedge.
+
+        sizing:    size the files with HEAD requests before downloading 
+                   (0/1); default is to size them only when the plan 
+                   needs the sizes: dry_run, quota, or order 'largest'
+                   or 'smallest'.  Without sizes the space preflight 
+                   only checks the free inodes.
+
+        dry_run:   only report the download plan (number of files, volume,
+                   free space), no file is written; default is False.
+
+        quota:     maximum number of bytes the download may write;
+                   default is 0 (no limit besides the free space).
+
+        layout:    'flat' (every file in outdir) or 'sharded' 
+                   (outdir/instrument/yyyymmdd/koaid), or a function 
+                   returning the file path relative to outdir of a plan 
+                   item; default is 'flat'.
+
+        store:     a FileStore, or the directory of one, shared with other
+                   downloads: files found in the store are linked into
+                   outdir instead of being downloaded, downloaded files
+                   are added to it; default is conf.store (no store when
+                   empty).  The store is kept within its size and age
+                   limits (conf.store_max_bytes, conf.store_max_age).
+
+        failures:  the negative cache of the files the server refused
+                   as missing or proprietary (see FailureCache), a
+                   FailureCache, a database path or True for
+                   outdir/.koafailures.sqlite; such files are skipped
+                   (for the same login) until their entry expires
+                   (conf.failure_ttl) instead of being requested again
+                   on every run; default is no cache.
+
+        refresh_failures: forget the cached failures before downloading:
+                   True (all), or a kind or list of kinds, e.g. 
+                   'proprietary' after a login; default is False.
+
+        shard:     (i, n): download only shard i (0 .. n-1) of the table,
+                   so n processes (or nodes) share the download; the rows
+                   are split by koaid.
+
+        claim:     a claim directory on a file system shared by the 
+                   processes (True: outdir/.koaclaims): each file is 
+                   claimed before it is downloaded (see ClaimDir) so 
+                   processes draining the same table never fetch a file
+                   twice, and the files claimed by a crashed process are
+                   taken over once its claims expire (conf.claim_ttl).
+                   With claim, shard is only the process' first share: 
+                   when done, it helps with the other shards; default is
+                   no claim.
+
+        order:     order in which the files are fetched: 'largest' 
+                   (largest first, best throughput), 'smallest' (first
+                   files soonest), 'table', 'date' (grouped by night),
+                   'calib' (calibration files first, then science files
+                   by night), or a function (plan item -> sort key);
+                   default is 'table'.
+
+        bandwidth: download bandwidth limit, bytes/s or a string with a
+                   K/M/G suffix, e.g. '20M' (default conf.bandwidth; 0:
+                   no limit).
+
+        worker_bandwidth: the same per worker (default 
+                   conf.worker_bandwidth).
+
+        bandwidth_schedule: time-of-day windows replacing bandwidth, 
+                   e.g. '08:00-20:00=2M' to run at full speed at night 
+                   only, or '08:00-20:00=pause' to download at night only
+                   (default conf.bandwidth_schedule).  The number of 
+                   concurrent downloads from one host is capped by
+                   conf.max_per_host.
+
+        stream:    start downloading as the rows are read instead of 
+                   planning the whole table first (sizing, dry_run,
+                   quota and order are then not used: the files are 
+                   fetched in table order); default is False.
+
+        The plan (see DownloadPlan) is returned, with the download's
+        statistics (plan.stats) and duration (plan.elapsed); 
+        KoaDownloadError is raised if the download can't run (a file 
+        failing to download is counted in plan.stats['nerror']).
+        """
 
-            if (self.colnames[i].lower() == 'filehand'):
-                self.ind_filehand = i
-             
-        if self.debug:
-            logging.debug ('')
-            logging.debug (f'self.ind_instrume= {self.ind_instrume:d}')
-            logging.debug (f'self.ind_koaid= {self.ind_koaid:d}')
-            logging.debug (f'self.ind_filehand= {self.ind_filehand:d}')
-       
+        for record in self.download_iter (metapath, format, outdir, **kwargs):
+            pass
+
+        return (self.plan)
+
+
+    @percall
+    def download_iter (self, metapath, format, outdir, **kwargs):
     
-        if (self.len_tbl == 0):
-            print ('There is no data in the metadata table.')
-            sys.exit()
+        """
+        The download_iter method runs a download (same input as download)
+        as a generator: a record is yielded for each file as soon as it is
+        written, so the files can be processed while the others are still
+        downloading.
+
+        Calling Synopsis (example):
+
+        for record in Koa.download_iter (metapath, 'ipac', outdir, \
+            calibfile=1):
+
+            if (record['status'] == 'ok'):
+                reduce (record['path'])
+
+        Each record is a dictionary:
+
+            koaid, instrument,
+            path:     file path,
+            size:     file size in bytes (-1 on error),
+            duration: transfer time in seconds,
+            status:   'ok', 'error', or 'exists' (downloaded by another 
+                      process, see claim),
+            nworker:  number of concurrent downloads when the file 
+                      completed,
+            msg:      error message,
+            source:   'network', 'store' (linked from the local store),
+                      'coalesced' (fetched once for concurrent downloads
+                      of the same file) or 'other' (another process),
+            calib:    0 for a file of the metadata table, 1 for a 
+                      calibration file,
+            group:    koaid of the science file a calibration file 
+                      belongs to (its own koaid for a science file)
+
+        Files already in outdir are not fetched, so not reported; the
+        plan (self.plan) lists them.
+        """
         
-        calibfile = 0 
-        if ('calibfile' in kwargs): 
-            calibfile = kwargs.get('calibfile')
-         
-        if self.debug:
-            logging.debug ('')
-            logging.debug (f'calibfile= {calibfile:d}')
+        if (self.debug == 0):
 
-        srow = 0;
-        erow = self.len_tbl - 1
+            if ('debugfile' in kwargs):
+            
+                self.debug = 1
+                self.debugfname = kwargs.get ('debugfile')
 
-        if ('start_row' in kwargs): 
-            srow = kwargs.get('start_row')
+                if (len(self.debugfname) > 0):
+      
+                    logging.basicConfig (filename=self.debugfname, \
+                        level=logging.DEBUG)
+    
+                    with open (self.debugfname, 'w') as fdebug:
+                        pass
 
+            if self.debug:
+                logging.debug ('')
+                logging.debug ('debug turned on')
+    
         if self.debug:
             logging.debug ('')
-            logging.debug (f'srow= {srow:d}')
-     
-        if ('end_row' in kwargs): 
-            erow = kwargs.get('end_row')
+            logging.debug ('Enter download:')
+
+        self.retry = RetryPolicy (debug=self.debug)
+        self.plan = None
         
+        if (isinstance (metapath, str) and (len(metapath) == 0)):
+            raise KoaParameterError (\
+                'Failed to find required input parameter: metapath')
+
+        if (len(format) == 0):
+            raise KoaParameterError (\
+                'Failed to find required input parameter: format')
+
+        if (len(outdir) == 0):
+            raise KoaParameterError (\
+                'Failed to find required input parameter: outdir')
+
+        self.metapath = metapath
+        self.format = format
+        self.outdir = outdir
+
         if self.debug:
             logging.debug ('')
-            logging.debug (f'erow= {erow:d}')
-     
-        if (srow < 0):
-            srow = 0 
-        if (erow > self.len_tbl - 1):
-            erow = self.len_tbl - 1 
- 
+            logging.debug (f'metapath= {str(self.metapath):s}')
+            logging.debug (f'format= {self.format:s}')
+            logging.debug (f'outdir= {self.outdir:s}')
+
+        cookiepath = ''
+        cookiejar = None
+        
+        if ('cookiepath' in kwargs): 
+            cookiepath = kwargs.get('cookiepath')
+
         if self.debug:
             logging.debug ('')
-            logging.debug (f'srow= {srow:d}')
-            logging.debug (f'erow= {erow:d}')
-     
+            logging.debug (f'cookiepath= {cookiepath:s}')
+
+#
+#    the cookies of cookiepath's session, shared with the other queries
+#    and downloads (see KoaSession); identity: the login the files are
+#    requested with, part of the keys of the shared fetches and of the
+#    failure cache
+#
+        self.session = None
+        self.identity = ''
+        if (len(cookiepath) > 0):
+   
+            self.session = get_session (cookiepath, debug=self.debug)
+            self.identity = os.path.abspath (self.session.cookiepath)
+
+            try: 
+                cookiejar = self.session.cookies ()
+    
+            except Exception as e:
+                if self.debug:
+                    logging.debug ('')
+                    logging.debug (f'loadCookie exception: {str(e):s}')
+
+                cookiejar = self.session.cookiejar
+        
+#
+#    retrieve baseurl from conf class: the best of the configured
+#    servers (see ServerPool);
+#
+        self.servers = get_servers (conf.server, debug=self.debug)
+        if ('server' in kwargs):
+            self.servers = get_servers (kwargs.get ('server'), \
+                debug=self.debug)
+
+        self.baseurl = self.servers.best ()
+
+        if self.debug:
+            logging.debug ('')
+            logging.debug (f'baseurl= {self.baseurl:s}')
+
+#
+#    urls for nph-getKoa, and nph-getCaliblist
+#
+        self.getkoa_url = self.baseurl + '/getKOA/nph-getKOA?return_mode=json&'
+        self.caliblist_url = self.baseurl+ '/KoaAPI/nph-getCaliblist?'
+
+        if self.debug:
+            logging.debug ('')
+            logging.debug (f'self.getkoa_url= {self.getkoa_url:s}')
+            logging.debug (f'self.caliblist_url= {self.caliblist_url:s}')
+      
+        calibfile = 0 
+        if ('calibfile' in kwargs): 
+            calibfile = kwargs.get('calibfile')
+         
+        if self.debug:
+            logging.debug ('')
+            logging.debug (f'calibfile= {calibfile:d}')
+
+#
+#    erow < 0: read to the end of the table
+#
+        srow = 0;
+        erow = -1
+
+        if ('start_row' in kwargs): 
+            srow = kwargs.get('start_row')
+
+        if ('end_row' in kwargs): 
+            erow = kwargs.get('end_row')
+        
+        if (srow < 0):
+            srow = 0 
+ 
+        if self.debug:
+            logging.debug ('')
+            logging.debug (f'srow= {srow:d}')
+            logging.debug (f'erow= {erow:d}')
+     
 #
 #    create outdir if it doesn't exist
 #
@@ -1308,365 +1855,1047 @@ class Archive:
         try:
             os.makedirs (self.outdir, mode=d1, exist_ok=True) 
 
-        except Exception as e:
-            
-            self.msg = 'Failed to create {self.outdir:s}:' + str(e) 
-            print (self.msg)
-            sys.exit()
+        except Exception as e:
+            
+            self.msg = f'Failed to create {self.outdir:s}: ' + str(e) 
+            raise KoaDownloadError (self.msg)
+
+        if self.debug:
+            logging.debug ('')
+            logging.debug ('returned os.makedirs') 
+
+        self.ndnloaded = 0
+        self.ndnloaded_calib = 0
+        self.ncaliblist = 0
+
+        self.nverified = 0
+        self.nrefetched = 0
+        self.nresumed = 0
+        self.verify_failed = []
+        self.nstored = 0
+        self.nhedged = 0
+        self.nhedge_won = 0
+        self.nother = 0
+        self.nskipped = 0
+        self.nerror = 0
+        self.ncoalesced = 0
+
+        start = time.monotonic ()
+
+        nworker = conf.nworker
+        if ('nworker' in kwargs): 
+            nworker = kwargs.get('nworker')
+
+        self.nworker = nworker
+
+        sizing = None
+        if ('sizing' in kwargs): 
+            sizing = kwargs.get('sizing')
+
+        dry_run = False
+        if ('dry_run' in kwargs): 
+            dry_run = kwargs.get('dry_run')
+
+        quota = 0
+        if ('quota' in kwargs): 
+            quota = kwargs.get('quota')
+
+        layout = 'flat'
+        if ('layout' in kwargs): 
+            layout = kwargs.get('layout')
+
+        stream = False
+        if ('stream' in kwargs): 
+            stream = kwargs.get('stream')
+
+        order = 'table'
+        if ('order' in kwargs): 
+            order = kwargs.get('order')
+
+#
+#    a HEAD request per file only when the sizes are used
+#
+        if (sizing is None):
+            sizing = int (dry_run or (quota > 0) or \
+                (order in ('largest', 'smallest')))
+
+        adaptive = conf.adaptive
+        if ('adaptive' in kwargs): 
+            adaptive = kwargs.get('adaptive')
+
+        max_nworker = conf.max_nworker
+        if ('max_nworker' in kwargs): 
+            max_nworker = kwargs.get('max_nworker')
+
+        self.hedge = conf.hedge
+        if ('hedge' in kwargs): 
+            self.hedge = kwargs.get('hedge')
+
+        self.concurrency = None
+        if adaptive:
+            self.concurrency = Concurrency (nworker=nworker, \
+                nmax=max_nworker, debug=self.debug)
+            self.retry.on_retry = self.concurrency.congested
+
+        tkwargs = dict()
+        for key in ('bandwidth', 'worker_bandwidth'):
+            if (key in kwargs):
+                tkwargs[key] = kwargs.get(key)
+
+        if ('bandwidth_schedule' in kwargs):
+            tkwargs['schedule'] = kwargs.get('bandwidth_schedule')
+
+        try:
+            self.layout = get_layout (layout)
+            get_order (order)
+
+            self.throttle = get_throttle (debug=self.debug, **tkwargs)
+        except Exception as e:
+            raise KoaParameterError (str(e))
+
+        if (not self.throttle.active()):
+            self.throttle = None
+
+        store = conf.store
+        if ('store' in kwargs): 
+            store = kwargs.get('store')
+
+        self.store = None
+        try:
+            if isinstance (store, FileStore):
+                self.store = store
+            elif ((store is not None) and (len(store) > 0)):
+                self.store = FileStore (store, debug=self.debug)
+        except Exception as e:
+            raise KoaDownloadError (\
+                f'Failed to open the file store {str(store):s}: ' + str(e))
+
+        failures = None
+        if ('failures' in kwargs): 
+            failures = kwargs.get('failures')
+
+        if (failures is True):
+            failures = os.path.join (self.outdir, '.koafailures.sqlite')
+
+        refresh_failures = False
+        if ('refresh_failures' in kwargs): 
+            refresh_failures = kwargs.get('refresh_failures')
+
+        self.failures = None
+        try:
+            if isinstance (failures, FailureCache):
+                self.failures = failures
+            elif (failures):
+                self.failures = FailureCache (failures, debug=self.debug)
+        except Exception as e:
+            raise KoaDownloadError (\
+                f'Failed to open the failure cache {str(failures):s}: ' \
+                + str(e))
+
+        if ((self.failures is not None) and (refresh_failures)):
+
+            kinds = None
+            if (refresh_failures is not True):
+                kinds = refresh_failures
+
+            self.failures.refresh (kinds)
+
+        shard = None
+        if ('shard' in kwargs): 
+            shard = kwargs.get('shard')
+
+        if ((shard is not None) and \
+            ((shard[1] < 1) or (shard[0] < 0) or (shard[0] >= shard[1]))):
+            raise KoaParameterError (f'Invalid shard: {str(shard):s}')
+
+        claim = False
+        if ('claim' in kwargs): 
+            claim = kwargs.get('claim')
+
+        self.claims = None
+        if (claim is True):
+            claim = os.path.join (self.outdir, '.koaclaims')
+
+        if (claim):
+            self.claims = ClaimDir (claim, debug=self.debug)
+
+#
+#    one scan of outdir: the existence checks are set lookups
+#
+        self.index = OutdirIndex (self.outdir, \
+            recursive=(layout != 'flat'), debug=self.debug)
+
+        if self.debug:
+            logging.debug ('')
+            logging.debug (f'nworker= {nworker:d}')
+            logging.debug (f'sizing= {sizing:d}')
+            logging.debug (f'dry_run= {str(dry_run):s}')
+            logging.debug (f'quota= {quota:d}')
+            logging.debug (f'shard= {str(shard):s}')
+            logging.debug (f'claim= {str(claim):s}')
+            logging.debug (f'stream= {str(stream):s}')
+      
+#
+#    planning: read only the instrume, koaid and filehand columns of the 
+#    metadata table (rows are streamed from the file by MetaReader, the 
+#    table is never loaded into memory as a whole), resolve the 
+#    calibration lists and size every file before anything is written.
+#
+        plan = DownloadPlan (self.outdir, debug=self.debug)
+        self.plan = plan
+
+        reader = MetaReader (self.metapath, self.format, \
+            columns=['instrume', 'koaid', 'filehand'], debug=self.debug)
+
+        self.len_tbl = 0
+        rows = self.__read_rows (reader, srow, erow, shard)
+
+        if stream:
+            
+            self.__print ('Start downloading the FITS data you requested as the ' + \
+                'metadata table is read;')
+            self.__print (f'please check your outdir: {self.outdir:s} for  progress.')
+
+            pending = self.__stream_items (rows, plan, cookiejar, calibfile)
+
+        else:
+            pending = self.__plan_download (plan, reader, rows, cookiejar, \
+                calibfile, nworker, sizing, dry_run, quota, shard, order)
+
+            if (pending is None):
+                plan.elapsed = time.monotonic() - start
+                return
+
+        runner = self.__run_items (pending, cookiejar, nworker)
+        try:
+            for (item, result, error) in runner:
+                yield (self.__count_record (item, result, error))
+
+        finally:
+#
+#    the caller may stop iterating early (break, close()): the workers
+#    are stopped first -- the transfers in flight are cancelled, which
+#    closes their files -- then the claims still held are released
+#
+            runner.close ()
+
+            if (self.claims is not None):
+                self.claims.close ()
+
+            plan.stats = self.__download_stats ()
+            plan.elapsed = time.monotonic() - start
+
+        if (stream and (self.len_tbl == 0)):
+            self.__print ('There is no data in the metadata table.')
+
+        if self.debug:
+            logging.debug ('')
+            logging.debug (f'{self.len_tbl:d} files in the table;')
+            logging.debug (f'{self.ndnloaded:d} files downloaded.')
+            logging.debug (f'{self.ncaliblist:d} calibration list downloaded.')
+            logging.debug (\
+                f'{self.ndnloaded_calib:d} calibration files downloaded.')
+
+        self.__print (f'A total of new {self.ndnloaded:d} FITS files downloaded.')
+        self.__print (f'{self.ncaliblist:d} new calibration list downloaded.')
+        self.__print (f'{self.ndnloaded_calib:d} new calibration FITS files downloaded.')
+
+        if (self.concurrency is not None):
+            self.__print (self.concurrency.report_line ())
+
+        if (self.claims is not None):
+
+            self.claims.close ()
+            self.__print (f'{self.nother:d} files downloaded by other processes.')
+
+        if (self.nskipped > 0):
+            self.__print (f'{self.nskipped:d} files skipped: refused by the ' + \
+                'server in a previous run (see refresh_failures).')
+
+        if (self.store is not None):
+
+            self.store.evict ()
+            stats = self.store.stats ()
+
+            self.__print (f'{self.nstored:d} files linked from the local store ' + \
+                f'({stats["nhit"]:d} hits, {stats["nmiss"]:d} misses, ' + \
+                f'{stats["nevict"]:d} evicted; ' + \
+                f'{format_size(stats["nbyte"]):s} in store).')
+
+        self.__print (f'{self.nverified:d} files verified, ' + \
+            f'{len(self.verify_failed):d} failed verification ' + \
+            f'({self.nrefetched:d} re-fetches, {self.nresumed:d} resumed).')
+
+        if (self.nhedged > 0):
+            self.__print (f'{self.nhedged:d} hedged requests ' + \
+                f'({self.nhedge_won:d} completed first).')
+
+        if (self.ncoalesced > 0):
+            self.__print (f'{self.ncoalesced:d} files shared with concurrent ' + \
+                'downloads of the same files.')
+
+        for (path, msg) in self.verify_failed:
+            self.__print (f'    {path:s}: {msg:s}')
+
+        plan.stats = self.__download_stats ()
+        plan.elapsed = time.monotonic() - start
+        return
+
+
+    def __count_record (self, item, result, error):
+
+#
+#    the record of a completed item, counted in the download statistics
+#
+        record = self.__make_record (item, result, error)
+
+        if (record['status'] == 'error'):
+            self.nerror = self.nerror + 1
+
+        if (error is not None):
+            self.__print (f'File [{item["koaid"]:s}] download: {str(error):s}')
+
+        elif (result['status'] == 'skipped'):
+            self.nskipped = self.nskipped + 1
+
+        elif (result['status'] == 'exists'):
+            self.nother = self.nother + 1
+
+        elif (item['calib']):
+            self.ndnloaded_calib = self.ndnloaded_calib + 1
+        else:
+            self.ndnloaded = self.ndnloaded + 1
+
+        if self.debug:
+            logging.debug ('')
+            logging.debug (f'{record["koaid"]:s}: {record["status"]:s} ' + \
+                f'{record["path"]:s}')
+
+        return (record)
+
+
+    def __download_stats (self):
+
+        stats = dict()
+        stats['ndownloaded'] = self.ndnloaded
+        stats['ndownloaded_calib'] = self.ndnloaded_calib
+        stats['ncaliblist'] = self.ncaliblist
+        stats['nerror'] = self.nerror
+        stats['nskipped'] = self.nskipped
+        stats['nother'] = self.nother
+        stats['nstored'] = self.nstored
+        stats['nverified'] = self.nverified
+        stats['nrefetched'] = self.nrefetched
+        stats['nresumed'] = self.nresumed
+        stats['nhedged'] = self.nhedged
+        stats['nhedge_won'] = self.nhedge_won
+        stats['ncoalesced'] = self.ncoalesced
+        stats['verify_failed'] = list (self.verify_failed)
+        return (stats)
+
+
+    def __plan_download (self, plan, reader, rows, cookiejar, calibfile, \
+        nworker, sizing, dry_run, quota, shard, order):
+
+#
+#    plan the whole table before downloading; returns the items to
+#    fetch in order, None when nothing is to be downloaded (dry run, 
+#    empty table)
+#
+        try:
+            for item in rows:
+                plan.add (item)
+
+        except Exception as e:
+            self.msg = 'Failed to read metadata table: ' + str(e) 
+            raise KoaDownloadError (self.msg)
+
+        if self.debug:
+            logging.debug ('')
+            logging.debug ('metadata table read')
+            logging.debug (f'self.len_tbl= {self.len_tbl:d}')
+            logging.debug ('colnames:')
+            logging.debug (reader.colnames)
+
+        if (self.len_tbl == 0):
+            self.__print ('There is no data in the metadata table.')
+            return (None)
+        
+        if (calibfile == 1):
+            self.__plan_calibfiles (plan, cookiejar, nworker, dry_run)
+
+        if (sizing == 1):
+            self.__plan_sizes (plan, cookiejar, nworker)
+
+        self.__print (plan.report())
+
+        if dry_run:
+            return (None)
+
+        (ok, msg) = plan.check_space (quota=quota)
+
+        if (not ok):
+            raise KoaDownloadError (msg)
+
+        pending = plan.pending (order)
+
+        if ((shard is not None) and (self.claims is not None)):
+
+            pending = \
+                [item for item in pending \
+                    if (shard_of (item['group'], shard[1]) == shard[0])] + \
+                [item for item in pending \
+                    if (shard_of (item['group'], shard[1]) != shard[0])]
+
+        nfetch = len ([item for item in pending if (item['failed'] is None)])
+
+        self.__print (f'Start downloading {nfetch:d} FITS data you requested;')
+        self.__print (f'please check your outdir: {self.outdir:s} for  progress.')
+
+        return (pending)
+
+
+    def __read_rows (self, reader, srow, erow, shard):
+
+#
+#    science items of the rows srow..erow (and of the shard) of the
+#    metadata table, as they are read
+#
+        for (instrument, koaid, filehand) in reader:
+       
+            l = self.len_tbl
+            self.len_tbl = self.len_tbl + 1
+
+            if (l < srow):
+                continue
+
+            if ((erow >= 0) and (l > erow)):
+                break
+
+#
+#    without claims the shards are a strict partition of the table
+#
+            if ((shard is not None) and (self.claims is None) and \
+                (shard_of (koaid, shard[1]) != shard[0])):
+                continue
+
+            if self.debug:
+                logging.debug ('')
+                logging.debug (f'l= {l:d} koaid= {koaid:s}')
+
+            yield (self.__make_item (instrument, koaid, filehand, l, 0, \
+                koaid))
+
+        return
+
+
+    def __stream_items (self, rows, plan, cookiejar, calibfile):
+
+#
+#    streaming: hand the items to the download workers as the rows are
+#    read; the calibration list of a science file is retrieved when its
+#    row is read
+#
+        try:
+            for item in rows:
+
+                if (not plan.add (item)):
+                    continue
+
+                if (not item['exists']):
+                    yield (item)
+
+                if (calibfile != 1):
+                    continue
+
+                try:
+                    table = self.__get_caliblist (item, cookiejar, False)
+
+                except Exception as e:
+
+                    msg = f'File [{item["koaid"]:s}] caliblist: {str(e):s}'
+                    plan.errors.append (msg)
+                    self.__print (msg)
+                    continue
+
+                for rec in table:
+
+                    calib = self.__make_item (rec['instrument'], \
+                        rec['koaid'], rec['filehand'], item['row'], 1, \
+                        item['koaid'])
+
+                    if (plan.add (calib) and (not calib['exists'])):
+                        yield (calib)
+
+        except Exception as e:
+
+            self.msg = 'Failed to read metadata table: ' + str(e) 
+            plan.errors.append (self.msg)
+            self.__print (self.msg)
+
+        return
+
+
+    def __make_record (self, item, result, error):
+
+        record = dict()
+        record['koaid'] = item['koaid']
+        record['instrument'] = item['instrument']
+        record['path'] = item['filepath']
+        record['calib'] = item['calib']
+        record['group'] = item['group']
+        record['duration'] = item.get ('end', 0.) - item.get ('start', 0.)
+        record['size'] = -1
+        record['msg'] = ''
+
+        record['nworker'] = self.nworker
+        if (self.concurrency is not None):
+            record['nworker'] = self.concurrency.limit
+
+        if (error is not None):
+            record['status'] = 'error'
+            record['msg'] = str(error)
+            record['source'] = 'network'
+            return (record)
+
+        record['status'] = result['status']
+        record['source'] = 'network'
+
+        if ('store' in result):
+            record['source'] = 'store'
+        elif ('coalesced' in result):
+            record['source'] = 'coalesced'
+        elif (result['status'] == 'exists'):
+            record['source'] = 'other'
+
+        if ('size' in result):
+            record['size'] = result['size']
+        else:
+            try:
+                record['size'] = os.stat (item['filepath']).st_size
+            except OSError:
+                pass
+
+        return (record)
+
+
+    def __run_items (self, items, cookiejar, nworker):
+
+#
+#    fetch the items on nworker threads, yield (item, result, error) as
+#    they complete; with claims, the items claimed by other processes
+#    are retried until they exist in outdir or their claim expires.
+#
+        def fetch (item):
+
+            item['start'] = time.monotonic()
+            try:
+                return (self.__fetch_item (item, cookiejar))
+            finally:
+                if (not self.__cancelled (item)):
+                    item['end'] = time.monotonic()
+
+        def hedge (item):
+
+            try:
+                return (self.__hedge_item (item, cookiejar))
+            finally:
+                if (not self.__cancelled (item)):
+                    item['end'] = time.monotonic()
+
+        hkwargs = dict()
+        if self.hedge:
+            hkwargs['hedge'] = hedge
+
+        engine = Downloader (fetch, nworker=nworker, \
+            concurrency=self.concurrency, debug=self.debug, **hkwargs)
+
+        while True:
+
+#
+#    closed explicitly, so a caller stopping early stops the workers now
+#    (see Downloader.run), not when the generator is collected
+#
+            busy = []
+            run = engine.run (items)
+            try:
+                for (item, result, error) in run:
+
+                    if ((error is None) and (result['status'] == 'claimed')):
+                        busy.append (item)
+                        continue
+
+                    yield (item, result, error)
+            finally:
+                run.close ()
+
+            with self.lock:
+                self.nhedged = self.nhedged + engine.nhedged
+                self.nhedge_won = self.nhedge_won + engine.nhedge_won
+
+            if (len(busy) == 0):
+                break
+
+            if self.debug:
+                logging.debug ('')
+                logging.debug (f'{len(busy):d} files claimed by ' + \
+                    'other processes: wait')
+
+            time.sleep (min (10., self.claims.ttl / 10.))
+            items = busy
+
+        return
+
+
+    def __fetch_item (self, item, cookiejar):
+
+#
+#    one planned file: claim it (claims), link it from the store (store)
+#    or download it
+#
+        if (item.get ('failed') is not None):
+
+            result = dict()
+            result['path'] = item['filepath']
+            result['status'] = 'skipped'
+            result['msg'] = item['failed']['msg']
+            return (result)
+
+        self.index.makedirs (item['relpath'])
+
+        if (self.claims is not None):
+
+            if (not self.claims.claim (item['relpath'])):
+
+                result = dict()
+                result['path'] = item['filepath']
+                result['status'] = 'claimed'
+                result['msg'] = ''
+                return (result)
+
+            try:
+#
+#    the outdir index is a snapshot: another process may have written
+#    the file since
+#
+                if (os.path.exists (item['filepath'])):
+
+                    self.index.add (item['relpath'])
+
+                    result = dict()
+                    result['path'] = item['filepath']
+                    result['status'] = 'exists'
+                    result['msg'] = ''
+                    return (result)
+
+                return (self.__fetch_stored (item, cookiejar))
+
+            finally:
+                self.claims.release (item['relpath'])
+
+        return (self.__fetch_stored (item, cookiejar))
+
+
+    def __hedge_item (self, item, cookiejar):
+
+#
+#    second copy of an item taking too long (see Downloader): the first
+#    copy holds the claim and the outdir directory exists, download to
+#    a separate part file; the copy completing second is cancelled
+#
+        result = self.__fetch_file (item['url'], item['filepath'], \
+            cookiejar, partpath=item['filepath'] + '.hedge.part', \
+            cancel=item.get ('cancel'))
+
+        self.index.add (item['relpath'])
+
+        if (self.store is not None):
+            self.__store_file (item, result)
+
+        return (result)
+
+
+    def __cancelled (self, item):
+
+        cancel = item.get ('cancel')
+        return ((cancel is not None) and cancel.is_set())
+
+
+    def __fetch_stored (self, item, cookiejar):
+
+        if (self.store is not None):
+
+            method = self.store.materialize (item['koaid'], item['filepath'])
+
+            if (method is not None):
+
+                self.index.add (item['relpath'])
+
+                with self.lock:
+                    self.nstored = self.nstored + 1
+
+                result = dict()
+                result['path'] = item['filepath']
+                result['status'] = 'ok'
+                result['msg'] = ''
+                result['store'] = method
+                return (result)
+
+#
+#    one fetch of a koaid at a time (for the same login): a download
+#    asking for a file already in flight in another download of the
+#    process waits for it, then links (or copies) it into place.
+#
+#    Only a definite refusal of the file (see FailureCache.kinds) is
+#    shared with the waiters: when the fetch they waited for failed
+#    otherwise (it was cancelled, its transfer failed), they fetch the
+#    file again, one of them leading the new fetch
+#
+        key = ('file', item['koaid'], self.identity)
+
+        while True:
+
+            own = []
+
+            def fetch ():
+                own.append (True)
+                return (self.__fetch_network (item, cookiejar))
+
+            try:
+                (result, leader) = flights.do (key, fetch, \
+                    cancel=item.get ('cancel'))
+
+            except KoaFileError as e:
+
+                if ((len(own) == 0) and (e.kind not in FailureCache.kinds) \
+                    and (not self.__cancelled (item))):
+                    continue
+
+                if (self.failures is not None):
+                    self.failures.add (item['koaid'], e.kind, str(e), \
+                        self.identity)
+                raise
+
+            except Exception:
+
+                if ((len(own) > 0) or self.__cancelled (item)):
+                    raise
+                continue
+
+            if (leader or (result['status'] == 'ok')):
+                break
+
+        if (not leader):
+            result = self.__coalesced_file (item, result)
+
+        self.index.add (item['relpath'])
+
+        if (self.store is not None):
+            self.__store_file (item, result)
+
+        return (result)
+
+
+    def __fetch_network (self, item, cookiejar):
+
+        relogin = (self.session is not None)
+
+        while True:
+
+            generation = 0
+            if (self.session is not None):
+                generation = self.session.generation
+
+            try:
+                return (self.__fetch_file (item['url'], item['filepath'], \
+                    cookiejar, cancel=item.get ('cancel')))
+
+            except KoaFileError as e:
+
+#
+#    refused for lack of a valid login: the session logs in again (once
+#    for all the files refused) and the file is requested again
+#
+                if (relogin and (e.kind == 'proprietary') and \
+                    self.session.relogin (generation)):
+                    relogin = False
+                    continue
+                raise
+
+
+    def __coalesced_file (self, item, result):
+
+#
+#    the file was fetched by an identical fetch in flight: link (or copy)
+#    the file it wrote into place
+#
+        if (os.path.abspath (result['path']) != \
+            os.path.abspath (item['filepath'])):
+
+            tmppath = item['filepath'] + '.coalesced'
+            if (os.path.exists (tmppath)):
+                os.remove (tmppath)
 
-        if self.debug:
-            logging.debug ('')
-            logging.debug ('returned os.makedirs') 
+            clone_file (result['path'], tmppath)
+            os.replace (tmppath, item['filepath'])
 
+        result = dict (result)
+        result['path'] = item['filepath']
+        result['coalesced'] = True
 
-        instrument = '' 
-        koaid = ''
-        filehand = ''
-        self.ndnloaded = 0
-        self.ndnloaded_calib = 0
-        self.ncaliblist = 0
-      
-        nfile = erow - srow + 1   
-        
-        print (f'Start downloading {nfile:d} FITS data you requested;')
-        print (f'please check your outdir: {self.outdir:s} for  progress.')
- 
-        for l in range (srow, erow+1):
-       
-            if self.debug:
-                logging.debug ('')
-                logging.debug (f'l= {l:d}')
-                logging.debug ('')
-                logging.debug ('self.astropytbl[l]= ')
-                logging.debug (self.astropytbl[l])
-                logging.debug ('instrument= ')
-                logging.debug (self.astropytbl[l][self.ind_instrume])
-
-            instrument = self.astropytbl[l][self.ind_instrume]
-            koaid = self.astropytbl[l][self.ind_koaid]
-            filehand = self.astropytbl[l][self.ind_filehand]
-	    
-            if self.debug:
-                logging.debug ('')
-                logging.debug ('type(instrument)= ')
-                logging.debug (type(instrument))
-                logging.debug (type(instrument) is bytes)
-            
-            if (type (instrument) is bytes):
-                
-                if self.debug:
-                    logging.debug ('')
-                    logging.debug ('bytes: decode')
+        with self.lock:
+            self.ncoalesced = self.ncoalesced + 1
 
-                instrument = instrument.decode("utf-8")
-                koaid = koaid.decode("utf-8")
-                filehand = filehand.decode("utf-8")
-           
-            ind = -1
-            ind = instrument.find ('HIRES')
-            if (ind >= 0):
-                instrument = 'HIRES'
+        return (result)
+
+
+    def __make_item (self, instrument, koaid, filehand, row, calib, group):
+
+        ind = -1
+        ind = instrument.find ('HIRES')
+        if (ind >= 0):
+            instrument = 'HIRES'
             
-            ind = -1
-            ind = instrument.find ('LRIS')
-            if (ind >= 0):
-                instrument = 'LRIS'
+        ind = -1
+        ind = instrument.find ('LRIS')
+        if (ind >= 0):
+            instrument = 'LRIS'
   
-            if self.debug:
-                logging.debug ('')
-                logging.debug (f'l= {l:d} koaid= {koaid:s}')
-                logging.debug (f'filehand= {filehand:s}')
-                logging.debug (f'instrument= {instrument:s}')
+        item = dict()
+        item['koaid'] = koaid
+        item['instrument'] = instrument
+        item['filehand'] = filehand
+        item['url'] = self.getkoa_url + 'filehand=' + filehand
+        item['row'] = row
+        item['calib'] = calib
+        item['group'] = group
+        item['size'] = -1
 
+        item['relpath'] = self.layout (item)
+        item['filepath'] = os.path.join (self.outdir, item['relpath'])
+        item['exists'] = self.index.exists (item['relpath'])
 
-#
-#    retrieve baseurl from conf class;
-#
-        self.baseurl = conf.server
+        if ((self.store is not None) and (not item['exists'])):
+            item['stored'] = (self.store.lookup (koaid) is not None)
 
-        if ('server' in kwargs):
-            self.baseurl = kwargs.get ('server')
+        if ((self.failures is not None) and (not item['exists'])):
+            item['failed'] = self.failures.lookup (koaid, self.identity)
 
         if self.debug:
             logging.debug ('')
-            logging.debug (f'baseurl= {self.baseurl:s}')
+            logging.debug (f'item: koaid= {koaid:s} calib= {calib:d}')
+            logging.debug (f'filepath= {item["filepath"]:s}')
+            logging.debug (f'exists= {str(item["exists"]):s}')
+
+        return (item)
+
+
+    def __plan_calibfiles (self, plan, cookiejar, nworker, dry_run):
 
 #
-#    urls for nph-getKoa, and nph-getCaliblist
+#    retrieve the calibration list of every science file (from outdir 
+#    when it was saved by a previous run) and add the calibration files
+#    to the plan; calibration files shared by several science files are
+#    planned once.
 #
-        self.getkoa_url = self.baseurl + '/getKOA/nph-getKOA?return_mode=json&'
-        self.caliblist_url = self.baseurl+ '/KoaAPI/nph-getCaliblist?'
-
         if self.debug:
             logging.debug ('')
-            logging.debug (f'self.getkoa_url= {self.getkoa_url:s}')
-            logging.debug (f'self.caliblist_url= {self.caliblist_url:s}')
-      
-#
-#   get lev0 files
-#
-            url = self.getkoa_url + 'filehand=' + filehand
-                
-            filepath = self.outdir + '/' + koaid
-                
-            if self.debug:
-                logging.debug ('')
-                logging.debug (f'filepath= {filepath:s}')
-                logging.debug (f'url= {url:s}')
+            logging.debug ('Enter __plan_calibfiles:')
 
-#
-#    if file doesn't exist: download
-#
-            isExist = os.path.exists (filepath)
-	    
-            if self.debug:
-                logging.debug ('')
-                logging.debug ('isExist:')
-                logging.debug (isExist)
+        science = [item for item in plan.items if (item['calib'] == 0)]
 
+        def get_caliblist (item):
+            return (self.__get_caliblist (item, cookiejar, dry_run))
 
-            if (not isExist):
+        lists = run_concurrent (get_caliblist, science, nworker)
 
-                try:
-                    self.__submit_request (url, filepath, cookiejar)
-                    self.ndnloaded = self.ndnloaded + 1
+        for (item, table) in zip (science, lists):
 
-                    self.msg =  'Returned file written to: ' + filepath   
-           
-                    if self.debug:
-                        logging.debug ('')
-                        logging.debug ('returned __submit_request')
-                        logging.debug (f'self.msg= {self.msg:s}')
-            
-                except Exception as e:
-                    print (f'File [{koaid:s}] download: {str(e):s}')
+            if isinstance (table, Exception):
 
+                msg = f'File [{item["koaid"]:s}] caliblist: {str(table):s}'
+                plan.errors.append (msg)
+                self.__print (msg)
+                continue
 
-#
-#    if calibfile == 1: download calibfile
-#
-            if (calibfile == 1):
+            for rec in table:
 
-                if self.debug:
-                    logging.debug ('')
-                    logging.debug ('calibfile=1: downloading calibfiles')
-	    
-                koaid_base = '' 
-                ind = -1
-                ind = koaid.rfind ('.')
-                if (ind > 0):
-                    koaid_base = koaid[0:ind]
-                else:
-                    koaid_base = koaid
+                plan.add (self.__make_item (rec['instrument'], \
+                    rec['koaid'], rec['filehand'], item['row'], 1, \
+                    item['koaid']))
 
-                if self.debug:
-                    logging.debug ('')
-                    logging.debug (f'koaid_base= {koaid_base:s}')
-	    
-                caliblist = self.outdir + '/' + koaid_base + '.caliblist.json'
-                
-                if self.debug:
-                    logging.debug ('')
-                    logging.debug (f'caliblist= {caliblist:s}')
+        if self.debug:
+            logging.debug ('')
+            logging.debug (f'{len(plan.items):d} items planned')
 
-                isExist = os.path.exists (caliblist)
-	    
-                if (not isExist):
+        return
 
-                    if self.debug:
-                        logging.debug ('')
-                        logging.debug ('downloading calibfiles')
-	    
-                    url = self.caliblist_url \
-                        + 'instrument=' + instrument \
-                        + '&koaid=' + koaid
 
-                    if self.debug:
-                        logging.debug ('')
-                        logging.debug (f'caliblist url= {url:s}')
+    def __get_caliblist (self, item, cookiejar, dry_run):
 
-                    try:
-                        self.__submit_request (url, caliblist, cookiejar)
-                        self.ncaliblist = self.ncaliblist + 1
+        koaid = item['koaid']
 
-                        self.msg =  'Returned file written to: ' + caliblist   
-           
-                        if self.debug:
-                            logging.debug ('')
-                            logging.debug ('returned __submit_request')
-                            logging.debug (f'self.msg= {self.msg:s}')
-            
-                    except Exception as e:
-                        print (f'File [{caliblist:s}] download: {str(e):s}')
+        koaid_base = '' 
+        ind = -1
+        ind = koaid.rfind ('.')
+        if (ind > 0):
+            koaid_base = koaid[0:ind]
+        else:
+            koaid_base = koaid
 
 #
-#    check again after caliblist is successfully downloaded, if caliblist 
-#    exists: download calibfiles
-#     
-                isExist = os.path.exists (caliblist)
-	  
-                                  
-                if (isExist):
+#    the calibration list is kept next to its science file
+#
+        relpath = os.path.join (os.path.dirname (item['relpath']), \
+            koaid_base + '.caliblist.json')
 
-                    if self.debug:
-                        logging.debug ('')
-                        logging.debug ('list exist: downloading calibfiles')
-	    
-                    try:
-                        ncalibs = self.__download_calibfiles ( \
-                            caliblist, cookiejar)
-                        self.ndnloaded_calib = self.ndnloaded_calib + ncalibs
+        caliblist = os.path.join (self.outdir, relpath)
                 
-                        if self.debug:
-                            logging.debug ('')
-                            logging.debug ('returned __download_calibfiles')
-                            logging.debug (f'{ncalibs:d} downloaded')
+        if self.debug:
+            logging.debug ('')
+            logging.debug (f'caliblist= {caliblist:s}')
 
-                    except Exception as e:
-                
-                        self.msg = 'Error downloading files in caliblist [' + \
-                            filepath + ']: ' +  str(e)
-                        
-                        if self.debug:
-                            logging.debug ('')
-                            logging.debug (f'errmsg= {self.msg:s}')
+        if (self.index.exists (relpath)):
 
-                
+            with open (caliblist) as fp:
+                jsondata = json.load (fp) 
+
+            return (jsondata['table'])
+
+        url = self.caliblist_url \
+            + 'instrument=' + item['instrument'] \
+            + '&koaid=' + koaid
 
         if self.debug:
             logging.debug ('')
-            logging.debug (f'{self.len_tbl:d} files in the table;')
-            logging.debug (f'{self.ndnloaded:d} files downloaded.')
-            logging.debug (f'{self.ncaliblist:d} calibration list downloaded.')
-            logging.debug (\
-                f'{self.ndnloaded_calib:d} calibration files downloaded.')
-
-        print (f'A total of new {self.ndnloaded:d} FITS files downloaded.')
-        print (f'{self.ncaliblist:d} new calibration list downloaded.')
-        print (f'{self.ndnloaded_calib:d} new calibration FITS files downloaded.')
+            logging.debug (f'caliblist url= {url:s}')
 
-        return
+        response = self.servers.request (self.retry, 'GET', url, \
+            cookies=cookiejar)
 
+        if (response.status_code != 200):
+            raise Exception ('Failed to submit the request')
 
+        jsondata = json.loads (response.text)
 
-    def __download_calibfiles (self, listpath, cookiejar):
+        if ('table' not in jsondata):
 
-        if self.debug:
-            logging.debug ('')
-            logging.debug (f'Enter __download_calibfiles: {listpath:s}')
+            msg = ''
+            if ('error' in jsondata):
+                msg = jsondata['error']
+            elif ('msg' in jsondata):
+                msg = jsondata['msg']
+            raise Exception (msg)
 
 #
-#    read input caliblist JSON file
+#    keep the list in outdir (written atomically) for the next runs
 #
-        nrec = 0
-        data = ''
-        try:
-            with open (listpath) as fp:
-	    
-                jsonData = json.load (fp) 
-                data = jsonData["table"]
+        if (not dry_run):
 
-            fp.close() 
+            self.index.makedirs (relpath)
 
-        except Exception as e:
-        
-            if self.debug:
-                logging.debug ('')
-                logging.debug (f'caliblist: {caliblist:s} load error')
+            with open (caliblist + '.part', 'w') as fp:
+                fp.write (response.text)
 
-            self.errmsg = 'Failed to read ' + listpath	
-	
-            fp.close() 
-            
-            raise Exception (self.errmsg)
+            os.replace (caliblist + '.part', caliblist)
+            self.index.add (relpath)
 
-            return
+            with self.lock:
+                self.ncaliblist = self.ncaliblist + 1
+
+        return (jsondata['table'])
+
+
+    def __plan_sizes (self, plan, cookiejar, nworker):
+
+#
+#    size the files to fetch with concurrent HEAD requests; a file the
+#    server doesn't size (no Content-Length, JSON error) keeps size -1
+#
+        items = [item for item in plan.items \
+            if ((not item['exists']) and (not item['stored']) and \
+                (item['failed'] is None))]
 
-        nrec = len(data)
-    
         if self.debug:
             logging.debug ('')
-            logging.debug (f'downloadCalibfiles: nrec= {nrec:d}')
+            logging.debug (f'Enter __plan_sizes: {len(items):d} items')
 
-        if (nrec == 0):
+        def head (item):
 
-            self.status = 'error'	
-            self.errmsg = 'No data found in the caliblist: ' + listpath
-	    
-            raise Exception (self.errmsg)
+            with host_slot (item['url']):
+                response = self.servers.request (self.retry, 'HEAD', \
+                    item['url'], cookies=cookiejar, allow_redirects=True)
 
+            content_type = response.headers.get ('Content-type', '')
 
-#
-#    retrieve koaid from caliblist json structure and download files
-#
-        ndnloaded = 0
-        for ind in range (0, nrec):
+            if ((response.status_code != 200) or \
+                (content_type == 'application/json')):
+                return (-1)
 
-            if self.debug:
-                logging.debug (f'downloadCalibfiles: ind= {ind:d}')
+            return (int (response.headers.get ('Content-Length', -1)))
 
-            koaid = data[ind]['koaid']
-            instrument = data[ind]['instrument']
-            filehand = data[ind]['filehand']
-            
-            if self.debug:
-                logging.debug (f'instrument= {instrument:s}')
-                logging.debug (f'koaid= {koaid:s}')
-                logging.debug (f'filehand= {filehand:s}')
+        sizes = run_concurrent (head, items, nworker)
 
-#
-#   get lev0 files
-#
-            url = self.getkoa_url + 'filehand=' + filehand
-                
-            filepath = self.outdir + '/' + koaid
-                
-            if self.debug:
-                logging.debug ('')
-                logging.debug (f'filepath= {filepath:s}')
-                logging.debug (f'url= {url:s}')
+        for (item, size) in zip (items, sizes):
+
+            if isinstance (size, Exception):
 
-#
-#    if file exists, skip
-#
-            isExist = os.path.exists (filepath)
-	    
-            if (isExist):
                 if self.debug:
                     logging.debug ('')
-                    logging.debug (f'isExist: {isExist:d}: skip')
-                     
+                    logging.debug (f'HEAD {item["koaid"]:s}: {str(size):s}')
                 continue
 
-            try:
-                self.__submit_request (url, filepath, cookiejar)
-                ndnloaded = ndnloaded + 1
-                
-                self.msg = 'calib file [' + filepath + '] downloaded.'
+            item['size'] = size
 
-                if self.debug:
-                    logging.debug ('')
-                    logging.debug ('returned __submit_request')
-                    logging.debug (f'self.msg: {self.msg:s}')
-            
-            except Exception as e:
-                
-                print (f'calib file download error: {str(e):s}')
+        return
 
-        if self.debug:
-            logging.debug ('')
-            logging.debug (f'{self.ndnloaded:d} files downloaded.')
 
-        return (ndnloaded)
+    def __store_file (self, item, result):
+
+#
+#    add a downloaded, verified file to the store; a store failure (full
+#    or read-only store) doesn't fail the download
+#
+        try:
+            self.store.put (item['koaid'], item['filepath'], \
+                result['checksum'], result['size'], \
+                algorithm=result['algorithm'])
+
+        except Exception as e:
+            if self.debug:
+                logging.debug ('')
+                logging.debug (f'store {item["koaid"]:s}: {str(e):s}')
+        return
+
+
+    def __submit_request(self, url, filepath, cookiejar, **kwargs):
+
+#
+#    kwargs: offset/headers resume a transfer kept by a previous attempt
+#    (Range request), partpath and cancel are passed to stream_to_file
+#
+        offset = 0
+        if ('offset' in kwargs):
+            offset = kwargs.get('offset')
 
+        headers = None
+        if ('headers' in kwargs):
+            headers = kwargs.get('headers')
 
-    def __submit_request(self, url, filepath, cookiejar):
+        partpath = filepath + '.part'
+        if ('partpath' in kwargs):
+            partpath = kwargs.get('partpath')
+
+        cancel = None
+        if ('cancel' in kwargs):
+            cancel = kwargs.get('cancel')
 
         if self.debug:
             logging.debug ('')
-            logging.debug ('Enter database.__submit_request:')
+            logging.debug ('Enter __submit_request:')
             logging.debug (f'url= {url:s}')
             logging.debug (f'filepath= {filepath:s}')
+            logging.debug (f'offset= {offset:d}')
        
             if not (cookiejar is None):  
             
@@ -1678,10 +2907,38 @@ class Archive:
                         logging.debug (f'cookie.name= {cookie.name:s}')
                         logging.debug (f'cookie.value= {cookie.value:s}')
                         logging.debug (f'cookie.domain= {cookie.domain:s}')
-            
+       
+#
+#    called from several download workers at once: keep the request 
+#    state local
+#
+        status = ''
+        msg = ''
+
+#
+#    resume with a Range request; If-Range makes the server send the
+#    whole file again if it changed in the meantime
+#
+        range_headers = dict()
+        if (offset > 0):
+            range_headers['Range'] = f'bytes={offset:d}-'
+
+            validator = headers.get ('ETag', headers.get ('Last-Modified'))
+            if (validator is not None):
+                range_headers['If-Range'] = validator
+
+#
+#    read timeout: a socket silent for conf.stall_time is a stalled
+#    transfer (resumed by __fetch_file)
+#
+        timeout = None
+        if (conf.stall_time > 0):
+            timeout = (float (conf.timeout), float (conf.stall_time))
+
         try:
-            self.response =  requests.get (url, cookies=cookiejar, \
-                stream=True)
+            response = self.servers.request (self.retry, 'GET', url, \
+                cookies=cookiejar, headers=range_headers, timeout=timeout, \
+                stream=True, spread=conf.spread_servers)
 
             if self.debug:
                 logging.debug ('')
@@ -1693,38 +2950,74 @@ class Archive:
                 logging.debug ('')
                 logging.debug (f'exception: {str(e):s}')
 
-            self.status = 'error'
-            self.msg = 'Failed to submit the request: ' + str(e)
+            status = 'error'
+            msg = 'Failed to submit the request: ' + str(e)
 	    
-            raise Exception (self.msg)
+            raise Exception (msg)
             return
                        
         if self.debug:
             logging.debug ('')
             logging.debug ('status_code:')
-            logging.debug (self.response.status_code)
+            logging.debug (response.status_code)
       
       
-        if (self.response.status_code == 200):
-            self.status = 'ok'
-            self.msg = ''
+        if ((offset > 0) and (response.status_code == 206)):
+            status = 'ok'
+            msg = ''
+
+        elif ((offset > 0) and (response.status_code == 416)):
+            response.close ()
+
+            result = dict()
+            result['path'] = filepath
+            result['status'] = 'error'
+            result['msg'] = 'Transfer failed: range not satisfiable'
+            return (result)
+
+        elif (response.status_code == 200):
+            status = 'ok'
+            msg = ''
+
+#
+#    no Range support (or the file changed): start from the beginning
+#
+            offset = 0
+            headers = None
         else:
-            self.status = 'error'
-            self.msg = 'Failed to submit the request'
+            status = 'error'
+            msg = 'Failed to submit the request'
+
+#
+#    the connection goes back to the pool only once the response is
+#    closed
+#
+            response.close ()
+
+#
+#    4xx: the server refuses the file (see FailureCache)
+#
+            if ((response.status_code >= 400) and \
+                (response.status_code < 500) and \
+                (response.status_code != 429)):
+                
+                msg = msg + f': status {response.status_code:d}'
+                raise KoaFileError (msg, \
+                    classify (msg, response.status_code))
 	    
-            raise Exception (self.msg)
+            raise Exception (msg)
             return
                        
             
         if self.debug:
             logging.debug ('')
             logging.debug ('headers: ')
-            logging.debug (self.response.headers)
+            logging.debug (response.headers)
       
       
-        self.content_type = ''
+        content_type = ''
         try:
-            self.content_type = self.response.headers['Content-type']
+            content_type = response.headers['Content-type']
         except Exception as e:
 
             if self.debug:
@@ -1733,17 +3026,27 @@ class Archive:
 
         if self.debug:
             logging.debug ('')
-            logging.debug (f'content_type= {self.content_type:s}')
+            logging.debug (f'content_type= {content_type:s}')
 
 
-        if (self.content_type == 'application/json'):
+        if (content_type == 'application/json'):
             
             if self.debug:
                 logging.debug ('')
                 logging.debug (\
                     'return is a json structure: might be error message')
             
-            jsondata = json.loads (self.response.text)
+#
+#    a JSON body is never the file: it is read and the response closed
+#
+            try:
+                jsondata = json.loads (response.text)
+
+            except Exception as e:
+                raise Exception ('Failed to read the server response: ' + \
+                    str(e))
+            finally:
+                response.close ()
           
             if self.debug:
                 logging.debug ('')
@@ -1751,13 +3054,13 @@ class Archive:
                 logging.debug (jsondata)
 
  
-            self.status = ''
+            status = ''
             try: 
-                self.status = jsondata['status']
+                status = jsondata['status']
                 
                 if self.debug:
                     logging.debug ('')
-                    logging.debug (f'self.status= {self.status:s}')
+                    logging.debug (f'status= {status:s}')
 
             except Exception as e:
 
@@ -1765,13 +3068,13 @@ class Archive:
                     logging.debug ('')
                     logging.debug (f'get status exception: e= {str(e):s}')
 
-            self.msg = '' 
+            msg = '' 
             try: 
-                self.msg = jsondata['msg']
+                msg = jsondata['msg']
                 
                 if self.debug:
                     logging.debug ('')
-                    logging.debug (f'self.msg= {self.msg:s}')
+                    logging.debug (f'msg= {msg:s}')
 
             except Exception as e:
 
@@ -1787,61 +3090,145 @@ class Archive:
                     logging.debug ('')
                     logging.debug (f'errmsg= {errmsg:s}')
 
-                if (len(errmsg) > 0):
-                    self.status = 'error'
-                    self.msg = errmsg
+                if (len(errmsg) > 0):
+                    status = 'error'
+                    msg = errmsg
+
+            except Exception as e:
+
+                if self.debug:
+                    logging.debug ('')
+                    logging.debug (f'get error exception: e= {str(e):s}')
+
+
+            if self.debug:
+                logging.debug ('')
+                logging.debug (f'status= {status:s}')
+                logging.debug (f'msg= {msg:s}')
+
+
+            if (status == 'error'):
+                raise KoaFileError (msg, classify (msg))
+                return
+
+            raise Exception (f'Unexpected server response: {str(jsondata):s}')
+            return
+
+#
+#    save to filepath: the data is verified while it is streamed
+#    (see transfer.stream_to_file)
+#
+        if self.debug:
+            logging.debug ('')
+            logging.debug ('save_to_file:')
+       
+        result = stream_to_file (response, filepath, \
+            throttle=self.throttle, partpath=partpath, offset=offset, \
+            headers=headers, keep_part=True, cancel=cancel, \
+            debug=self.debug)
+
+        status = result['status']
+        msg = result['msg']
+
+        if (status == 'ok'):
+            msg =  'Returned file written to: ' + filepath   
+            
+        if self.debug:
+            logging.debug ('')
+            logging.debug (msg)
+	
+        return (result)
+                       
+
+    def __fetch_file (self, url, filepath, cookiejar, **kwargs):
+
+#
+#    download and verify; a file failing verification is re-fetched up
+#    to conf.refetch times before it is reported as an error.  A transfer
+#    interrupted (stalled, timed out, connection lost) after receiving
+#    data is resumed where it stopped, up to conf.resumes times.
+#
+#    kwargs: partpath, cancel (hedged requests, see __hedge_item)
+#
+        partpath = filepath + '.part'
+        if ('partpath' in kwargs):
+            partpath = kwargs.get('partpath')
+
+        cancel = None
+        if ('cancel' in kwargs):
+            cancel = kwargs.get('cancel')
 
-            except Exception as e:
+        nfetch = 0
+        nresume = 0
+        offset = 0
+        headers = None
+        while True:
 
-                if self.debug:
-                    logging.debug ('')
-                    logging.debug (f'get error exception: e= {str(e):s}')
+            if (self.throttle is not None):
+                self.throttle.wait_window (cancel)
+
+            try:
+                with host_slot (url):
+                    result = self.__submit_request (url, filepath, \
+                        cookiejar, offset=offset, headers=headers, \
+                        partpath=partpath, cancel=cancel)
 
+            except Exception:
+                if (os.path.exists (partpath)):
+                    os.remove (partpath)
+                raise
+
+            if (result['status'] == 'ok'):
+                break
+
+            if ((cancel is not None) and cancel.is_set()):
+                raise Exception (result['msg'])
 
             if self.debug:
                 logging.debug ('')
-                logging.debug (f'self.status= {self.status:s}')
-                logging.debug (f'self.msg= {self.msg:s}')
+                logging.debug (f'fetch {nfetch:d}: {result["msg"]:s}')
 
+            partial = result.get ('partial', 0)
+            if ((partial > offset) and (nresume < conf.resumes)):
 
-            if (self.status == 'error'):
-                raise Exception (self.msg)
-                return
+                if self.debug:
+                    logging.debug ('')
+                    logging.debug (f'resume at {partial:d} bytes')
 
-#
-#    save to filepath
-#
-        if self.debug:
-            logging.debug ('')
-            logging.debug ('save_to_file:')
-       
-        try:
-            with open (filepath, 'wb') as fd:
+                offset = partial
+                headers = result['headers']
+                nresume = nresume + 1
 
-                for chunk in self.response.iter_content (chunk_size=1024):
-                    fd.write (chunk)
-            
-            self.msg =  'Returned file written to: ' + filepath   
-#            print (self.msg)
-            
-            if self.debug:
-                logging.debug ('')
-                logging.debug (self.msg)
-	
-        except Exception as e:
+                with self.lock:
+                    self.nresumed = self.nresumed + 1
+                continue
 
-            if self.debug:
-                logging.debug ('')
-                logging.debug (f'exception: {str(e):s}')
+            offset = 0
+            headers = None
 
-            self.status = 'error'
-            self.msg = 'Failed to save returned data to file: %s' % filepath
+            if (nfetch >= conf.refetch):
+                break
+
+            self.retry.sleep (nfetch)
+            nfetch = nfetch + 1
             
-            raise Exception (self.msg)
-            return
+            with self.lock:
+                self.nrefetched = self.nrefetched + 1
+
+        if ((result['status'] != 'ok') and os.path.exists (partpath)):
+            os.remove (partpath)
+
+        with self.lock:
+            if (result['status'] == 'ok'):
+                self.nverified = self.nverified + 1
+            else:
+                self.verify_failed.append ((filepath, result['msg']))
+
+        if (result['status'] != 'ok'):
+            raise Exception (result['msg'])
+
+        return (result)
 
-        return
-                       
 
     def __make_query (self, url):
        
@@ -1852,7 +3239,8 @@ class Archive:
 
         response = None
         try:
-            response = requests.get (url, stream=True)
+            response = self.servers.request (self.retry, 'GET', url, \
+                stream=True)
 
             if self.debug:
                 logging.debug ('')
@@ -1949,8 +3337,42 @@ class KoaTap:
         cookiefile -- a full path cookie file containing user info; 
 	              default is no cookiefile
 	debug      -- default is no debug written
+        servers    -- a ServerPool: the query is submitted to its best
+                      server, failing over to the next one; default is
+                      url's server only
+
+    send_async also accepts:
+
+        timeout    -- time limit (seconds) of the job, default
+                      conf.query_timeout (0: no limit);
+        deadline   -- the same as an absolute time (time.time());
+        cancel     -- a threading.Event: once set, the job is aborted
+                      and CancelledError is raised;
+        relogin    -- when the server refuses the query for lack of a
+                      valid login, log in again (see KoaSession) and
+                      resubmit the query once; default is True;
+        on_job     -- called with the KoaJob as soon as it is created;
+
+    get_data accepts timeout, deadline and cancel as well: they limit its
+    wait for the job to complete.
+
+    a job still running past its time limit is aborted and deleted on
+    the server (UWS PHASE=ABORT, DELETE) and KoaTimeoutError is raised.
+
+    A query that fails (submission, job in ERROR or ABORTED phase, 
+    result retrieval) is not raised: send_async returns the message, 
+    starting with 'Error:'.  It only raises when the caller's own limits
+    stop the query (CancelledError, KoaTimeoutError).
+
+    send_async, send_sync and save_data run on a per-call copy of the
+    service (see calls.percall): one KoaTap can submit concurrent queries.
     """
 
+#
+#    containers the calls modify, copied for each call
+#
+    percall_copy = ('datadict',)
+
     def __init__ (self, url, **kwargs):
 
         self.url = url 
@@ -1986,6 +3408,12 @@ class KoaTap:
             logging.debug ('')
             logging.debug ('')
             logging.debug ('Enter koatap.init (debug on)')
+
+        self.retry = RetryPolicy (debug=self.debug)
+
+        self.servers = None
+        if ('servers' in kwargs):
+            self.servers = kwargs.get('servers')
                                 
         if ('cookiefile' in kwargs):
             self.cookiepath = kwargs.get('cookiefile')
@@ -2036,21 +3464,23 @@ class KoaTap:
                 logging.debug (f'key= {key:s} val= {self.datadict[key]:s}')
     
         
-        self.cookiejar = http.cookiejar.MozillaCookieJar (self.cookiepath)
-         
-        if self.debug:
-            logging.debug ('')
-            logging.debug ('cookiejar')
-            logging.debug (self.cookiejar)
-   
+#
+#    the cookies of the cookie file's session, shared with the other
+#    queries and downloads (see KoaSession)
+#
+        self.session = None
+        self.cookiejar = None
+
         if (len(self.cookiepath) > 0):
         
+            self.session = get_session (self.cookiepath, debug=self.debug)
+
             try:
-                self.cookiejar.load (ignore_discard=True, ignore_expires=True);
+                self.cookiejar = self.session.cookies ()
             
                 if self.debug:
                     logging.debug (
-                        'cookie loaded from %s' % self.cookiepath)
+                        'cookies of %s' % self.cookiepath)
         
                     for cookie in self.cookiejar:
                         logging.debug ('cookie:')
@@ -2069,6 +3499,19 @@ class KoaTap:
         return 
        
 
+    def __post (self, url, **kwargs):
+
+#
+#    submit to the TAP service; with a ServerPool the request fails over
+#    to the next server (the job then lives on the server that took it)
+#
+        if (self.servers is None):
+            return (self.retry.request ('POST', url, **kwargs))
+
+        return (self.servers.request (self.retry, 'POST', url, **kwargs))
+
+
+    @percall
     def send_async (self, query, **kwargs):
 
         if self.debug:
@@ -2113,16 +3556,46 @@ class KoaTap:
         self.oupath = ''
         if ('outpath' in kwargs):
             self.outpath = kwargs.get('outpath')
+
+#
+#    stream: the result is not saved, the caller reads it from
+#    self.response_result (a streamed response)
+#
+        self.stream = False
+        if ('stream' in kwargs):
+            self.stream = kwargs.get('stream')
+
+        deadline = self.__deadline (kwargs)
+
+        cancel = None
+        if ('cancel' in kwargs):
+            cancel = kwargs.get('cancel')
+
+        on_job = None
+        if ('on_job' in kwargs):
+            on_job = kwargs.get('on_job')
+
+        if self.debug:
+            logging.debug ('')
+            logging.debug (f'deadline= {str(deadline):s}')
   
+        if ((cancel is not None) and cancel.is_set()):
+            raise concurrent.futures.CancelledError ('query cancelled')
+
+        generation = 0
+        if (self.session is not None):
+            generation = self.session.generation
+
         try:
 
             if (len(self.cookiepath) > 0):
         
-                self.response = requests.post (url, data= self.datadict, \
-	            cookies=self.cookiejar, allow_redirects=False)
+                self.response = self.__post (url, \
+                    data= self.datadict, cookies=self.cookiejar, \
+                    allow_redirects=False)
             else: 
-                self.response = requests.post (url, data= self.datadict, \
-	            allow_redirects=False)
+                self.response = self.__post (url, \
+                    data= self.datadict, allow_redirects=False)
 
             if self.debug:
                 logging.debug ('')
@@ -2217,6 +3690,12 @@ class KoaTap:
                     logging.debug (f'msg= {self.msg:s}')
 
                 if (self.status == 'error'):
+
+                    if self.__renew (data['msg'], generation, kwargs):
+
+                        kwargs['relogin'] = False
+                        return (self.send_async (query, **kwargs))
+
                     self.msg = 'Error: ' + data['msg']
                     return (self.msg)
 
@@ -2241,15 +3720,18 @@ class KoaTap:
         try:
             if (self.debug):
                 self.koajob = KoaJob (\
-                    self.statusurl, debug=1)
+                    self.statusurl, cookies=self.cookiejar, debug=1)
             else:
                 self.koajob = KoaJob (\
-                    self.statusurl)
+                    self.statusurl, cookies=self.cookiejar)
         
             if self.debug:
                 logging.debug ('')
                 logging.debug (f'koajob instantiated')
                 logging.debug (f'phase= {self.koajob.phase:s}')
+
+            if (on_job is not None):
+                on_job (self.koajob)
        
        
         except Exception as e:
@@ -2274,17 +3756,7 @@ class KoaTap:
             logging.debug (f'phase: {phase:s}')
             
         if ((phase.lower() != 'completed') and (phase.lower() != 'error')):
-            
-            while ((phase.lower() != 'completed') and \
-                (phase.lower() != 'error')):
-                
-                time.sleep (2)
-                phase = self.koajob.get_phase()
-        
-                if self.debug:
-                    logging.debug ('')
-                    logging.debug ('here0-1')
-                    logging.debug (f'phase= {phase:s}')
+            phase = self.__wait_job (deadline, cancel)
             
         if self.debug:
             logging.debug ('')
@@ -2305,6 +3777,12 @@ class KoaTap:
             
             return (self.msg)
 
+        if (phase.lower() == 'aborted'):
+	   
+            self.status = 'error'
+            self.msg = 'Error: the query job was aborted.'
+            return (self.msg)
+
         if self.debug:
             logging.debug ('')
             logging.debug ('here2: phase is completed')
@@ -2321,7 +3799,8 @@ class KoaTap:
 #   send resulturl to retrieve result table
 #
         try:
-            self.response_result = requests.get (self.resulturl, stream=True)
+            self.response_result = self.retry.request ('GET', \
+                self.resulturl, cookies=self.cookiejar, stream=True)
         
             if self.debug:
                 logging.debug ('')
@@ -2336,9 +3815,23 @@ class KoaTap:
                 logging.debug ('')
                 logging.debug (f'exception: e= {str(e):s}')
             
-            raise Exception (self.msg)    
+            return (self.msg)    
      
        
+        if self.stream:
+
+            if (self.response_result.status_code != 200):
+
+                self.status = 'error'
+                self.msg = 'Error: failed to retrieve the result: ' + \
+                    f'status {self.response_result.status_code:d}'
+                self.response_result.close ()
+                return (self.msg)
+
+            self.status = 'ok'
+            self.msg = 'Result ready to stream.'
+            return (self.msg)
+
 #
 # save table to file
 #
@@ -2410,6 +3903,140 @@ class KoaTap:
         """
 
 
+    def __renew (self, msg, generation, kwargs):
+
+#
+#    the server refused the query for lack of a valid login: True if the
+#    session logged in again, the query is then resubmitted (once)
+#
+        relogin = True
+        if ('relogin' in kwargs):
+            relogin = kwargs.get('relogin')
+
+        if ((not relogin) or (self.session is None)):
+            return (False)
+
+        if (classify (msg) != 'proprietary'):
+            return (False)
+
+        return (self.session.relogin (generation))
+
+
+    def __deadline (self, kwargs):
+
+#
+#    the absolute time limit of the job: the earliest of the deadline and
+#    timeout keywords (timeout defaults to conf.query_timeout), None for
+#    no limit
+#
+        deadline = None
+        if ('deadline' in kwargs):
+            deadline = kwargs.get('deadline')
+
+        timeout = conf.query_timeout
+        if ('timeout' in kwargs):
+            timeout = kwargs.get('timeout')
+
+        if ((timeout is not None) and (timeout > 0)):
+            if ((deadline is None) or (time.time() + timeout < deadline)):
+                deadline = time.time() + timeout
+
+        return (deadline)
+
+
+    def __wait_job (self, deadline, cancel):
+
+#
+#    poll the job until it is COMPLETED, ERROR or ABORTED and return the
+#    phase; each status request is limited to the time left.  Past the
+#    deadline the job is aborted (KoaTimeoutError), on cancel too
+#    (CancelledError)
+#
+        phase = self.koajob.phase
+
+        try:
+            while ((phase.lower() != 'completed') and \
+                (phase.lower() != 'error') and \
+                (phase.lower() != 'aborted')):
+                
+                wait = 2.
+                if (deadline is not None):
+
+                    if (time.time() >= deadline):
+                        self.__abort_job (deadline)
+
+                    wait = max (0., min (wait, deadline - time.time()))
+
+                if (cancel is None):
+                    time.sleep (wait)
+
+                elif cancel.wait (wait):
+                    self.__cancel_job ()
+
+                try:
+                    phase = self.koajob.get_phase (deadline=deadline)
+
+                except Exception:
+                    if ((deadline is not None) and (time.time() >= deadline)):
+                        self.__abort_job (deadline)
+                    raise
+        
+                if self.debug:
+                    logging.debug ('')
+                    logging.debug (f'phase= {phase:s}')
+
+#
+#    interrupted by the user: don't leave the job running on the server
+#
+        except KeyboardInterrupt:
+            self.koajob.abort ()
+            raise
+
+        return (phase)
+
+
+    def __cancel_job (self):
+
+#
+#    the query was cancelled: abort its job on the server and raise
+#
+        self.koajob.abort ()
+
+        self.status = 'error'
+        self.msg = 'Error: the query was cancelled; the job was aborted.'
+
+        if self.debug:
+            logging.debug ('')
+            logging.debug (f'{self.msg:s}')
+
+        raise concurrent.futures.CancelledError (self.msg)
+
+
+    def __abort_job (self, deadline):
+
+#
+#    the job ran past its deadline: abort it on the server and raise
+#
+        self.koajob.abort (deadline=time.time() + KoaJob.abort_time)
+
+        jobid = self.koajob.statusurl
+        try:
+            jobid = self.koajob.get_jobid ()
+        except Exception:
+            pass
+
+        self.status = 'error'
+        self.msg = 'Error: query job ' + jobid + \
+            ' did not complete within its time limit; the job was aborted.'
+
+        if self.debug:
+            logging.debug ('')
+            logging.debug (f'{self.msg:s}')
+
+        raise KoaTimeoutError (self.msg)
+
+
+    @percall
     def send_sync (self, query, **kwargs):
        
         if self.debug:
@@ -2462,11 +4089,12 @@ class KoaTap:
         try:
             if (len(self.cookiepath) > 0):
         
-                self.response = requests.post (url, data= self.datadict, \
-                    cookies=self.cookiejar, allow_redirects=False, stream=True)
+                self.response = self.__post (url, \
+                    data= self.datadict, cookies=self.cookiejar, \
+                    allow_redirects=False, stream=True)
             else: 
-                self.response = requesrs.post (url, data= self.datadict, \
-                    allow_redicts=False, stream=True)
+                self.response = self.__post (url, \
+                    data= self.datadict, allow_redirects=False, stream=True)
 
             if self.debug:
                 logging.debug ('')
@@ -2550,6 +4178,7 @@ class KoaTap:
 #
 # save data to astropy table
 #
+    @percall
     def save_data (self, outpath):
 
         if self.debug:
@@ -2564,6 +4193,7 @@ class KoaTap:
             fpath = outpath
         else:
             fd, fpath = tempfile.mkstemp(suffix='.xml', dir='./')
+            os.close (fd)
             tmpfile_created = 1 
             
             if self.debug:
@@ -2574,18 +4204,18 @@ class KoaTap:
             logging.debug ('')
             logging.debug (f'fpath= {fpath:s}')
      
-        fp = open (fpath, "wb")
-            
-        for data in self.response_result.iter_content(4096):
-                
-            len_data = len(data)            
-        
-            if (len_data < 1):
-                break
+        result = stream_to_file (self.response_result, fpath, \
+            debug=self.debug)
 
-            fp.write (data)
-        
-        fp.close()
+        if (result['status'] != 'ok'):
+
+            self.status = 'error'
+            self.msg = 'Error: ' + result['msg']
+
+            if (tmpfile_created == 1):
+                os.remove (fpath)
+
+            return (self.msg)
 
         if self.debug:
             logging.debug ('')
@@ -2657,7 +4287,7 @@ class KoaTap:
 #
 #    outpath is given: loop until job is complete and download the data
 #
-    def get_data (self, resultpath):
+    def get_data (self, resultpath, **kwargs):
 
         if self.debug:
             logging.debug ('')
@@ -2665,6 +4295,12 @@ class KoaTap:
             logging.debug (f'async_job = {self.async_job:d}')
             logging.debug (f'resultpath = {resultpath:s}')
 
+        deadline = self.__deadline (kwargs)
+
+        cancel = None
+        if ('cancel' in kwargs):
+            cancel = kwargs.get('cancel')
+
 
 
         if (self.async_job == 0):
@@ -2680,21 +4316,11 @@ class KoaTap:
             self.msg = 'Result written to file: [' + resultpath + ']'
         
         else:
-            phase = self.koajob.get_phase()
+            phase = self.__wait_job (deadline, cancel)
         
             if self.debug:
                 logging.debug ('')
-                logging.debug (f'returned koajob.get_phase: phase= {phase:s}')
-
-            while ((phase.lower() != 'completed') and \
-	        (phase.lower() != 'error')):
-                time.sleep (2)
-                phase = self.koajob.get_phase()
-        
-                if self.debug:
-                    logging.debug ('')
-                    logging.debug (\
-                        f'returned koajob.get_phase: phase= {phase:s}')
+                logging.debug (f'returned __wait_job: phase= {phase:s}')
 
 #
 #    phase == 'error'
@@ -2710,6 +4336,12 @@ class KoaTap:
             
                 return (self.msg)
 
+            if (phase.lower() == 'aborted'):
+	   
+                self.status = 'error'
+                self.msg = 'Error: the query job was aborted.'
+                return (self.msg)
+
 #
 #   job completed write table to disk file
 #
@@ -3612,8 +5244,19 @@ class KoaJob:
     """
     KoaJob class is used internally by KoaTap class to store the job 
     parameters and returned urls for job status and result files.  
+
+    The job's requests send the cookies of the optional 'cookies' 
+    keyword (the KoaTap session's cookie jar).
+
+    get_phase and abort accept a deadline (time.time()): their requests
+    are limited to the time left and not retried past it.
     """
 
+#
+#    time given to abort a job whose deadline has passed
+#
+    abort_time = 5.
+
     def __init__ (self, statusurl, **kwargs):
 
         self.debug = 0 
@@ -3645,9 +5288,15 @@ class KoaJob:
            
             self.debug = kwargs.get('debug')
            
+        self.cookiejar = None
+        if ('cookies' in kwargs):
+            self.cookiejar = kwargs.get('cookies')
+
         if self.debug:
             logging.debug ('')
             logging.debug ('Enter koajob (debug on)')
+
+        self.retry = RetryPolicy (debug=self.debug)
                                 
         try:
             self.__get_statusjob()
@@ -3787,7 +5436,8 @@ class KoaJob:
 #   send resulturl to retrieve result table
 #
         try:
-            response = requests.get (self.resulturl, stream=True)
+            response = self.retry.request ('GET', self.resulturl, \
+                cookies=self.cookiejar, stream=True)
         
             if self.debug:
                 logging.debug ('')
@@ -3807,21 +5457,13 @@ class KoaJob:
 #
 # retrieve table from response
 #
-        with open (outpath, "wb") as fp:
-            
-            for data in response.iter_content(4096):
-                
-                len_data = len(data)            
-            
-#                if debug:
-#                    logging.debug ('')
-#                    logging.debug (f'len_data= {len_data:d}')
- 
-                if (len_data < 1):
-                    break
+        result = stream_to_file (response, outpath, debug=self.debug)
 
-                fp.write (data)
-        fp.close()
+        if (result['status'] != 'ok'):
+
+            self.status = 'error'
+            self.msg = 'Error: ' + result['msg']
+            raise Exception (self.msg)    
         
         self.resultpath = outpath
         self.status = 'ok'
@@ -3834,6 +5476,40 @@ class KoaJob:
         return        
 
     
+    def abort (self, deadline=None):
+
+        """
+        Abort the job (UWS PHASE=ABORT) and delete it from the server so
+        it no longer holds server resources.  Errors are ignored: the
+        server destroys the job at its destruction time anyway.
+        """
+
+        if self.debug:
+            logging.debug ('')
+            logging.debug ('Enter abort')
+            logging.debug (f'statusurl= {self.statusurl:s}')
+
+        try:
+            response = self.retry.request ('POST', self.statusurl + '/phase', \
+                data={'PHASE': 'ABORT'}, cookies=self.cookiejar, \
+                allow_redirects=False, deadline=deadline)
+            response.close ()
+
+            response = self.retry.request ('DELETE', self.statusurl, \
+                cookies=self.cookiejar, allow_redirects=False, \
+                deadline=deadline)
+            response.close ()
+
+        except Exception as e:
+           
+            if self.debug:
+                logging.debug ('')
+                logging.debug (f'exception: e= {str(e):s}')
+
+        self.phase = 'ABORTED'
+        return
+
+
     def get_parameters (self):
 
         if self.debug:
@@ -3845,7 +5521,7 @@ class KoaJob:
         return (self.parameters)
     
 
-    def get_phase (self):
+    def get_phase (self, deadline=None):
 
         if self.debug:
             logging.debug ('')
@@ -3856,7 +5532,7 @@ class KoaJob:
 	    (self.phase.lower() != 'error')):
 
             try:
-                self.__get_statusjob ()
+                self.__get_statusjob (deadline)
 
                 if self.debug:
                     logging.debug ('')
@@ -4112,7 +5788,7 @@ class KoaJob:
             return (self.errorsummary)
     
     
-    def __get_statusjob (self):
+    def __get_statusjob (self, deadline=None):
 
         if self.debug:
             logging.debug ('')
@@ -4123,7 +5799,8 @@ class KoaJob:
 #   self.status doesn't exist, call get_status
 #
         try:
-            self.response = requests.get (self.statusurl, stream=True)
+            self.response = self.retry.request ('GET', self.statusurl, \
+                cookies=self.cookiejar, stream=True, deadline=deadline)
             
             if self.debug:
                 logging.debug ('')
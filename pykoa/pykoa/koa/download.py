@@ -0,0 +1,1117 @@
+import os
+import time
+import queue
+import shutil
+import logging
+import threading
+import concurrent.futures
+
+from . import conf
+
+
+def format_size (nbyte):
+
+    """
+    Human readable byte count, e.g. 1.5 GB.
+    """
+
+    size = float (nbyte)
+    for unit in ('B', 'KB', 'MB', 'GB', 'TB'):
+
+        if ((size < 1000.) or (unit == 'TB')):
+            break
+        size = size / 1000.
+
+    if (unit == 'B'):
+        return (f'{int(size):d} B')
+
+    return (f'{size:.1f} {unit:s}')
+
+
+def flat_layout (item):
+
+    """
+    Every file directly in outdir: koaid.
+    """
+
+    return (item['koaid'])
+
+
+def koa_date (koaid):
+
+    """
+    UT date (yyyymmdd) of a koaid (e.g. HI.20180316.12345.fits), or ''.
+    """
+
+    fields = koaid.split ('.')
+
+    if ((len(fields) > 2) and (len(fields[1]) == 8) and \
+        fields[1].isdigit()):
+        return (fields[1])
+
+    return ('')
+
+
+def sharded_layout (item):
+
+    """
+    Files sharded by instrument and UT date: instrument/yyyymmdd/koaid;
+    the date is taken from the koaid (e.g. HI.20180316.12345.fits).
+    """
+
+    date = koa_date (item['koaid'])
+    if (len(date) == 0):
+        date = 'nodate'
+
+    instrument = item['instrument']
+    if (len(instrument) == 0):
+        instrument = item['koaid'].split ('.')[0]
+
+    return (os.path.join (instrument, date, item['koaid']))
+
+
+layouts = {'flat': flat_layout, 'sharded': sharded_layout}
+
+def get_layout (layout):
+
+    """
+    Return the layout function for layout: 'flat', 'sharded' or a
+    function (item -> file path relative to outdir).
+    """
+
+    if callable (layout):
+        return (layout)
+
+    if (layout not in layouts):
+        raise Exception (f'Unknown layout: {layout:s}')
+
+    return (layouts[layout])
+
+
+#
+#    ordering policies: sort keys of the plan items; the row number ends
+#    every key so ties keep the table order
+#
+def largest_order (item):
+
+    """
+    Files from the local store first (no transfer), then largest first
+    (longest processing time first balances the work over the workers),
+    then the files of unknown size in table order.
+    """
+
+    return ((not item['stored'], item['size'] < 0, -item['size'], \
+        item['row'], item['calib']))
+
+
+def smallest_order (item):
+
+    """
+    Smallest first (shortest time to the first files), files of unknown
+    size last.
+    """
+
+    return ((item['size'] < 0, item['size'], item['row'], item['calib']))
+
+
+def table_order (item):
+
+    """
+    Table order, each science file followed by its calibration files.
+    """
+
+    return ((item['row'], item['calib']))
+
+
+def date_order (item):
+
+    """
+    Grouped by night (UT date of the koaid), table order within a night.
+    """
+
+    return ((koa_date (item['koaid']), item['row'], item['calib']))
+
+
+def calib_order (item):
+
+    """
+    Calibration files first, then the science files; both grouped by
+    night.
+    """
+
+    return ((-item['calib'], koa_date (item['koaid']), item['row']))
+
+
+orders = {'largest': largest_order, 'smallest': smallest_order, \
+    'table': table_order, 'date': date_order, 'calib': calib_order}
+
+def get_order (order):
+
+    """
+    Return the sort key function of order: 'largest', 'smallest',
+    'table', 'date', 'calib' or a function (item -> sort key).
+    """
+
+    if callable (order):
+        return (order)
+
+    if (order not in orders):
+        raise Exception (f'Unknown order: {order:s}')
+
+    return (orders[order])
+
+
+class OutdirIndex:
+
+    """
+    OutdirIndex class takes one os.scandir snapshot of outdir (recursive
+    for sharded layouts) into an in-memory set, so the 'file already
+    downloaded' checks cost a set lookup rather than a stat of the 
+    (parallel) file system per file.  Files downloaded during the run are
+    added to the set; partial '.part' files are not indexed.
+
+    The directories of a sharded layout are created once each.
+    """
+
+    def __init__ (self, outdir, **kwargs):
+
+        self.debug = 0
+        if ('debug' in kwargs):
+            self.debug = kwargs.get('debug')
+
+        self.recursive = False
+        if ('recursive' in kwargs):
+            self.recursive = kwargs.get('recursive')
+
+        self.outdir = outdir
+        self.files = set()
+        self.dirs = set([''])
+        self.lock = threading.Lock ()
+
+        self.__scan ('')
+
+        if self.debug:
+            logging.debug ('')
+            logging.debug (f'OutdirIndex: {len(self.files):d} files, ' + \
+                f'{len(self.dirs):d} directories')
+        return
+
+
+    def __scan (self, reldir):
+
+        try:
+            entries = os.scandir (os.path.join (self.outdir, reldir))
+        except OSError:
+            return
+
+        with entries:
+            for entry in entries:
+
+                relpath = os.path.join (reldir, entry.name)
+
+                if (entry.is_dir (follow_symlinks=False)):
+                    self.dirs.add (relpath)
+                    if self.recursive:
+                        self.__scan (relpath)
+
+                elif (not entry.name.endswith ('.part')):
+                    self.files.add (relpath)
+        return
+
+
+    def exists (self, relpath):
+
+        return (relpath in self.files)
+
+
+    def add (self, relpath):
+
+        with self.lock:
+            self.files.add (relpath)
+        return
+
+
+    def makedirs (self, relpath):
+
+        """
+        Create the directory of relpath (once).
+        """
+
+        reldir = os.path.dirname (relpath)
+
+        if (reldir in self.dirs):
+            return
+
+        os.makedirs (os.path.join (self.outdir, reldir), exist_ok=True)
+
+        with self.lock:
+            self.dirs.add (reldir)
+        return
+
+
+class DownloadPlan:
+
+    """
+    DownloadPlan class holds every file a download will fetch (science
+    files and their calibration files) with their expected sizes, so the
+    total volume is known, and checked against the free space, before
+    anything is written.
+
+    Each item is a dictionary:
+
+        koaid, instrument, filehand, url, filepath, relpath (file path
+        relative to outdir),
+        calib:  0 for a file of the metadata table, 1 for a calibration
+                file;
+        group:  koaid of the science file the item belongs to;
+        row:    row number in the metadata table;
+        size:   expected size in bytes (-1: unknown);
+        exists: the file is already in outdir (it won't be fetched);
+        stored: the file is in the local FileStore (it will be linked
+                from the store, not downloaded);
+        failed: the FailureCache entry of a file the server refused in
+                a previous run (it will be skipped), or None
+
+    Calibration files shared by several science files are planned (and
+    downloaded) once.
+    """
+
+    def __init__ (self, outdir, **kwargs):
+
+        self.debug = 0
+        if ('debug' in kwargs):
+            self.debug = kwargs.get('debug')
+
+        self.outdir = outdir
+
+        self.items = []
+        self.byfile = dict()
+
+        self.ncaliblist = 0
+        self.errors = []
+
+#
+#    filled when the download completes: its statistics (see
+#    Archive.download) and duration in seconds
+#
+        self.stats = None
+        self.elapsed = 0.
+        return
+
+
+    def add (self, item):
+
+        """
+        Add an item; returns False if the same file is already planned.
+        """
+
+        if (item['filepath'] in self.byfile):
+            return (False)
+
+        item.setdefault ('size', -1)
+        item.setdefault ('exists', False)
+        item.setdefault ('stored', False)
+        item.setdefault ('failed', None)
+
+        self.byfile[item['filepath']] = item
+        self.items.append (item)
+        return (True)
+
+
+    def pending (self, order='table'):
+
+        """
+        Items to fetch, in the order they should be started, see 
+        get_order (default 'table': table order, each science file 
+        followed by its calibration files).  The plan is sorted in 
+        memory, the metadata table is not read again.
+        """
+
+        todo = [item for item in self.items if (not item['exists'])]
+        todo.sort (key=get_order (order))
+
+        return (todo)
+
+
+    def totals (self):
+
+        total = dict()
+        total['nfile'] = len(self.items)
+        total['ncalib'] = 0
+        total['nexist'] = 0
+        total['nfetch'] = 0
+        total['nstored'] = 0
+        total['nfailed'] = 0
+        total['nbyte'] = 0
+        total['nunknown'] = 0
+
+        for item in self.items:
+
+            if (item['calib']):
+                total['ncalib'] = total['ncalib'] + 1
+
+            if (item['exists']):
+                total['nexist'] = total['nexist'] + 1
+                continue
+
+            if (item['failed'] is not None):
+                total['nfailed'] = total['nfailed'] + 1
+                continue
+
+            total['nfetch'] = total['nfetch'] + 1
+
+            if (item['stored']):
+                total['nstored'] = total['nstored'] + 1
+            elif (item['size'] < 0):
+                total['nunknown'] = total['nunknown'] + 1
+            else:
+                total['nbyte'] = total['nbyte'] + item['size']
+
+        return (total)
+
+
+    def check_space (self, **kwargs):
+
+        """
+        Check the volume to download against the space available in
+        outdir (free bytes and free inodes for the user) and against an
+        optional quota; returns (ok, msg).
+
+        Optional input:
+        ---------------
+        quota:  maximum number of bytes the download may write;
+
+        margin: fraction of the volume kept as safety margin for files of
+                unknown size (default 0.05)
+        """
+
+        quota = 0
+        if ('quota' in kwargs):
+            quota = kwargs.get('quota')
+
+        margin = 0.05
+        if ('margin' in kwargs):
+            margin = kwargs.get('margin')
+
+        total = self.totals ()
+        need = int (total['nbyte'] * (1. + margin))
+
+        msg = ''
+        try:
+            usage = shutil.disk_usage (self.outdir)
+            free = usage.free
+
+            if (need > free):
+                msg = f'Not enough space in {self.outdir:s}: ' + \
+                    f'{format_size(need):s} needed, ' + \
+                    f'{format_size(free):s} free.'
+
+            if (hasattr (os, 'statvfs') and (len(msg) == 0)):
+
+                st = os.statvfs (self.outdir)
+                if ((st.f_files > 0) and (total['nfetch'] > st.f_favail)):
+                    msg = f'Not enough inodes in {self.outdir:s}: ' + \
+                        f'{total["nfetch"]:d} files, ' + \
+                        f'{st.f_favail:d} available.'
+
+        except OSError as e:
+
+            if self.debug:
+                logging.debug ('')
+                logging.debug (f'check_space exception: {str(e):s}')
+
+        if ((quota > 0) and (need > quota) and (len(msg) == 0)):
+            msg = f'Download of {format_size(need):s} exceeds the ' + \
+                f'quota of {format_size(quota):s}.'
+
+        if self.debug:
+            logging.debug ('')
+            logging.debug (f'check_space: need= {need:d} msg= {msg:s}')
+
+        return ((len(msg) == 0), msg)
+
+
+    def report (self):
+
+        total = self.totals ()
+
+        lines = []
+        lines.append (f'Download plan: {total["nfile"]:d} files ' + \
+            f'({total["nfile"]-total["ncalib"]:d} science, ' + \
+            f'{total["ncalib"]:d} calibration), ' + \
+            f'{total["nexist"]:d} already in outdir.')
+
+        line = f'    {total["nfetch"]-total["nstored"]:d} files to ' + \
+            f'download: {format_size(total["nbyte"]):s}'
+        if (total['nunknown'] > 0):
+            line = line + f' ({total["nunknown"]:d} files of unknown size)'
+        lines.append (line)
+
+        if (total['nstored'] > 0):
+            lines.append (f'    {total["nstored"]:d} files from the ' + \
+                'local store')
+
+        if (total['nfailed'] > 0):
+            lines.append (f'    {total["nfailed"]:d} files skipped: ' + \
+                'refused by the server in a previous run')
+
+        try:
+            free = shutil.disk_usage (self.outdir).free
+            lines.append (f'    free space in {self.outdir:s}: ' + \
+                f'{format_size(free):s}')
+        except OSError:
+            pass
+
+        for msg in self.errors:
+            lines.append ('    ' + msg)
+
+        return ('\n'.join (lines))
+
+
+def run_concurrent (func, items, nworker):
+
+    """
+    Call func(item) for every item on nworker threads; returns the list
+    of results (exceptions are returned, not raised) in item order.
+    """
+
+    if (len(items) == 0):
+        return ([])
+
+    def call (item):
+        try:
+            return (func (item))
+        except Exception as e:
+            return (e)
+
+    with concurrent.futures.ThreadPoolExecutor ( \
+        max_workers=max (1, nworker)) as executor:
+        return (list (executor.map (call, items)))
+
+
+class Concurrency:
+
+    """
+    Concurrency class is an AIMD (additive increase, multiplicative
+    decrease) controller of the number of concurrent downloads.
+
+    The workers report every completed file.  At most every 'interval'
+    seconds the controller measures the aggregate throughput of the last
+    interval and keeps its running average for the current limit:
+
+      - congestion since the last decision (a failed file, a retried
+        request: 429/503, timeout, ... see RetryPolicy.on_retry, or a
+        latency spike: a file taking more than 'spike' times the usual
+        time per byte): the limit is halved;
+
+      - every slot busy and the throughput at this limit 5% or more 
+        above the throughput at limit-1 (or not measured yet): the limit
+        is raised by one (up to nmax);
+
+      - otherwise the limit is kept.
+
+    The congestion signals of the interval following a decrease are
+    ignored (they come from the requests started before it).  The
+    throughputs measured are forgotten after a congestion and every 30
+    seconds, so the controller probes upwards again when conditions
+    change.
+
+    Every decision is kept in 'history' as (seconds since start, limit,
+    throughput in bytes/s, reason) for the instrumentation output.
+
+    Optional input:
+    ---------------
+    nworker:  initial limit (default conf.nworker);
+
+    nmax:     maximum limit (default conf.max_nworker);
+
+    interval: minimum seconds between decisions (default 2);
+
+    spike:    latency spike factor (default 3);
+
+    debug:    default is no debug written
+    """
+
+    def __init__ (self, **kwargs):
+
+        self.debug = 0
+        if ('debug' in kwargs):
+            self.debug = kwargs.get('debug')
+
+        self.limit = conf.nworker
+        if ('nworker' in kwargs):
+            self.limit = kwargs.get('nworker')
+
+        self.nmax = conf.max_nworker
+        if ('nmax' in kwargs):
+            self.nmax = kwargs.get('nmax')
+
+        self.interval = 2.
+        if ('interval' in kwargs):
+            self.interval = kwargs.get('interval')
+
+        self.spike = 3.
+        if ('spike' in kwargs):
+            self.spike = kwargs.get('spike')
+
+        self.nmax = max (1, self.nmax)
+        self.limit = min (max (1, self.limit), self.nmax)
+        self.nstart = self.limit
+
+        self.active = 0
+        self.saturated = False
+        self.cond = threading.Condition ()
+
+        self.start = time.monotonic()
+        self.stamp = self.start
+        self.nbyte = 0
+        self.rates = dict()
+        self.rates_stamp = self.start
+        self.congestion = ''
+        self.quiet_until = self.start
+        self.cost = -1.
+
+        self.history = []
+        self.nincrease = 0
+        self.ndecrease = 0
+        return
+
+
+    def acquire (self):
+
+        """
+        Block until a download slot is free.
+        """
+
+        with self.cond:
+
+            while (self.active >= self.limit):
+                self.saturated = True
+                self.cond.wait ()
+
+            self.active = self.active + 1
+            if (self.active >= self.limit):
+                self.saturated = True
+        return
+
+
+    def release (self):
+
+        with self.cond:
+            self.active = self.active - 1
+            self.cond.notify ()
+        return
+
+
+    def congested (self, reason):
+
+        """
+        Report a congestion signal (e.g. a retried 503).
+        """
+
+        with self.cond:
+            if ((len(self.congestion) == 0) and \
+                (time.monotonic() >= self.quiet_until)):
+                self.congestion = reason
+        return
+
+
+    def report (self, nbyte, duration, error=None):
+
+        """
+        Report a completed file: nbyte received in duration seconds, and
+        the exception that failed it, if any.
+        """
+
+        with self.cond:
+
+            self.nbyte = self.nbyte + max (0, nbyte)
+
+            quiet = (time.monotonic() < self.quiet_until)
+
+            if (error is not None):
+                if ((len(self.congestion) == 0) and (not quiet)):
+                    self.congestion = 'error: ' + str(error)[0:60]
+
+#
+#    latency: seconds per MB (files of 64 KB or more), against its
+#    running average
+#
+            elif (nbyte >= 65536):
+
+                cost = duration / (nbyte / 1.e6)
+
+                if ((self.cost > 0.) and (cost > self.spike * self.cost) \
+                    and (len(self.congestion) == 0) and (not quiet)):
+                    self.congestion = f'latency spike ({cost:.2f} s/MB)'
+
+                if (self.cost < 0.):
+                    self.cost = cost
+                else:
+                    self.cost = 0.8*self.cost + 0.2*cost
+
+            self.__decide ()
+        return
+
+
+    def __decide (self):
+
+        now = time.monotonic()
+        if (now - self.stamp < self.interval):
+            return
+
+        throughput = self.nbyte / (now - self.stamp)
+        limit = self.limit
+        reason = ''
+
+        if (now - self.rates_stamp > 30.):
+            self.rates.clear ()
+            self.rates_stamp = now
+
+        if (len(self.congestion) > 0):
+
+            limit = max (1, self.limit // 2)
+            reason = self.congestion
+            self.rates.clear ()
+            self.quiet_until = now + self.interval
+
+        else:
+            if (self.limit in self.rates):
+                self.rates[self.limit] = \
+                    0.5*self.rates[self.limit] + 0.5*throughput
+            else:
+                self.rates[self.limit] = throughput
+
+            below = self.rates.get (self.limit-1, -1.)
+
+            if (self.saturated and (self.limit < self.nmax) and \
+                (self.rates[self.limit] >= 1.05 * below)):
+
+                limit = self.limit + 1
+                reason = 'throughput up'
+
+        if (limit > self.limit):
+            self.nincrease = self.nincrease + 1
+        elif (limit < self.limit):
+            self.ndecrease = self.ndecrease + 1
+
+        if (limit != self.limit):
+
+            self.history.append ((now - self.start, limit, throughput, \
+                reason))
+
+            if self.debug:
+                logging.debug ('')
+                logging.debug (f'Concurrency: {self.limit:d} -> ' + \
+                    f'{limit:d} ({reason:s}; {throughput:.0f} B/s)')
+
+            self.limit = limit
+            self.cond.notify_all ()
+
+        self.stamp = now
+        self.nbyte = 0
+        self.congestion = ''
+        self.saturated = (self.active >= self.limit)
+        return
+
+
+    def report_line (self):
+
+        nmax = max ([self.nstart] + [h[1] for h in self.history])
+
+        return (f'Adaptive concurrency: {self.nstart:d} -> ' + \
+            f'{self.limit:d} workers (peak {nmax:d}; ' + \
+            f'{self.nincrease:d} increases, {self.ndecrease:d} decreases)')
+
+
+class Downloader:
+
+    """
+    Downloader class runs the fetch of the planned items on a pool of
+    worker threads and hands out the results as the files complete.
+
+    Calling Synopsis (example):
+
+    engine = Downloader (fetch, nworker=4)
+
+    for (item, result, error) in engine.run (plan.pending()):
+        ...
+
+    fetch(item) downloads one item and returns its result; error is the
+    exception raised by fetch (result is then None).
+
+    Hedged requests: one slow transfer in a large batch sets the time of
+    the whole batch.  With a hedge function, an item still running after
+    the 95th percentile of the fetch durations so far (once hedge_min
+    fetches have completed) gets a second, concurrent fetch, hedge(item).
+    The first copy to complete successfully is handed out and the other
+    one is cancelled through item['cancel'], a threading.Event set on
+    every item; an error is handed out only when no copy succeeded.  At
+    most max(1, nworker/4) hedges run at a time.
+
+    When the caller stops iterating run() early (break, close()), the
+    items not started are dropped, the fetches in flight are cancelled
+    through item['cancel'] and the threads are joined before close()
+    returns, so nothing keeps downloading behind the caller's back.
+
+    Optional input:
+    ---------------
+    nworker:     number of worker threads (default conf.nworker);
+
+    concurrency: a Concurrency controller adapting the number of 
+                 concurrent fetches (nworker is then ignored, the pool
+                 has concurrency.nmax threads); default is a fixed 
+                 number of workers;
+
+    hedge:       function fetching a second copy of a slow item; default
+                 is no hedged requests;
+
+    debug:       default is no debug written
+    """
+
+    hedge_min = 20
+    hedge_quantile = 0.95
+    hedge_interval = 0.5
+
+    stop_timeout = 30.
+
+    def __init__ (self, fetch, **kwargs):
+
+        self.debug = 0
+        if ('debug' in kwargs):
+            self.debug = kwargs.get('debug')
+
+        self.fetch = fetch
+
+        self.nworker = conf.nworker
+        if ('nworker' in kwargs):
+            self.nworker = kwargs.get('nworker')
+
+        self.nworker = max (1, self.nworker)
+
+        self.concurrency = None
+        if ('concurrency' in kwargs):
+            self.concurrency = kwargs.get('concurrency')
+
+        if (self.concurrency is not None):
+            self.nworker = self.concurrency.nmax
+
+        self.hedge = None
+        if ('hedge' in kwargs):
+            self.hedge = kwargs.get('hedge')
+
+        self.nhedge_max = max (1, self.nworker // 4)
+
+        self.nhedged = 0
+        self.nhedge_won = 0
+        return
+
+
+    def run (self, items):
+
+        """
+        items is a list, or any iterable (e.g. a generator reading rows
+        from a network stream): it is then consumed by a feeder thread
+        and the workers start on the first items while the next ones are
+        still being produced.
+        """
+
+        todo = queue.Queue ()
+        done = queue.Queue ()
+
+        concurrency = self.concurrency
+
+#
+#    items being fetched (id -> [item, start, hedged]); hedging state:
+#    number of copies running per item, completed durations; stop is set
+#    when the caller stops iterating
+#
+        lock = threading.Lock ()
+        running = dict()
+        copies = dict()
+        durations = []
+        nhedge = [0]
+        hedgers = []
+        finished = threading.Event ()
+        stop = threading.Event ()
+
+        def work ():
+
+            while (not stop.is_set()):
+
+                if (concurrency is not None):
+                    concurrency.acquire ()
+
+                item = todo.get ()
+                if ((item is None) or stop.is_set()):
+                    if (concurrency is not None):
+                        concurrency.release ()
+                    break
+
+                start = time.monotonic()
+
+                item['cancel'] = threading.Event ()
+
+#
+#    registered under the lock stop is checked under: an item is either
+#    dropped here or cancelled by __stop
+#
+                with lock:
+                    if (not stop.is_set()):
+                        running[id(item)] = [item, start, False]
+                        if (self.hedge is not None):
+                            copies[id(item)] = 1
+
+                if (id(item) not in running):
+                    if (concurrency is not None):
+                        concurrency.release ()
+                    break
+
+                try:
+                    result = self.fetch (item)
+                    entry = (item, result, None)
+                except Exception as e:
+                    entry = (item, None, e)
+
+                with lock:
+                    del running[id(item)]
+                    if ((self.hedge is not None) and \
+                        self.__succeeded (entry)):
+                        durations.append (time.monotonic() - start)
+
+                if (concurrency is not None):
+                    concurrency.release ()
+
+                    nbyte = 0
+                    if (isinstance (entry[1], dict)):
+                        nbyte = entry[1].get ('size', 0)
+
+                    concurrency.report (nbyte, time.monotonic() - start, \
+                        entry[2])
+
+                done.put ((entry, False))
+
+            done.put (None)
+            return
+
+        def hedge_work (item):
+
+            try:
+                result = self.hedge (item)
+                entry = (item, result, None)
+            except Exception as e:
+                entry = (item, None, e)
+
+            done.put ((entry, True))
+            return
+
+        def monitor ():
+
+            while (not finished.wait (self.hedge_interval)):
+
+                launch = []
+                with lock:
+
+                    if (len(durations) < self.hedge_min):
+                        continue
+
+                    ranked = sorted (durations)
+                    limit = ranked[int (self.hedge_quantile * \
+                        (len(ranked) - 1))]
+
+                    now = time.monotonic()
+                    for (key, state) in running.items():
+
+                        if (nhedge[0] >= self.nhedge_max):
+                            break
+
+                        if (state[2] or (now - state[1] <= limit)):
+                            continue
+
+                        state[2] = True
+                        copies[key] = copies[key] + 1
+                        nhedge[0] = nhedge[0] + 1
+                        launch.append (state[0])
+
+                for item in launch:
+
+                    self.nhedged = self.nhedged + 1
+
+                    if self.debug:
+                        logging.debug ('')
+                        logging.debug (f'Downloader: hedge item after ' + \
+                            f'{limit:.1f} seconds')
+
+                    t = threading.Thread (target=hedge_work, args=(item,), \
+                        name='koa-download-hedge', daemon=True)
+                    t.start ()
+                    hedgers.append (t)
+            return
+
+        feeder = None
+        if isinstance (items, (list, tuple)):
+
+            nitem = len(items)
+            nthread = min (self.nworker, max (1, nitem))
+
+            for item in items:
+                todo.put (item)
+            for i in range (0, nthread):
+                todo.put (None)
+        else:
+            nitem = -1
+            nthread = self.nworker
+
+            def feed ():
+
+                try:
+                    for item in items:
+                        if stop.is_set():
+                            break
+                        todo.put (item)
+
+                except Exception as e:
+                    if self.debug:
+                        logging.debug ('')
+                        logging.debug (f'Downloader feed: {str(e):s}')
+                finally:
+                    for i in range (0, nthread):
+                        todo.put (None)
+                return
+
+            feeder = threading.Thread (target=feed, \
+                name='koa-download-feed', daemon=True)
+            feeder.start ()
+
+        if self.debug:
+            logging.debug ('')
+            logging.debug (f'Downloader.run: {nitem:d} items, ' + \
+                f'{nthread:d} workers')
+
+        threads = []
+        for i in range (0, nthread):
+            t = threading.Thread (target=work, name=f'koa-download-{i:d}', \
+                daemon=True)
+            t.start ()
+            threads.append (t)
+
+        monitoring = None
+        if (self.hedge is not None):
+            monitoring = threading.Thread (target=monitor, \
+                name='koa-download-hedging', daemon=True)
+            monitoring.start ()
+
+#
+#    a hedge is only launched for an item still in running, i.e. before
+#    its worker queued the item's entry: once all workers are done,
+#    nhedge counts every hedge still to be received
+#
+        nrunning = nthread
+        try:
+            while True:
+
+                if (nrunning == 0):
+                    with lock:
+                        if (nhedge[0] == 0):
+                            break
+
+                entry = done.get ()
+                if (entry is None):
+                    nrunning = nrunning - 1
+                    continue
+
+                (entry, hedged) = entry
+
+                if (self.hedge is None):
+                    yield entry
+                    continue
+
+                item = entry[0]
+                with lock:
+                    copies[id(item)] = copies[id(item)] - 1
+                    left = copies[id(item)]
+                    if (left == 0):
+                        del copies[id(item)]
+                    if hedged:
+                        nhedge[0] = nhedge[0] - 1
+
+#
+#    the first successful copy wins; the other copies are cancelled and
+#    dropped; an error waits for the other copy
+#
+                if item['cancel'].is_set():
+                    continue
+
+                if self.__succeeded (entry):
+
+                    if hedged:
+                        self.nhedge_won = self.nhedge_won + 1
+
+                    if (left > 0):
+                        item['cancel'].set ()
+                    yield entry
+
+                elif (left == 0):
+                    yield entry
+        finally:
+            finished.set ()
+            self.__stop (stop, lock, running, todo, nthread, \
+                threads + [feeder, monitoring], hedgers)
+
+        return
+
+
+    def __stop (self, stop, lock, running, todo, nthread, threads, hedgers):
+
+#
+#    the caller stopped iterating (or the run is over): drop the items not
+#    started, cancel the fetches in flight and wait for the threads (the
+#    hedges last: the monitor launching them is stopped first)
+#
+        with lock:
+            stop.set ()
+            for state in running.values():
+                state[0]['cancel'].set ()
+
+        try:
+            while True:
+                todo.get_nowait ()
+        except queue.Empty:
+            pass
+
+        for i in range (0, nthread):
+            todo.put (None)
+
+        for t in threads:
+            self.__join (t)
+
+        for t in list (hedgers):
+            self.__join (t)
+        return
+
+
+    def __join (self, t):
+
+        if (t is None):
+            return
+
+        t.join (self.stop_timeout)
+
+        if (t.is_alive() and self.debug):
+            logging.debug ('')
+            logging.debug (f'Downloader: {t.name:s} still running ' + \
+                f'after {self.stop_timeout:.0f} seconds')
+        return
+
+
+    def __succeeded (self, entry):
+
+        (item, result, error) = entry
+
+        if (error is not None):
+            return (False)
+
+        if (isinstance (result, dict) and (result.get ('status') == 'error')):
+            return (False)
+
+        return (True)
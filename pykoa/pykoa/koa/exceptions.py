@@ -0,0 +1,74 @@
+class KoaError (Exception):
+
+    """
+    Base class of the errors raised by pykoa.
+    """
+
+    pass
+
+
+class KoaParameterError (KoaError, ValueError):
+
+    """
+    KoaParameterError is raised when a required input is missing or an
+    input is invalid.
+    """
+
+    pass
+
+
+class KoaLoginError (KoaError):
+
+    """
+    KoaLoginError is raised when the login fails (invalid credentials,
+    service unreachable).
+    """
+
+    pass
+
+
+class KoaQueryError (KoaError):
+
+    """
+    KoaQueryError is raised when a query fails: the query can't be
+    built or submitted, its job ends in ERROR or ABORTED phase, or the
+    result can't be retrieved.
+    """
+
+    pass
+
+
+class KoaTimeoutError (KoaQueryError, TimeoutError):
+
+    """
+    KoaTimeoutError is raised when a query does not complete within its
+    time limit (timeout or deadline); the query's UWS job has been
+    aborted on the server.
+    """
+
+    pass
+
+
+class KoaDownloadError (KoaError):
+
+    """
+    KoaDownloadError is raised when a download can't run: outdir can't
+    be created, the metadata table can't be read, not enough space, ...
+    (a file failing to download is reported in its record instead).
+    """
+
+    pass
+
+
+class KoaFileError (KoaError):
+
+    """
+    KoaFileError is raised when the server refuses a file: kind is
+    'missing', 'proprietary' or 'refused' (see failures.classify).
+    """
+
+    def __init__ (self, msg, kind='refused'):
+
+        super().__init__ (msg)
+        self.kind = kind
+        return
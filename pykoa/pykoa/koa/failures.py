@@ -0,0 +1,218 @@
+import os
+import time
+import sqlite3
+import logging
+import threading
+
+from . import conf
+
+
+def classify (msg, status=200):
+
+    """
+    Kind of a file error returned by the server: 'missing',
+    'proprietary' or 'refused', from the HTTP status or the error message
+    of a JSON answer.  Only 'missing' and 'proprietary' are definite (see
+    FailureCache.kinds); 'refused' may succeed on the next request.
+    """
+
+    if (status in (404, 410)):
+        return ('missing')
+
+    if (status in (401, 403)):
+        return ('proprietary')
+
+    text = msg.lower()
+
+    for word in ('proprietary', 'permission', 'authoriz', 'login', \
+        'access'):
+        if (word in text):
+            return ('proprietary')
+
+    for word in ('not found', 'no such', 'does not exist', 'missing'):
+        if (word in text):
+            return ('missing')
+
+    return ('refused')
+
+
+class FailureCache:
+
+    """
+    FailureCache class is a persistent negative cache of the files the
+    server refused as missing or proprietary, so a rerun of a download
+    doesn't request them all again.
+
+    Entries ((koaid, identity) -> kind, message, time) are kept in a
+    sqlite database shared by the processes using it; identity is the
+    login the file was requested with ('' for none), so a file refused
+    as proprietary to one login is still requested with another.  An
+    entry older than ttl seconds is ignored (and dropped), the file is
+    then requested again.  Only the kinds in FailureCache.kinds are
+    cached: other refusals and transient errors (connection errors,
+    server errors, failed verification) are not.
+
+    After a login, the files refused as proprietary can be requested
+    again with refresh('proprietary').
+
+    Calling Synopsis (example):
+
+    failures = FailureCache (outdir + '/.koafailures.sqlite')
+
+    entry = failures.lookup (koaid, identity)
+    if (entry is None):
+        ...
+
+    Required input:
+    ---------------
+    path:  database file (created if it doesn't exist).
+
+    Optional input:
+    ---------------
+    ttl:   seconds an entry is valid (default conf.failure_ttl);
+
+    debug: default is no debug written
+    """
+
+    kinds = ('missing', 'proprietary')
+
+    def __init__ (self, path, **kwargs):
+
+        self.debug = 0
+        if ('debug' in kwargs):
+            self.debug = kwargs.get('debug')
+
+        self.ttl = float (conf.failure_ttl)
+        if ('ttl' in kwargs):
+            self.ttl = float (kwargs.get('ttl'))
+
+        self.path = path
+
+        dirname = os.path.dirname (path)
+        if (len(dirname) > 0):
+            os.makedirs (dirname, exist_ok=True)
+
+        self.lock = threading.Lock ()
+
+        self.db = sqlite3.connect (path, timeout=60., \
+            check_same_thread=False)
+
+#
+#    a database of the former layout (keyed by koaid only) is dropped: it
+#    is only a cache
+#
+        with self.lock, self.db:
+
+            columns = [row[1] for row in \
+                self.db.execute ('pragma table_info (failures)')]
+            if ((len(columns) > 0) and ('identity' not in columns)):
+                self.db.execute ('drop table failures')
+
+            self.db.execute ('create table if not exists failures (' + \
+                'koaid text, identity text, kind text, msg text, ' + \
+                'added real, primary key (koaid, identity))')
+
+        self.nhit = 0
+
+        if self.debug:
+            logging.debug ('')
+            logging.debug (f'FailureCache: {path:s} ttl= {self.ttl:.0f}')
+        return
+
+
+    def lookup (self, koaid, identity=''):
+
+        """
+        Return the entry of koaid for the login identity (a dictionary:
+        kind, msg, added) or None if the file is not known to fail.
+        """
+
+        with self.lock:
+
+            row = self.db.execute ('select kind, msg, added from failures ' + \
+                'where koaid = ? and identity = ?', \
+                (koaid, identity)).fetchone ()
+
+            if (row is None):
+                return (None)
+
+            if (time.time() - row[2] > self.ttl):
+
+                with self.db:
+                    self.db.execute ('delete from failures ' + \
+                        'where koaid = ? and identity = ?', (koaid, identity))
+                return (None)
+
+            self.nhit = self.nhit + 1
+
+        entry = dict()
+        entry['kind'] = row[0]
+        entry['msg'] = row[1]
+        entry['added'] = row[2]
+        return (entry)
+
+
+    def add (self, koaid, kind, msg, identity=''):
+
+        """
+        Record the refusal of koaid to the login identity; returns False
+        (nothing recorded) if kind is not one of FailureCache.kinds.
+        """
+
+        if (kind not in self.kinds):
+            return (False)
+
+        with self.lock, self.db:
+            self.db.execute ('insert or replace into failures ' + \
+                '(koaid, identity, kind, msg, added) ' + \
+                'values (?, ?, ?, ?, ?)', \
+                (koaid, identity, kind, msg, time.time()))
+
+        if self.debug:
+            logging.debug ('')
+            logging.debug (f'FailureCache.add: {koaid:s} {kind:s} {msg:s}')
+        return (True)
+
+
+    def remove (self, koaid, identity=''):
+
+        with self.lock, self.db:
+            self.db.execute ('delete from failures ' + \
+                'where koaid = ? and identity = ?', (koaid, identity))
+        return
+
+
+    def refresh (self, kinds=None):
+
+        """
+        Forget the failures of the given kinds (a kind or a list of
+        kinds; default: all), e.g. refresh('proprietary') after a login;
+        returns the number of entries removed.
+        """
+
+        if isinstance (kinds, str):
+            kinds = [kinds]
+
+        with self.lock, self.db:
+
+            if (kinds is None):
+                cursor = self.db.execute ('delete from failures')
+            else:
+                marks = ', '.join (['?'] * len(kinds))
+                cursor = self.db.execute ('delete from failures ' + \
+                    f'where kind in ({marks:s})', tuple (kinds))
+
+            nremoved = cursor.rowcount
+
+        if self.debug:
+            logging.debug ('')
+            logging.debug (f'FailureCache.refresh: {nremoved:d} removed')
+
+        return (nremoved)
+
+
+    def close (self):
+
+        with self.lock:
+            self.db.close ()
+        return
@@ -0,0 +1,381 @@
+import re
+import time
+import logging
+import threading
+import concurrent.futures
+
+from .exceptions import KoaTimeoutError
+
+
+def normalize_adql (query):
+
+    """
+    The form of an ADQL query used to recognize identical queries:
+    whitespace collapsed and keywords and identifiers lower-cased outside
+    the quoted strings and delimited identifiers, which are kept as is.
+    """
+
+    parts = re.split (r"('(?:[^']|'')*'|\"[^\"]*\")", query)
+
+    for i in range (0, len(parts), 2):
+        parts[i] = re.sub (r'\s+', ' ', parts[i]).lower ()
+
+    return (''.join (parts).strip ())
+
+
+class Flight:
+
+#
+#    one operation in flight: its result (or error) once done; for a
+#    shared operation (see SingleFlight.share) its callers, the event
+#    abandoning it and the last value it published
+#
+    def __init__ (self):
+
+        self.done = threading.Event ()
+        self.result = None
+        self.error = None
+        self.nwaiter = 0
+
+        self.callers = []
+        self.closed = False
+        self.abandon = threading.Event ()
+        self.published = None
+        return
+
+
+class Caller:
+
+#
+#    one caller of a shared operation: its delivery and notification
+#    functions, and its own result once delivered
+#
+    def __init__ (self, deliver, notify):
+
+        self.deliver = deliver
+        self.notify = notify
+
+        self.result = None
+        self.error = None
+        self.delivering = False
+        self.gone = False
+        return
+
+
+class SingleFlight:
+
+    """
+    SingleFlight class coalesces identical concurrent operations: the
+    first caller of a key (the leader) runs the operation, the callers
+    of the same key arriving while it is in flight wait for it and get
+    its result (or its error) instead of running it again.
+
+    Calling Synopsis (example):
+
+    (result, leader) = flights.do (key, fetch)
+
+    Once the operation completes, the key is forgotten: a later call
+    runs the operation again (this is not a cache).
+
+    do() runs the operation on the leader's thread, with the leader's
+    own limits; share() runs it on a thread of its own, which no single
+    caller can stop: each caller only gives up its own wait, and the
+    operation is abandoned when none of them is waiting any more.
+    """
+
+#
+#    seconds the last caller giving up a shared operation waits for the
+#    operation to wind down (e.g. its job to be aborted)
+#
+    abandon_wait = 30.
+
+    def __init__ (self, **kwargs):
+
+        self.debug = 0
+        if ('debug' in kwargs):
+            self.debug = kwargs.get('debug')
+
+        self.flights = dict()
+        self.ncoalesced = 0
+
+        self.lock = threading.Lock ()
+        return
+
+
+    def do (self, key, fn, **kwargs):
+
+        """
+        Run fn() for the key, or wait for the same key's operation in
+        flight; returns (result, leader), leader False when the result
+        is another caller's.
+
+        Optional input (for the waiters):
+        ---------------
+        deadline: time.time() past which a waiter gives up waiting
+                  (KoaTimeoutError), the operation goes on;
+
+        cancel:   a threading.Event: once set, a waiter gives up waiting
+                  (CancelledError)
+        """
+
+        with self.lock:
+
+            flight = self.flights.get (key)
+            leader = (flight is None)
+
+            if leader:
+                flight = Flight ()
+                self.flights[key] = flight
+            else:
+                flight.nwaiter = flight.nwaiter + 1
+                self.ncoalesced = self.ncoalesced + 1
+
+        if leader:
+
+            try:
+                flight.result = fn ()
+
+            except BaseException as e:
+                flight.error = e
+                raise
+
+            finally:
+                with self.lock:
+                    del self.flights[key]
+                flight.done.set ()
+
+            return ((flight.result, True))
+
+        if self.debug:
+            logging.debug ('')
+            logging.debug (f'SingleFlight: waiting for {str(key):s}')
+
+        self.__wait (flight, kwargs.get ('deadline'), kwargs.get ('cancel'))
+
+        if (flight.error is not None):
+            raise flight.error
+
+        return ((flight.result, False))
+
+
+    def share (self, key, fn, **kwargs):
+
+        """
+        Run fn(abandon, publish) for the key on a thread of its own, or
+        join the same key's operation in flight, and wait for it; returns
+        (result, leader), leader False when the operation was started by
+        another caller.
+
+        abandon is a threading.Event set when every caller has given up
+        waiting: fn should then stop (e.g. abort its job).  publish(value)
+        passes a value (e.g. the job created) to the callers' notify.
+
+        Optional input:
+        ---------------
+        deliver:  function(result, last) run on the operation's thread
+                  for each caller still waiting, before the operation 
+                  completes (e.g. copy a result file to the caller's own
+                  path; last: no other caller follows, the file can be
+                  moved); its return value (or error) is the caller's
+                  result;
+
+        cleanup:  function(result) run on the operation's thread once
+                  the callers are delivered (e.g. remove a result file),
+                  the leader's only;
+
+        notify:   function(value) called with the values published, the
+                  last one at once when the caller joins;
+
+        deadline: time.time() past which the caller gives up waiting
+                  (KoaTimeoutError);
+
+        cancel:   a threading.Event: once set, the caller gives up 
+                  waiting (CancelledError)
+        """
+
+        caller = Caller (kwargs.get ('deliver'), kwargs.get ('notify'))
+
+        with self.lock:
+
+#
+#    an abandoned operation still winding down is not joined
+#
+            flight = self.flights.get (key)
+            leader = ((flight is None) or flight.abandon.is_set())
+
+            if leader:
+                flight = Flight ()
+                self.flights[key] = flight
+            else:
+                flight.nwaiter = flight.nwaiter + 1
+                self.ncoalesced = self.ncoalesced + 1
+
+            flight.callers.append (caller)
+            published = flight.published
+
+        if ((published is not None) and (caller.notify is not None)):
+            caller.notify (published)
+
+        if leader:
+            t = threading.Thread (target=self.__run, \
+                args=(key, flight, fn, kwargs.get ('cleanup')), \
+                name='koa-flight', daemon=True)
+            t.start ()
+
+        elif self.debug:
+            logging.debug ('')
+            logging.debug (f'SingleFlight: joining {str(key):s}')
+
+        try:
+            self.__wait (flight, kwargs.get ('deadline'), \
+                kwargs.get ('cancel'), caller)
+
+        except BaseException:
+            self.__leave (flight, caller, force=True)
+            raise
+
+        if (caller.error is not None):
+            raise caller.error
+
+        return ((caller.result, leader))
+
+
+    def __run (self, key, flight, fn, cleanup):
+
+#
+#    the thread of a shared operation: run it, then deliver its result
+#    to each caller still waiting before completing the flight
+#
+        def publish (value):
+
+            with self.lock:
+                flight.published = value
+                callers = [caller for caller in flight.callers \
+                    if (not caller.gone)]
+
+            for caller in callers:
+                if (caller.notify is not None):
+                    caller.notify (value)
+            return
+
+        try:
+            flight.result = fn (flight.abandon, publish)
+
+        except BaseException as e:
+            flight.error = e
+
+        with self.lock:
+
+            if (self.flights.get (key) is flight):
+                del self.flights[key]
+            flight.closed = True
+
+            callers = [caller for caller in flight.callers \
+                if (not caller.gone)]
+            for caller in callers:
+                caller.delivering = True
+
+        for (i, caller) in enumerate (callers):
+
+            if ((flight.error is None) and (caller.deliver is not None)):
+
+                try:
+                    caller.result = caller.deliver (flight.result, \
+                        (i == len(callers) - 1))
+                except Exception as e:
+                    caller.error = e
+            else:
+                caller.result = flight.result
+                caller.error = flight.error
+
+        if ((flight.error is None) and (cleanup is not None)):
+
+            try:
+                cleanup (flight.result)
+            except Exception as e:
+                if self.debug:
+                    logging.debug ('')
+                    logging.debug (f'SingleFlight cleanup: {str(e):s}')
+
+        flight.done.set ()
+        return
+
+
+    def __leave (self, flight, caller, force=False):
+
+#
+#    a caller gives up its wait, unless its result is already being
+#    delivered (force: it leaves anyway, e.g. KeyboardInterrupt); the
+#    last one abandons the operation and waits (a little) for it to
+#    stop.  Returns False if the caller must keep waiting.
+#
+        with self.lock:
+
+            if caller.gone:
+                return (True)
+
+            if (caller.delivering and (not force)):
+                return (False)
+
+            caller.gone = True
+
+            last = ((not flight.closed) and \
+                all (c.gone for c in flight.callers))
+
+            if last:
+                flight.abandon.set ()
+
+        if last:
+
+            if self.debug:
+                logging.debug ('')
+                logging.debug ('SingleFlight: operation abandoned')
+
+            flight.done.wait (self.abandon_wait)
+        return (True)
+
+
+    def __wait (self, flight, deadline, cancel, caller=None):
+
+#
+#    wait for the flight within the caller's limits; the caller of a
+#    shared operation leaves it (see __leave) before raising
+#
+        while True:
+
+            wait = 1.
+            error = None
+
+            if (deadline is not None):
+
+                remaining = deadline - time.time()
+                if (remaining <= 0.):
+                    error = KoaTimeoutError ('Error: the query did not ' + \
+                        'complete within the time limit.')
+
+                wait = max (0., min (wait, remaining))
+
+            if ((error is None) and (cancel is not None) and \
+                cancel.is_set()):
+                error = concurrent.futures.CancelledError ('query cancelled')
+
+            if (error is None):
+                if flight.done.wait (wait):
+                    return
+                continue
+
+            if ((caller is None) or self.__leave (flight, caller)):
+                raise error
+
+#
+#    the caller's result is being delivered: wait for the delivery
+#
+            flight.done.wait ()
+            return
+
+
+#
+#    the flights of the queries and of the file fetches of all Archive
+#    instances of the process
+#
+flights = SingleFlight ()
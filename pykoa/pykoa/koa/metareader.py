@@ -0,0 +1,415 @@
+import io
+import csv
+import logging
+import xml.parsers.expat
+
+from astropy.table import Table
+
+
+class MetaReader:
+
+    """
+    MetaReader class reads only the requested columns from a KOA metadata
+    table (ipac, csv, tsv or votable) without parsing the whole table
+    into an astropy table.
+
+    The table is read line by line (or element by element for votable);
+    only the requested columns are extracted and returned as strings,
+    so iterating over the reader uses constant memory regardless of the
+    table size.
+
+    Calling Synopsis (example):
+
+    reader = MetaReader (metapath, 'ipac', \
+        columns=['koaid', 'instrume', 'filehand'])
+
+    for (koaid, instrume, filehand) in reader:
+        ...
+
+    or
+
+    data = reader.read()    # dictionary of column name: list of values
+
+    Required input:
+    ---------------
+    source:  a metadata file path or an open file object (text or binary);
+
+    format:  metadata table's format: ipac, votable, csv, or tsv.
+
+    Optional input:
+    ---------------
+    columns: list of column names to extract (case-insensitive);
+             default: ['koaid', 'instrume', 'filehand']
+
+    debug:   default is no debug written
+    """
+
+    columns_default = ['koaid', 'instrume', 'filehand']
+
+    def __init__ (self, source, format, **kwargs):
+
+        self.source = source
+        self.format = format.lower()
+
+        self.debug = 0
+        if ('debug' in kwargs):
+            self.debug = kwargs.get('debug')
+
+        self.columns = self.columns_default
+        if ('columns' in kwargs):
+            self.columns = list (kwargs.get('columns'))
+
+        self.columns = [col.lower() for col in self.columns]
+
+#
+#    colnames: all column names in the table (available once the header
+#    has been parsed); nrow: number of data rows returned so far.
+#
+        self.colnames = []
+        self.nrow = 0
+
+        if self.debug:
+            logging.debug ('')
+            logging.debug ('Enter MetaReader.init:')
+            logging.debug (f'format= {self.format:s}')
+            logging.debug (f'columns= {str(self.columns):s}')
+
+        if (self.format.startswith ('ascii.')):
+            self.format = self.format[6:]
+        if (self.format == 'tab'):
+            self.format = 'tsv'
+
+        return
+
+
+    def __iter__ (self):
+
+        """
+        Iterate over the table rows; each row is a tuple of the requested
+        column values (str) in the order given by 'columns'.
+        """
+
+        self.nrow = 0
+
+        if (self.format == 'votable'):
+            rows = self.__iter_votable ()
+        else:
+            fp, close = self.__open_text ()
+
+            try:
+                if (self.format == 'ipac'):
+                    rows = self.__iter_ipac (fp)
+                elif (self.format == 'csv'):
+                    rows = self.__iter_delimited (fp, ',')
+                elif (self.format == 'tsv'):
+                    rows = self.__iter_delimited (fp, '\t')
+                else:
+                    rows = self.__iter_astropy ()
+
+                for row in rows:
+                    self.nrow = self.nrow + 1
+                    yield row
+            finally:
+                if close:
+                    fp.close()
+
+            return
+
+        for row in rows:
+            self.nrow = self.nrow + 1
+            yield row
+
+        return
+
+
+    def read (self):
+
+        """
+        Read all rows and return a dictionary: column name -> list of
+        values (str), in the order of the table.
+        """
+
+        data = dict()
+        for col in self.columns:
+            data[col] = []
+
+        for row in self:
+            for i in range (0, len(self.columns)):
+                data[self.columns[i]].append (row[i])
+
+        if self.debug:
+            logging.debug ('')
+            logging.debug (f'MetaReader.read: nrow= {self.nrow:d}')
+
+        return (data)
+
+
+    def __open_text (self):
+
+        if isinstance (self.source, str):
+            fp = open (self.source, 'r', newline='')
+            return (fp, True)
+
+        if isinstance (self.source, io.TextIOBase):
+            return (self.source, False)
+
+        fp = io.TextIOWrapper (self.source, encoding='utf-8', newline='')
+        return (fp, False)
+
+
+    def __column_index (self, names):
+
+        self.colnames = names
+
+        lower = [name.lower() for name in names]
+
+        indx = []
+        for col in self.columns:
+
+            if (col not in lower):
+                msg = f'Column [{col:s}] not found in the metadata table.'
+                raise Exception (msg)
+
+            indx.append (lower.index (col))
+
+        if self.debug:
+            logging.debug ('')
+            logging.debug (f'colnames= {str(names):s}')
+            logging.debug (f'column index= {str(indx):s}')
+
+        return (indx)
+
+
+    def __iter_ipac (self, fp):
+
+#
+#    IPAC table: keyword/comment lines start with '\', up to four header
+#    lines start with '|' (name, type, unit, null); data lines are fixed
+#    width, each value lies between the positions of two '|' in the
+#    header.
+#
+        header = []
+        spans = None
+        nulls = None
+
+        for line in fp:
+
+            line = line.rstrip ('\r\n')
+
+            if (spans is None):
+
+                if (len(line) == 0 or line[0] == '\\'):
+                    continue
+
+                if (line[0] == '|'):
+                    header.append (line)
+                    continue
+
+#
+#    first data line: compute column spans from the name line
+#
+                pos = [i for i, c in enumerate (header[0]) if c == '|']
+
+                names = []
+                for i in range (0, len(pos)-1):
+                    names.append (header[0][pos[i]+1:pos[i+1]].strip (' -'))
+
+                indx = self.__column_index (names)
+                spans = [(pos[i]+1, pos[i+1]) for i in indx]
+
+                nulls = [None] * len(indx)
+                if (len(header) > 3):
+                    nulls = [header[3][s:e].strip() for (s, e) in spans]
+
+            if (len(line.strip()) == 0):
+                continue
+
+            row = []
+            for i in range (0, len(spans)):
+
+                (s, e) = spans[i]
+                val = line[s:e].strip()
+
+                if (val == nulls[i]):
+                    val = ''
+                row.append (val)
+
+            yield tuple (row)
+
+        return
+
+
+    def __iter_delimited (self, fp, delimiter):
+
+#
+#    plain str.split for lines without quotes (the common case for KOA
+#    tables); the csv module only for lines containing quoted fields.
+#
+        indx = None
+        for line in fp:
+
+            line = line.rstrip ('\r\n')
+
+            if (len(line) == 0):
+                continue
+
+            if ('"' in line):
+                fields = next (csv.reader ([line], delimiter=delimiter))
+            else:
+                fields = line.split (delimiter)
+
+            if (indx is None):
+                if (fields[0].startswith ('#')):
+                    continue
+
+                indx = self.__column_index ([f.strip() for f in fields])
+                continue
+
+            yield tuple ([fields[i].strip() for i in indx])
+
+        return
+
+
+    def __iter_votable (self):
+
+#
+#    stream the votable through expat: only the text of the TD elements
+#    in the requested columns is collected, rows are handed out as soon
+#    as their TR closes, so memory stays constant.  BINARY/FITS 
+#    serializations are not streamable here: fall back to astropy.
+#
+        state = dict()
+        state['names'] = []
+        state['want'] = None
+        state['itd'] = -1
+        state['intd'] = False
+        state['text'] = []
+        state['row'] = dict()
+        state['binary'] = False
+
+        rows = []
+
+        def start_element (name, attrs):
+
+            tag = name.rsplit (':', 1)[-1]
+
+            if (tag == 'TD'):
+                state['itd'] = state['itd'] + 1
+                state['intd'] = (state['itd'] in state['want'])
+                state['text'] = []
+
+            elif (tag == 'TR'):
+                if (state['want'] is None):
+                    indx = self.__column_index (state['names'])
+                    state['indx'] = indx
+                    state['want'] = set (indx)
+                state['itd'] = -1
+                state['row'] = dict()
+
+            elif (tag == 'FIELD'):
+                state['names'].append (attrs.get ('name', ''))
+
+            elif (tag in ('BINARY', 'BINARY2', 'FITS')):
+                state['binary'] = True
+            return
+
+        def end_element (name):
+
+            tag = name.rsplit (':', 1)[-1]
+
+            if (tag == 'TD'):
+                if (state['intd']):
+                    state['row'][state['itd']] = ''.join (state['text'])
+                state['intd'] = False
+
+            elif (tag == 'TR'):
+                row = state['row']
+                rows.append (tuple ( \
+                    [row.get (i, '').strip() for i in state['indx']]))
+            return
+
+        def char_data (data):
+
+            if (state['intd']):
+                state['text'].append (data)
+            return
+
+        parser = xml.parsers.expat.ParserCreate ()
+        parser.StartElementHandler = start_element
+        parser.EndElementHandler = end_element
+        parser.CharacterDataHandler = char_data
+        parser.buffer_text = True
+
+        close = False
+        fp = self.source
+        if isinstance (self.source, str):
+            fp = open (self.source, 'rb')
+            close = True
+
+#
+#    read1 hands over the data as it arrives from a network stream
+#
+        read = getattr (fp, 'read1', fp.read)
+
+        try:
+            while True:
+
+                data = read (1048576)
+
+                if (len(data) == 0):
+                    parser.Parse (b'', True)
+                else:
+                    parser.Parse (data, False)
+
+                if (state['binary']):
+                    
+                    if self.debug:
+                        logging.debug ('')
+                        logging.debug ('votable BINARY/FITS: use astropy')
+
+                    if not isinstance (self.source, str):
+                        msg = 'BINARY votable requires a file path.'
+                        raise Exception (msg)
+
+                    yield from self.__iter_astropy ()
+                    return
+
+                yield from rows
+                rows.clear()
+
+                if (len(data) == 0):
+                    break
+        finally:
+            if close:
+                fp.close()
+
+        return
+
+
+    def __iter_astropy (self):
+
+        fmt_astropy = self.format
+        if (self.format == 'tsv'):
+            fmt_astropy = 'ascii.tab'
+        if (self.format == 'csv'):
+            fmt_astropy = 'ascii.csv'
+        if (self.format == 'ipac'):
+            fmt_astropy = 'ascii.ipac'
+
+        tbl = Table.read (self.source, format=fmt_astropy)
+
+        indx = self.__column_index (tbl.colnames)
+
+        cols = [tbl.columns[i] for i in indx]
+        for l in range (0, len(tbl)):
+
+            row = []
+            for col in cols:
+                val = col[l]
+                if (type(val) is bytes):
+                    val = val.decode ('utf-8')
+                row.append (str(val).strip())
+
+            yield tuple (row)
+
+        return
@@ -0,0 +1,320 @@
+import time
+import logging
+import threading
+
+import numpy as np
+from astropy.table import Table
+
+from . import conf
+
+
+#
+#    astropy formats of the KOA table formats
+#
+table_formats = {
+    'ipac': 'ascii.ipac',
+    'votable': 'votable',
+    'csv': 'ascii.csv',
+    'tsv': 'ascii.tab',
+}
+
+def parse_criteria (param):
+
+    """
+    The constraints of query_criteria parameters that can be evaluated
+    locally: a dictionary (datetime: (start, end) numpy datetime64 or
+    None, pos: (ra, dec, radius) in degrees or None), or None when the
+    parameters have other constraints (target, polygon or box
+    position, ...).
+    """
+
+    criteria = dict()
+    criteria['datetime'] = None
+    criteria['pos'] = None
+
+    for key in param:
+        if (key not in ('instrument', 'datetime', 'pos')):
+            return (None)
+
+    try:
+        if (len(param.get ('datetime', '')) > 0):
+
+            (start, end) = param['datetime'].split ('/')
+
+            criteria['datetime'] = ( \
+                np.datetime64 (start.strip().replace (' ', 'T'), 'ms'), \
+                np.datetime64 (end.strip().replace (' ', 'T'), 'ms'))
+
+        if (len(param.get ('pos', '')) > 0):
+
+            words = param['pos'].lower().split ()
+            if ((len(words) != 4) or (words[0] != 'circle')):
+                return (None)
+
+            criteria['pos'] = (float (words[1]), float (words[2]), \
+                float (words[3]))
+
+    except ValueError:
+        return (None)
+
+    return (criteria)
+
+
+def separation (ra1, dec1, ra2, dec2):
+
+    """
+    Angular separation (degrees) of two positions (degrees); the
+    arguments may be numpy arrays.
+    """
+
+    ra1 = np.radians (ra1)
+    dec1 = np.radians (dec1)
+    ra2 = np.radians (ra2)
+    dec2 = np.radians (dec2)
+
+    h = np.sin ((dec2 - dec1) / 2.)**2 + \
+        np.cos (dec1) * np.cos (dec2) * np.sin ((ra2 - ra1) / 2.)**2
+
+    return (np.degrees (2. * np.arcsin (np.sqrt (np.clip (h, 0., 1.)))))
+
+
+def contains (outer, inner):
+
+    """
+    True if every row matching the criteria inner also matches outer.
+    """
+
+    if (outer['datetime'] is not None):
+
+        if (inner['datetime'] is None):
+            return (False)
+
+        if ((inner['datetime'][0] < outer['datetime'][0]) or \
+            (inner['datetime'][1] > outer['datetime'][1])):
+            return (False)
+
+    if (outer['pos'] is not None):
+
+        if (inner['pos'] is None):
+            return (False)
+
+        (ra1, dec1, r1) = outer['pos']
+        (ra2, dec2, r2) = inner['pos']
+
+        if (separation (ra1, dec1, ra2, dec2) + r2 > r1):
+            return (False)
+
+    return (True)
+
+
+class QueryCache:
+
+    """
+    QueryCache class keeps the recent results of query_criteria (and
+    query_datetime, query_position, query_object) in memory, so a query
+    whose criteria are contained in a cached result's -- same
+    instrument, login, servers and format, a datetime sub-range and/or a
+    circle inside the cached circle -- is answered by filtering the
+    cached table locally instead of submitting a TAP job.
+
+    The rows are selected with vectorized predicates on the row times
+    (date_columns, e.g. date_obs + ut) and positions (ra_column,
+    dec_column, degrees) computed once when the result is cached; a
+    result lacking the columns of a constraint can't answer it.  Only
+    complete results (no maxrec) are cached; polygon, box and target
+    constraints are always sent to the server.
+
+    Entries expire after conf.query_cache_ttl seconds (0: no cache); at
+    most conf.query_cache_size results are kept (the least recently
+    used are dropped).
+    """
+
+    date_columns = ('date_obs', 'ut')
+    ra_column = 'ra'
+    dec_column = 'dec'
+
+    def __init__ (self, **kwargs):
+
+        self.debug = 0
+        if ('debug' in kwargs):
+            self.debug = kwargs.get('debug')
+
+        self.entries = []
+
+        self.nhit = 0
+        self.nmiss = 0
+
+        self.lock = threading.Lock ()
+        return
+
+
+    def enabled (self):
+
+        return (conf.query_cache_ttl > 0)
+
+
+    def add (self, scope, criteria, outpath, format):
+
+        """
+        Cache the result table outpath (format) of a query of criteria
+        (see parse_criteria) for the scope (instrument, login, servers,
+        format).
+        """
+
+        table = Table.read (outpath, format=table_formats[format])
+
+        entry = dict()
+        entry['scope'] = scope
+        entry['criteria'] = criteria
+        entry['table'] = table
+        entry['times'] = self.__row_times (table)
+        entry['positions'] = self.__row_positions (table)
+        entry['added'] = time.monotonic()
+
+        with self.lock:
+
+            self.__expire ()
+
+            self.entries.insert (0, entry)
+            del self.entries[int (conf.query_cache_size):]
+
+        if self.debug:
+            logging.debug ('')
+            logging.debug (f'QueryCache.add: {len(table):d} rows ' + \
+                f'{str(criteria):s}')
+        return
+
+
+    def lookup (self, scope, criteria):
+
+        """
+        The rows of a cached result matching criteria (an astropy
+        Table), or None if no cached result contains them.
+        """
+
+        with self.lock:
+
+            self.__expire ()
+
+            for entry in self.entries:
+
+                if ((entry['scope'] != scope) or \
+                    (not contains (entry['criteria'], criteria))):
+                    continue
+
+                if ((criteria['datetime'] is not None) and \
+                    (entry['times'] is None)):
+                    continue
+
+                if ((criteria['pos'] is not None) and \
+                    (entry['positions'] is None)):
+                    continue
+
+                self.entries.remove (entry)
+                self.entries.insert (0, entry)
+                self.nhit = self.nhit + 1
+                break
+            else:
+                self.nmiss = self.nmiss + 1
+                return (None)
+
+        return (entry['table'][self.__select (entry, criteria)])
+
+
+    def clear (self):
+
+        with self.lock:
+            self.entries = []
+        return
+
+
+    def __select (self, entry, criteria):
+
+        mask = np.ones (len(entry['table']), dtype=bool)
+
+        if (criteria['datetime'] is not None):
+
+            (start, end) = criteria['datetime']
+            times = entry['times']
+
+            mask &= ((times >= start) & (times <= end))
+
+        if (criteria['pos'] is not None):
+
+            (ra, dec, radius) = criteria['pos']
+            (ras, decs) = entry['positions']
+
+            mask &= (separation (ra, dec, ras, decs) <= radius)
+
+        return (mask)
+
+
+    def __column (self, table, name):
+
+        for colname in table.colnames:
+            if (colname.lower() == name):
+                return (table[colname])
+
+        raise KeyError (name)
+
+
+    def __row_times (self, table):
+
+#
+#    numpy datetime64 of the rows (NaT for null values), None without the
+#    date columns
+#
+        try:
+            columns = [np.char.strip (np.ma.filled ( \
+                self.__column (table, name).astype (str), '')) \
+                for name in self.date_columns]
+
+            values = columns[0]
+            for column in columns[1:]:
+                values = np.char.add (np.char.add (values, 'T'), column)
+
+            values = np.where (np.char.str_len (columns[0]) > 0, values, \
+                'NaT')
+
+            return (values.astype ('datetime64[ms]'))
+
+        except (KeyError, ValueError) as e:
+
+            if self.debug:
+                logging.debug ('')
+                logging.debug (f'QueryCache: no row times: {str(e):s}')
+            return (None)
+
+
+    def __row_positions (self, table):
+
+        try:
+            ras = np.ma.filled (np.asarray (self.__column (table, \
+                self.ra_column), dtype=float), np.nan)
+            decs = np.ma.filled (np.asarray (self.__column (table, \
+                self.dec_column), dtype=float), np.nan)
+
+            return ((ras, decs))
+
+        except (KeyError, ValueError, TypeError) as e:
+
+            if self.debug:
+                logging.debug ('')
+                logging.debug (f'QueryCache: no row positions: {str(e):s}')
+            return (None)
+
+
+    def __expire (self):
+
+        ttl = float (conf.query_cache_ttl)
+        now = time.monotonic()
+
+        self.entries = [entry for entry in self.entries \
+            if (now - entry['added'] <= ttl)]
+        return
+
+
+#
+#    the query results of all Archive instances of the process
+#
+query_cache = QueryCache ()
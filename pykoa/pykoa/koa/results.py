@@ -0,0 +1,57 @@
+class QueryResult:
+
+    """
+    QueryResult class is returned by the query methods (query_adql,
+    query_criteria, query_datetime, ...) once the result table is saved:
+
+        outpath: the result table file,
+        format:  its format,
+        query:   the ADQL query sent,
+        nrows:   number of rows in the table (-1: not counted),
+        job:     the query's KoaJob,
+        elapsed: seconds from the call to the saved table,
+        msg:     the service's message
+    """
+
+    def __init__ (self, **kwargs):
+
+        self.outpath = kwargs.get ('outpath', '')
+        self.format = kwargs.get ('format', '')
+        self.query = kwargs.get ('query', '')
+        self.nrows = kwargs.get ('nrows', -1)
+        self.job = kwargs.get ('job')
+        self.elapsed = kwargs.get ('elapsed', 0.)
+        self.msg = kwargs.get ('msg', '')
+        return
+
+
+    def __repr__ (self):
+
+        return (f'QueryResult (outpath={self.outpath!r}, ' + \
+            f'nrows={self.nrows:d}, elapsed={self.elapsed:.2f})')
+
+
+class LoginResult:
+
+    """
+    LoginResult class is returned by a successful login:
+
+        userid:     the KOA user,
+        cookiepath: the cookie file saved,
+        elapsed:    seconds the login took,
+        msg:        the service's message
+    """
+
+    def __init__ (self, **kwargs):
+
+        self.userid = kwargs.get ('userid', '')
+        self.cookiepath = kwargs.get ('cookiepath', '')
+        self.elapsed = kwargs.get ('elapsed', 0.)
+        self.msg = kwargs.get ('msg', '')
+        return
+
+
+    def __repr__ (self):
+
+        return (f'LoginResult (userid={self.userid!r}, ' + \
+            f'cookiepath={self.cookiepath!r})')
@@ -0,0 +1,467 @@
+import time
+import random
+import logging
+import threading
+import email.utils
+import urllib.parse
+
+import requests
+
+from . import conf
+
+
+class CircuitBreaker:
+
+    """
+    CircuitBreaker class pauses every request to a server that is clearly
+    down instead of letting each worker fail (and retry) on its own.
+
+    The breaker is 'closed' while requests succeed.  After 'threshold'
+    consecutive failures it 'opens': wait() then blocks all callers for
+    'cooldown' seconds.  When the cooldown expires a single probe request
+    is let through ('half-open'); its success closes the breaker, its
+    failure re-opens it with the cooldown doubled (up to cooldown_max).
+
+    One breaker is shared by all requests to the same host, see
+    get_breaker().
+    """
+
+    def __init__ (self, **kwargs):
+
+        self.threshold = conf.breaker_threshold
+        if ('threshold' in kwargs):
+            self.threshold = kwargs.get('threshold')
+
+        self.cooldown_min = float (conf.breaker_cooldown)
+        if ('cooldown' in kwargs):
+            self.cooldown_min = float (kwargs.get('cooldown'))
+
+        self.cooldown_max = 16. * self.cooldown_min
+        self.cooldown = self.cooldown_min
+
+        self.state = 'closed'
+        self.nfailure = 0
+        self.opened_until = 0.
+        self.probing = False
+        self.probe_start = 0.
+
+        self.lock = threading.Condition ()
+        return
+
+
+    def wait (self):
+
+        """
+        Block while the breaker is open; returns when the caller may send
+        its request.
+        """
+
+        with self.lock:
+
+            while True:
+
+                if (self.state == 'closed'):
+                    return
+
+                now = time.monotonic()
+
+                if (self.state == 'open'):
+
+                    if (now < self.opened_until):
+                        self.lock.wait (self.opened_until - now)
+                        continue
+
+                    self.state = 'half-open'
+                    self.probing = False
+
+#
+#    half-open: one probe at a time; a probe that never reported back
+#    (caller interrupted) is replaced after cooldown_max
+#
+                if ((not self.probing) or \
+                    (now - self.probe_start > self.cooldown_max)):
+                    self.probing = True
+                    self.probe_start = now
+                    return
+
+                self.lock.wait (1.)
+
+        return
+
+
+    def available (self):
+
+        """
+        False while the breaker is open (a request would wait for the
+        end of the cooldown).
+        """
+
+        with self.lock:
+            return ((self.state != 'open') or \
+                (time.monotonic() >= self.opened_until))
+
+
+    def success (self):
+
+        with self.lock:
+            self.state = 'closed'
+            self.nfailure = 0
+            self.probing = False
+            self.cooldown = self.cooldown_min
+            self.lock.notify_all ()
+        return
+
+
+    def failure (self):
+
+        with self.lock:
+
+            self.nfailure = self.nfailure + 1
+
+            if (self.state == 'half-open'):
+                self.cooldown = min (2.*self.cooldown, self.cooldown_max)
+                self.__open ()
+
+            elif ((self.state == 'closed') and \
+                (self.nfailure >= self.threshold)):
+                self.__open ()
+
+            self.lock.notify_all ()
+        return
+
+
+    def __open (self):
+
+        self.state = 'open'
+        self.probing = False
+        self.opened_until = time.monotonic() + self.cooldown
+
+        logging.warning ( \
+            f'KOA server unavailable: pausing requests for ' + \
+            f'{self.cooldown:.1f} seconds')
+        return
+
+
+def loggable (url):
+
+    """
+    The url without its query string, for the logs: a query string may
+    carry credentials (e.g. the login's password).
+    """
+
+    return (urllib.parse.urlsplit (url)._replace (query='').geturl ())
+
+
+def loggable_error (e, url):
+
+#
+#    the message of a requests exception, which may quote the url's path
+#    and query string, without the query string
+#
+    msg = str(e)
+
+    query = urllib.parse.urlsplit (url).query
+    if (len(query) > 0):
+        msg = msg.replace ('?' + query, '')
+
+    return (msg)
+
+
+breakers = dict()
+breakers_lock = threading.Lock ()
+
+def get_breaker (url):
+
+    """
+    Return the CircuitBreaker shared by all requests to url's host.
+    """
+
+    host = urllib.parse.urlsplit (url).netloc
+
+    with breakers_lock:
+
+        if (host not in breakers):
+            breakers[host] = CircuitBreaker ()
+
+        return (breakers[host])
+
+
+class RetryPolicy:
+
+    """
+    RetryPolicy class sends HTTP requests with retries on transient
+    errors (connection resets, timeouts, 429/500/502/503/504 responses).
+
+    Retries wait with exponential backoff and full jitter:
+
+        delay = random (0, min (backoff_max, backoff * 2**attempt))
+
+    unless the server sends a Retry-After header, which is honored.
+    All requests go through the host's CircuitBreaker.
+
+    Only idempotent requests (GET, HEAD, status polls) are retried after
+    the request may have reached the server; other methods (POST) are
+    retried only when the connection could not be established or the
+    server answered 429/503, i.e. the request was not processed.
+
+    Calling Synopsis (example):
+
+    policy = RetryPolicy ()
+    response = policy.request ('GET', url, stream=True)
+
+    Optional input:
+    ---------------
+    retries:     maximum number of retries (default conf.retries);
+
+    backoff:     base delay in seconds (default conf.backoff);
+
+    backoff_max: maximum delay in seconds (default conf.backoff_max);
+
+    timeout:     default requests timeout, (connect, read) seconds
+                 (default conf.timeout, conf.read_timeout);
+
+    debug:       default is no debug written
+
+    on_retry, if set, is called with a short reason for every transient
+    failure (e.g. to feed a Concurrency controller).
+    """
+
+    retry_status = (429, 500, 502, 503, 504)
+    retry_status_post = (429, 503)
+
+    def __init__ (self, **kwargs):
+
+        self.debug = 0
+        if ('debug' in kwargs):
+            self.debug = kwargs.get('debug')
+
+        self.retries = conf.retries
+        if ('retries' in kwargs):
+            self.retries = kwargs.get('retries')
+
+        self.backoff = float (conf.backoff)
+        if ('backoff' in kwargs):
+            self.backoff = float (kwargs.get('backoff'))
+
+        self.backoff_max = float (conf.backoff_max)
+        if ('backoff_max' in kwargs):
+            self.backoff_max = float (kwargs.get('backoff_max'))
+
+        self.timeout = (float (conf.timeout), float (conf.read_timeout))
+        if ('timeout' in kwargs):
+            self.timeout = kwargs.get('timeout')
+
+        self.on_retry = None
+        return
+
+
+    def delay (self, attempt, response=None):
+
+        """
+        Return the number of seconds to wait before retry 'attempt'
+        (0-based), honoring the Retry-After header of response.
+        """
+
+        if (response is not None):
+
+            after = self.__retry_after (response)
+            if (after is not None):
+                return (min (after, self.backoff_max))
+
+        cap = min (self.backoff_max, self.backoff * (2 ** attempt))
+        return (random.uniform (0., cap))
+
+
+    def sleep (self, attempt, response=None, deadline=None):
+
+        wait = self.delay (attempt, response)
+        if (deadline is not None):
+            wait = max (0., min (wait, deadline - time.time()))
+
+        if self.debug:
+            logging.debug ('')
+            logging.debug (f'retry {attempt:d}: sleep {wait:.2f} seconds')
+
+        time.sleep (wait)
+        return
+
+
+    def request (self, method, url, **kwargs):
+
+        """
+        Send the request with retries; returns the requests response (the
+        last one when all retries failed on a retryable status) or raises
+        the last exception.
+
+        Optional input: any requests.request keyword, plus
+
+        session:  a requests.Session to send the request with;
+
+        deadline: an absolute time (time.time()): the timeout of each
+                  attempt is capped at the time left and no retry is
+                  made past it (requests.exceptions.Timeout is raised
+                  when no time is left).
+        """
+
+        session = None
+        if ('session' in kwargs):
+            session = kwargs.pop('session')
+
+        deadline = None
+        if ('deadline' in kwargs):
+            deadline = kwargs.pop('deadline')
+
+#
+#    never wait forever on a server: a hung connection would block the
+#    caller (and a download worker) indefinitely
+#
+        if (kwargs.get('timeout') is None):
+            kwargs['timeout'] = self.timeout
+
+        timeout = kwargs['timeout']
+
+        idempotent = (method.upper() in ('GET', 'HEAD', 'OPTIONS'))
+
+        statuses = self.retry_status
+        if (not idempotent):
+            statuses = self.retry_status_post
+
+        breaker = get_breaker (url)
+
+        attempt = 0
+        while True:
+
+            if (deadline is not None):
+                kwargs['timeout'] = self.__capped (timeout, deadline)
+
+            breaker.wait ()
+
+            response = None
+            try:
+                if (session is None):
+                    response = requests.request (method, url, **kwargs)
+                else:
+                    response = session.request (method, url, **kwargs)
+
+            except requests.exceptions.RequestException as e:
+
+                breaker.failure ()
+
+                if (self.on_retry is not None):
+                    self.on_retry (type(e).__name__)
+
+                if self.debug:
+                    logging.debug ('')
+                    logging.debug (f'{method:s} {loggable (url):s}: ' + \
+                        loggable_error (e, url))
+
+                if ((attempt >= self.retries) or \
+                    (not self.is_transient (e, idempotent)) or \
+                    self.__past (deadline)):
+                    raise
+
+                self.sleep (attempt, deadline=deadline)
+                attempt = attempt + 1
+                continue
+
+            if (response.status_code not in self.retry_status):
+                breaker.success ()
+                return (response)
+
+            breaker.failure ()
+
+            if (self.on_retry is not None):
+                self.on_retry (f'status {response.status_code:d}')
+
+            if self.debug:
+                logging.debug ('')
+                logging.debug (f'{method:s} {loggable (url):s}: ' + \
+                    f'status {response.status_code:d}')
+
+            if ((attempt >= self.retries) or \
+                (response.status_code not in statuses) or \
+                self.__past (deadline)):
+                return (response)
+
+            self.sleep (attempt, response, deadline=deadline)
+            response.close ()
+            attempt = attempt + 1
+
+        return
+
+
+    def __capped (self, timeout, deadline):
+
+#
+#    the requests timeout (a number or a (connect, read) tuple) limited
+#    to the time left before deadline
+#
+        left = deadline - time.time()
+        if (left <= 0.):
+            raise requests.exceptions.Timeout ( \
+                'no time left before the deadline')
+
+        if isinstance (timeout, tuple):
+            return (tuple (left if (t is None) else min (t, left) \
+                for t in timeout))
+
+        if (timeout is None):
+            return (left)
+
+        return (min (timeout, left))
+
+
+    def __past (self, deadline):
+
+        return ((deadline is not None) and (time.time() >= deadline))
+
+
+    def is_transient (self, e, idempotent=True):
+
+        """
+        Return True if the exception e is worth a retry.
+        """
+
+        if (not idempotent):
+            return (self.__is_connect_error (e))
+
+        return (isinstance (e, (requests.exceptions.ConnectionError, \
+            requests.exceptions.Timeout, \
+            requests.exceptions.ChunkedEncodingError)))
+
+
+    def __is_connect_error (self, e):
+
+#
+#    the request never reached the server: safe to resend a POST
+#
+        if isinstance (e, requests.exceptions.ConnectTimeout):
+            return (True)
+
+        if (not isinstance (e, requests.exceptions.ConnectionError)):
+            return (False)
+
+        reason = None
+        if (len(e.args) > 0):
+            reason = getattr (e.args[0], 'reason', None)
+
+        name = type(reason).__name__
+        return (name in ('NewConnectionError', 'NameResolutionError'))
+
+
+    def __retry_after (self, response):
+
+        value = response.headers.get ('Retry-After')
+        if (value is None):
+            return (None)
+
+        try:
+            return (max (0., float (value)))
+        except ValueError:
+            pass
+
+        try:
+            when = email.utils.parsedate_to_datetime (value)
+            return (max (0., when.timestamp() - time.time()))
+        except Exception:
+            return (None)
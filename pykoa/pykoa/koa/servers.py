@@ -0,0 +1,358 @@
+import time
+import logging
+import threading
+
+import requests
+
+from . import conf
+from .retry import RetryPolicy, get_breaker, loggable_error
+
+
+def parse_servers (value):
+
+    """
+    List of the KOA base URLs given as a list, or as a string of comma
+    or blank separated URLs.
+    """
+
+    if isinstance (value, str):
+        value = value.replace (',', ' ').split ()
+
+    servers = []
+    for server in value:
+
+        server = server.strip()
+        if ((len(server) > 0) and (server not in servers)):
+            servers.append (server)
+
+    if (len(servers) == 0):
+        raise Exception ('No KOA server given.')
+
+    return (servers)
+
+
+class ServerPool:
+
+    """
+    ServerPool class holds the KOA servers (base URLs: the primary first,
+    then the mirrors), keeps track of their latency and health, picks the
+    server requests are sent to and fails over to the next server when
+    one fails.
+
+    Latency: the servers are probed (GET of the base URL, any answer
+    below status 500 is healthy) on first use and again every
+    conf.probe_interval seconds; every request sent through the pool
+    updates its server's latency (moving average of the time to the
+    response headers).
+
+    Health: a server failing a request (connection error, 5xx) is
+    avoided for conf.breaker_cooldown seconds, as is a server whose
+    CircuitBreaker is open.
+
+    Requests (see request) are sent to the best server: the healthy one
+    with the lowest latency, the list order breaking ties.  With a single
+    server nothing is probed and requests go through unchanged.
+
+    One pool is shared by all the requests to the same servers, see
+    get_servers().
+
+    Required input:
+    ---------------
+    servers: list of base URLs (or string, see parse_servers).
+
+    Optional input:
+    ---------------
+    debug:   default is no debug written
+    """
+
+#
+#    moving average weight of a new latency sample
+#
+    alpha = 0.3
+
+#
+#    spread: servers within this factor of the best latency share the
+#    transfers
+#
+    spread_factor = 2.
+
+    def __init__ (self, servers, **kwargs):
+
+        self.debug = 0
+        if ('debug' in kwargs):
+            self.debug = kwargs.get('debug')
+
+        self.servers = parse_servers (servers)
+
+        self.latency = dict()
+        self.down_until = dict()
+        for server in self.servers:
+            self.latency[server] = None
+            self.down_until[server] = 0.
+
+        self.probed = 0.
+        self.nspread = 0
+
+        self.lock = threading.Lock ()
+        self.probe_lock = threading.Lock ()
+        return
+
+
+    def probe (self):
+
+        """
+        Measure the latency and health of every server (concurrently).
+        """
+
+        timeout = min (float (conf.timeout), 10.)
+
+        def probe_one (server):
+
+            start = time.monotonic()
+            try:
+                response = requests.get (server, timeout=timeout, \
+                    stream=True)
+                response.close ()
+
+                if (response.status_code >= 500):
+                    raise Exception (f'status {response.status_code:d}')
+
+                self.success (server, time.monotonic() - start)
+
+            except Exception as e:
+
+                if self.debug:
+                    logging.debug ('')
+                    logging.debug (f'probe {server:s}: {str(e):s}')
+
+                self.failure (server)
+            return
+
+        threads = []
+        for server in self.servers:
+            t = threading.Thread (target=probe_one, args=(server,), \
+                name='koa-probe', daemon=True)
+            t.start ()
+            threads.append (t)
+
+        for t in threads:
+            t.join ()
+
+        with self.lock:
+            self.probed = time.monotonic()
+
+        if self.debug:
+            logging.debug ('')
+            logging.debug ('ServerPool.probe:')
+            for server in self.servers:
+                logging.debug (f'{server:s}: latency= ' + \
+                    f'{str(self.latency[server]):s}')
+        return
+
+
+    def ranked (self):
+
+        """
+        Servers in the order to try them: healthy servers by latency,
+        then the servers found down.
+        """
+
+        if (len(self.servers) == 1):
+            return (list (self.servers))
+
+        if (time.monotonic() - self.probed > conf.probe_interval):
+
+            with self.probe_lock:
+                if (time.monotonic() - self.probed > conf.probe_interval):
+                    self.probe ()
+
+        now = time.monotonic()
+
+        def key (server):
+
+            down = ((now < self.down_until[server]) or \
+                (not get_breaker (server).available ()))
+
+            latency = self.latency[server]
+            if (latency is None):
+                latency = float ('inf')
+
+            return ((down, latency, self.servers.index (server)))
+
+        with self.lock:
+            return (sorted (self.servers, key=key))
+
+
+    def best (self):
+
+        return (self.ranked()[0])
+
+
+    def rebase (self, url, server):
+
+        """
+        url with its server part replaced by server (url is returned
+        unchanged if it doesn't start with one of the pool's servers).
+        """
+
+        for base in self.servers:
+            if url.startswith (base):
+                return (server + url[len(base):])
+
+        return (url)
+
+
+    def success (self, server, latency):
+
+        with self.lock:
+
+            if (self.latency[server] is None):
+                self.latency[server] = latency
+            else:
+                self.latency[server] = (1. - self.alpha) * \
+                    self.latency[server] + self.alpha * latency
+
+            self.down_until[server] = 0.
+        return
+
+
+    def failure (self, server):
+
+        with self.lock:
+            self.down_until[server] = time.monotonic() + \
+                float (conf.breaker_cooldown)
+        return
+
+
+    def request (self, retry, method, url, **kwargs):
+
+        """
+        Send a request (url on any of the pool's servers) with the
+        RetryPolicy retry, to the best server first; on a connection
+        error or a 5xx answer the request is sent to the next server.
+        Only the last server tried gets retry's full retries, the others
+        fail over after one retry.  POST requests fail over only when the
+        server did not process them (see RetryPolicy).
+
+        Optional input: the RetryPolicy.request keywords, plus
+
+        spread: share the requests between the servers whose latency is
+                within spread_factor of the best (e.g. file transfers
+                under load); default is False.
+        """
+
+        spread = False
+        if ('spread' in kwargs):
+            spread = kwargs.pop('spread')
+
+        servers = self.ranked ()
+
+        if (len(servers) == 1):
+            return (retry.request (method, url, **kwargs))
+
+        if spread:
+            servers = self.__spread (servers)
+
+        idempotent = (method.upper() in ('GET', 'HEAD', 'OPTIONS'))
+
+        statuses = RetryPolicy.retry_status
+        if (not idempotent):
+            statuses = RetryPolicy.retry_status_post
+
+        quick = RetryPolicy (retries=min (1, retry.retries), \
+            backoff=retry.backoff, backoff_max=retry.backoff_max, \
+            timeout=retry.timeout, debug=retry.debug)
+        quick.on_retry = retry.on_retry
+
+        for (i, server) in enumerate (servers):
+
+            last = (i == len(servers) - 1)
+
+            target = self.rebase (url, server)
+
+            policy = quick
+            if last:
+                policy = retry
+
+            start = time.monotonic()
+            try:
+                response = policy.request (method, target, **kwargs)
+
+            except requests.exceptions.RequestException as e:
+
+                if ((not last) and (retry.is_transient (e, idempotent))):
+
+                    self.failure (server)
+                    self.__failover (server, loggable_error (e, target))
+                    continue
+
+                raise
+
+            if ((not last) and (response.status_code in statuses)):
+
+                response.close ()
+                self.failure (server)
+                self.__failover (server, f'status {response.status_code:d}')
+                continue
+
+            if (response.status_code < 500):
+                self.success (server, time.monotonic() - start)
+
+            return (response)
+
+        return
+
+
+    def __spread (self, servers):
+
+#
+#    rotate between the healthy servers close to the best one
+#
+        now = time.monotonic()
+
+        with self.lock:
+
+            best = self.latency[servers[0]]
+            if ((best is None) or (now < self.down_until[servers[0]])):
+                return (servers)
+
+            near = []
+            for server in servers:
+
+                latency = self.latency[server]
+                if ((latency is None) or (now < self.down_until[server]) or \
+                    (latency > self.spread_factor * best)):
+                    break
+                near.append (server)
+
+            first = self.nspread % len(near)
+            self.nspread = self.nspread + 1
+
+        return (near[first:] + near[0:first] + servers[len(near):])
+
+
+    def __failover (self, server, reason):
+
+        logging.warning (f'KOA server {server:s} failed ({reason:s}): ' + \
+            'trying the next server')
+        return
+
+
+pools = dict()
+pools_lock = threading.Lock ()
+
+def get_servers (servers, **kwargs):
+
+    """
+    Return the ServerPool shared by all requests to servers (list of
+    base URLs or string, see parse_servers).
+    """
+
+    key = tuple (parse_servers (servers))
+
+    with pools_lock:
+
+        if (key not in pools):
+            pools[key] = ServerPool (list (key), **kwargs)
+
+        return (pools[key])
@@ -0,0 +1,226 @@
+import os
+import json
+import logging
+import threading
+import urllib.parse
+import http.cookiejar
+
+from . import conf
+from .retry import RetryPolicy, loggable_error
+from .servers import get_servers
+from .exceptions import KoaLoginError
+
+
+class KoaSession:
+
+    """
+    KoaSession class holds a KOA login: the cookie jar of a cookie file,
+    loaded once and shared by every request of the Archive, KoaTap and
+    KoaJob objects using that cookie file (queries, job status polls,
+    result and file downloads), and the credentials of the login.
+
+    The cookie file is loaded again only when it changes on disk (e.g.
+    another process logged in).  When the session expires -- a cookie
+    has expired, or the server refuses a request for lack of a valid
+    login -- the session logs in again with the credentials of its last
+    login (kept in memory only, with conf.relogin), once for all the
+    requests that found it expired.
+
+    One session is shared by all the users of a cookie file, see
+    get_session().
+
+    Required input:
+    ---------------
+    cookiepath: the cookie file (written by login).
+
+    Optional input:
+    ---------------
+    server:     KOA server(s) to log in to (default conf.server);
+
+    debug:      default is no debug written
+    """
+
+    def __init__ (self, cookiepath, **kwargs):
+
+        self.debug = 0
+        if ('debug' in kwargs):
+            self.debug = kwargs.get('debug')
+
+        self.cookiepath = cookiepath
+
+        self.servers = get_servers (conf.server, debug=self.debug)
+        if ('server' in kwargs):
+            self.servers = get_servers (kwargs.get ('server'), \
+                debug=self.debug)
+
+        self.cookiejar = http.cookiejar.MozillaCookieJar (cookiepath)
+        self.mtime = None
+
+        self.userid = ''
+        self.password = ''
+
+#
+#    generation: number of logins, so the requests that found the
+#    session expired trigger a single new login
+#
+        self.generation = 0
+        self.nrelogin = 0
+
+        self.retry = RetryPolicy (debug=self.debug)
+        self.lock = threading.Lock ()
+        return
+
+
+    def cookies (self):
+
+        """
+        Return the shared cookie jar: (re)loaded if the cookie file
+        changed on disk, after a new login if one of its cookies expired.
+        """
+
+        with self.lock:
+            self.__load ()
+            generation = self.generation
+
+            expired = False
+            for cookie in self.cookiejar:
+                if cookie.is_expired ():
+                    expired = True
+
+        if expired:
+            self.relogin (generation)
+
+        return (self.cookiejar)
+
+
+    def login (self, userid, password):
+
+        """
+        Log in to KOA, save the session cookies to the cookie file;
+        raises KoaLoginError if the login fails.
+        """
+
+        with self.lock:
+            msg = self.__login (userid, password)
+        return (msg)
+
+
+    def relogin (self, generation):
+
+        """
+        Log in again, unless another request already did since the
+        session's generation was read; returns True if the session was
+        renewed.
+        """
+
+        with self.lock:
+
+            if (self.generation != generation):
+                return (True)
+
+            if ((not conf.relogin) or (len(self.userid) == 0)):
+                return (False)
+
+            logging.warning ('KOA session expired: logging in again as ' + \
+                self.userid)
+
+            try:
+                self.__login (self.userid, self.password)
+
+            except KoaLoginError as e:
+                logging.warning (str(e))
+                return (False)
+
+            self.nrelogin = self.nrelogin + 1
+
+        return (True)
+
+
+    def __load (self):
+
+#
+#    load the cookie file if it changed since it was last read
+#
+        try:
+            mtime = os.stat (self.cookiepath).st_mtime
+        except OSError:
+            return
+
+        if (mtime == self.mtime):
+            return
+
+        self.cookiejar.load (ignore_discard=True, ignore_expires=True)
+        self.mtime = mtime
+
+        if self.debug:
+            logging.debug ('')
+            logging.debug (f'cookies loaded from {self.cookiepath:s}')
+        return
+
+
+    def __login (self, userid, password):
+
+        param = dict()
+        param['userid'] = userid
+        param['password'] = urllib.parse.quote (password)
+
+        url = self.servers.best () + '/KoaAPI/nph-koaLogin?' + \
+            urllib.parse.urlencode (param)
+
+        try:
+            response = self.servers.request (self.retry, 'GET', url)
+
+            jsondata = json.loads (response.content.decode ('utf-8'))
+
+        except Exception as e:
+            raise KoaLoginError ('Failed to login: ' + loggable_error (e, url))
+
+        status = jsondata.get ('status', '')
+        msg = jsondata.get ('msg', '')
+
+        if (status != 'ok'):
+            raise KoaLoginError ('Failed to login: ' + msg)
+
+        for r in response.history + [response]:
+            for cookie in r.cookies:
+                self.cookiejar.set_cookie (cookie)
+
+        self.cookiejar.save (self.cookiepath, ignore_discard=True)
+        self.mtime = os.stat (self.cookiepath).st_mtime
+
+        self.generation = self.generation + 1
+
+        if conf.relogin:
+            self.userid = userid
+            self.password = password
+
+        if self.debug:
+            logging.debug ('')
+            logging.debug (f'KoaSession: logged in as {userid:s} ' + \
+                f'generation= {self.generation:d}')
+
+        return ('Successfully login as ' + userid)
+
+
+sessions = dict()
+sessions_lock = threading.Lock ()
+
+def get_session (cookiepath, **kwargs):
+
+    """
+    Return the KoaSession shared by all users of the cookie file
+    cookiepath (the server keyword, if given, replaces the session's
+    login server).
+    """
+
+    key = os.path.abspath (cookiepath)
+
+    with sessions_lock:
+
+        if (key not in sessions):
+            sessions[key] = KoaSession (cookiepath, **kwargs)
+
+        elif ('server' in kwargs):
+            sessions[key].servers = get_servers (kwargs.get ('server'))
+
+        return (sessions[key])
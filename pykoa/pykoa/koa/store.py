@@ -0,0 +1,526 @@
+import os
+import time
+import errno
+import hashlib
+import shutil
+import sqlite3
+import logging
+import threading
+
+from . import conf
+
+
+#
+#    Linux FICLONE ioctl: copy-on-write clone (reflink) on btrfs, xfs, ...
+#
+FICLONE = 0x40049409
+
+def clone_file (src, dst, link=True):
+
+    """
+    Make dst a copy of src as cheaply as the file system allows: a hard
+    link, else a reflink (copy-on-write clone), else a plain copy.
+    Returns 'link', 'reflink' or 'copy'.
+
+    link=False: dst must be a file of its own (its permissions can be
+    changed without affecting src), a reflink or a copy.
+    """
+
+    if link:
+        try:
+            os.link (src, dst)
+            return ('link')
+        except OSError as e:
+            if (e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, \
+                errno.ENOTSUP, errno.EACCES)):
+                raise
+
+    try:
+        import fcntl
+
+        with open (src, 'rb') as fsrc, open (dst, 'wb') as fdst:
+            fcntl.ioctl (fdst.fileno(), FICLONE, fsrc.fileno())
+        return ('reflink')
+
+    except (ImportError, OSError):
+        if (os.path.exists (dst)):
+            os.remove (dst)
+
+    shutil.copyfile (src, dst)
+    return ('copy')
+
+
+class FileStore:
+
+    """
+    FileStore class is a local, content-addressed store of KOA files
+    shared by several downloads (teams, pipelines) on the same file
+    system, so each file crosses the network once.
+
+    Files are kept under root/objects/xx/<checksum> (conf.checksum
+    algorithm) and indexed by koaid in a small SQLite database
+    (root/index.sqlite) with their checksum and size.  download() looks a
+    koaid up in the store first and materializes the file into its outdir
+    with a hard link (or a reflink, or a copy across file systems).
+    Downloaded files are added to the store as a reflink or a copy, so
+    the downloaded file itself is left as it is.
+
+    Store objects are made read-only: a file materialized by hard link
+    shares its inode with the store object, so it must not be modified in
+    place.
+
+    The store is bounded: when it grows over max_bytes the least recently
+    used files are evicted, files unused for max_age days are evicted by
+    evict().  Pinned files (pin(), or in use by this process) are never
+    evicted.  Note the space of an evicted file is only released once its
+    hard-linked copies in outdirs are removed too.
+
+    Calling Synopsis (example):
+
+    store = FileStore ('/scratch/koa_store')
+
+    Koa.download (metapath, 'ipac', outdir, store=store)
+
+    Required input:
+    ---------------
+    root:   store directory (created if it doesn't exist).
+
+    Optional input:
+    ---------------
+    max_bytes: maximum size of the store in bytes 
+               (default conf.store_max_bytes; 0: no limit);
+
+    max_age:   files unused for max_age days are evicted
+               (default conf.store_max_age; 0: no limit);
+
+    verify:    lookup checks the checksum of a store object (reading
+               the whole file) before it is reused, not only its size
+               (default False);
+
+    debug:     default is no debug written
+    """
+
+    def __init__ (self, root, **kwargs):
+
+        self.debug = 0
+        if ('debug' in kwargs):
+            self.debug = kwargs.get('debug')
+
+        self.max_bytes = conf.store_max_bytes
+        if ('max_bytes' in kwargs):
+            self.max_bytes = kwargs.get('max_bytes')
+
+        self.max_age = conf.store_max_age
+        if ('max_age' in kwargs):
+            self.max_age = kwargs.get('max_age')
+
+        self.verify = False
+        if ('verify' in kwargs):
+            self.verify = kwargs.get('verify')
+
+        self.root = root
+        self.objdir = os.path.join (root, 'objects')
+        os.makedirs (self.objdir, exist_ok=True)
+
+        self.lock = threading.Lock ()
+        self.inuse = dict()
+
+        self.db = sqlite3.connect (os.path.join (root, 'index.sqlite'), \
+            timeout=60., check_same_thread=False)
+
+#
+#    used: last time the file was stored or materialized (LRU order);
+#    pinned: never evicted
+#
+        with self.lock, self.db:
+            self.db.execute ('create table if not exists files (' + \
+                'koaid text primary key, algorithm text, checksum text, ' + \
+                'size integer, added real, used real, ' + \
+                'pinned integer default 0)')
+
+            columns = [row[1] for row in \
+                self.db.execute ('pragma table_info (files)')]
+
+            if ('used' not in columns):
+                self.db.execute ('alter table files add column used real')
+                self.db.execute ('update files set used = added')
+
+            if ('pinned' not in columns):
+                self.db.execute ('alter table files add column ' + \
+                    'pinned integer default 0')
+
+            self.db.execute ('create index if not exists files_used ' + \
+                'on files (used)')
+            self.db.execute ('create index if not exists files_checksum ' + \
+                'on files (checksum)')
+
+#
+#    the size of the store, kept up to date by put and evict (each object
+#    counted once); computed once for a store created without it
+#
+            self.db.execute ('create table if not exists totals (' + \
+                'name text primary key, value integer)')
+
+            row = self.db.execute ('select value from totals ' + \
+                'where name = ?', ('nbyte',)).fetchone ()
+
+            if (row is None):
+                row = self.db.execute ('select sum (size) from (select ' + \
+                    'max (size) as size from files group by checksum)' \
+                    ).fetchone ()
+                self.db.execute ('insert into totals (name, value) ' + \
+                    'values (?, ?)', ('nbyte', int (row[0] or 0)))
+
+        self.nhit = 0
+        self.nmiss = 0
+        self.nput = 0
+        self.nevict = 0
+        self.nbyte_evicted = 0
+
+        if self.debug:
+            logging.debug ('')
+            logging.debug (f'FileStore: root= {root:s}')
+        return
+
+
+    def object_path (self, checksum):
+
+        return (os.path.join (self.objdir, checksum[0:2], checksum))
+
+
+    def lookup (self, koaid):
+
+        """
+        Return the store object path of koaid, or None if the store has
+        no (valid) copy of it.  An object is valid if it has the size
+        recorded in the index; its checksum is only computed and compared
+        with verify (see FileStore).
+        """
+
+        with self.lock:
+            row = self.db.execute ('select algorithm, checksum, size ' + \
+                'from files where koaid = ?', (koaid,)).fetchone ()
+
+        path = None
+        if (row is not None):
+
+            (algorithm, checksum, size) = row
+            path = self.object_path (checksum)
+
+            try:
+                if (os.stat (path).st_size != size):
+                    path = None
+
+                elif (self.verify and \
+                    (self.__checksum (path, algorithm) != checksum)):
+                    path = None
+
+            except OSError:
+                path = None
+
+        if self.debug:
+            logging.debug ('')
+            logging.debug (f'FileStore.lookup {koaid:s}: {str(path):s}')
+
+        return (path)
+
+
+    def materialize (self, koaid, filepath):
+
+        """
+        Create filepath from the store copy of koaid; returns the method
+        used ('link', 'reflink' or 'copy'), or None on a store miss.
+        """
+
+        self.__use (koaid)
+        try:
+            path = self.lookup (koaid)
+
+            method = None
+            if (path is not None):
+
+                tmppath = filepath + '.part'
+                if (os.path.exists (tmppath)):
+                    os.remove (tmppath)
+
+#
+#    the object may have been evicted by another process since lookup
+#
+                try:
+                    method = clone_file (path, tmppath)
+                    os.replace (tmppath, filepath)
+                except FileNotFoundError:
+                    method = None
+
+            with self.lock, self.db:
+                if (method is None):
+                    self.nmiss = self.nmiss + 1
+                else:
+                    self.nhit = self.nhit + 1
+                    self.db.execute ('update files set used = ? ' + \
+                        'where koaid = ?', (time.time(), koaid))
+        finally:
+            self.__release (koaid)
+
+        if (method is None):
+            return (None)
+
+        if self.debug:
+            logging.debug ('')
+            logging.debug (f'FileStore.materialize {koaid:s}: {method:s}')
+
+        return (method)
+
+
+    def put (self, koaid, filepath, checksum, size, **kwargs):
+
+        """
+        Add the downloaded (verified) filepath to the store as koaid.
+
+        Optional input:
+        ---------------
+        algorithm: checksum algorithm (default conf.checksum)
+        """
+
+        algorithm = conf.checksum
+        if ('algorithm' in kwargs):
+            algorithm = kwargs.get('algorithm')
+
+        path = self.object_path (checksum)
+
+        self.__use (koaid)
+        try:
+            if (not os.path.exists (path)):
+
+                os.makedirs (os.path.dirname (path), exist_ok=True)
+
+                tmppath = path + \
+                    f'.{os.getpid():d}.{threading.get_ident():d}'
+#
+#    an object of its own (not a hard link of filepath): making it
+#    read-only must not change the permissions of the user's file
+#
+                clone_file (filepath, tmppath, link=False)
+                os.chmod (tmppath, 0o444)
+                os.replace (tmppath, path)
+
+            now = time.time()
+            with self.lock, self.db:
+
+                old = self.db.execute ('select checksum, size from files ' + \
+                    'where koaid = ?', (koaid,)).fetchone ()
+
+                nref = self.db.execute ('select count (*) from files ' + \
+                    'where checksum = ?', (checksum,)).fetchone ()[0]
+
+                self.db.execute ('insert into files ' + \
+                    '(koaid, algorithm, checksum, size, added, used) ' + \
+                    'values (?, ?, ?, ?, ?, ?) on conflict (koaid) do ' + \
+                    'update set algorithm = excluded.algorithm, ' + \
+                    'checksum = excluded.checksum, size = excluded.size, ' + \
+                    'used = excluded.used', \
+                    (koaid, algorithm, checksum, size, now, now))
+
+                if (nref == 0):
+                    self.__add_nbyte (size)
+
+#
+#    koaid had another content: its object goes if nothing else uses it
+#
+                if ((old is not None) and (old[0] != checksum)):
+                    self.__unref (old[0], old[1])
+
+                self.nput = self.nput + 1
+
+            if ((self.max_bytes > 0) and (self.nbyte () > self.max_bytes)):
+                self.evict ()
+        finally:
+            self.__release (koaid)
+
+        if self.debug:
+            logging.debug ('')
+            logging.debug (f'FileStore.put {koaid:s}: {path:s}')
+
+        return (path)
+
+
+    def pin (self, koaid, pinned=True):
+
+        """
+        Pin (or unpin) koaid: a pinned file is never evicted.
+        """
+
+        with self.lock, self.db:
+            self.db.execute ('update files set pinned = ? where koaid = ?', \
+                (int (pinned), koaid))
+        return
+
+
+    def unpin (self, koaid):
+
+        self.pin (koaid, False)
+        return
+
+
+    def nbyte (self):
+
+        """
+        Size of the store in bytes (each object counted once).
+        """
+
+        with self.lock:
+            row = self.db.execute ('select value from totals ' + \
+                'where name = ?', ('nbyte',)).fetchone ()
+
+        return (int (row[0]))
+
+
+    def evict (self, **kwargs):
+
+        """
+        Evict the files unused for max_age days, then the least recently
+        used files until the store fits in max_bytes; pinned files and
+        files in use are kept.  Returns the number of files evicted.
+
+        Optional input:
+        ---------------
+        max_bytes, max_age: override the store's limits for this call
+        """
+
+        max_bytes = self.max_bytes
+        if ('max_bytes' in kwargs):
+            max_bytes = kwargs.get('max_bytes')
+
+        max_age = self.max_age
+        if ('max_age' in kwargs):
+            max_age = kwargs.get('max_age')
+
+        nbyte = self.nbyte ()
+        oldest = time.time() - max_age*86400.
+
+        with self.lock:
+            rows = self.db.execute ('select koaid, checksum, size, used ' + \
+                'from files where pinned = 0 order by used').fetchall ()
+
+        nevict = 0
+        for (koaid, checksum, size, used) in rows:
+
+            old = ((max_age > 0) and (used < oldest))
+            over = ((max_bytes > 0) and (nbyte > max_bytes))
+
+            if ((not old) and (not over)):
+                break
+
+            with self.lock, self.db:
+
+                if (koaid in self.inuse):
+                    continue
+
+                self.db.execute ('delete from files where koaid = ?', \
+                    (koaid,))
+
+                if self.__unref (checksum, size):
+                    nbyte = nbyte - size
+                    self.nbyte_evicted = self.nbyte_evicted + size
+
+                self.nevict = self.nevict + 1
+                nevict = nevict + 1
+
+            if self.debug:
+                logging.debug ('')
+                logging.debug (f'FileStore.evict {koaid:s}')
+
+        return (nevict)
+
+
+    def stats (self):
+
+        """
+        Store statistics: number of files and bytes, limits, and this 
+        session's hits, misses, additions and evictions.
+        """
+
+        with self.lock:
+            nfile = self.db.execute ( \
+                'select count (*) from files').fetchone ()[0]
+
+        stats = dict()
+        stats['nfile'] = nfile
+        stats['nbyte'] = self.nbyte ()
+        stats['max_bytes'] = self.max_bytes
+        stats['max_age'] = self.max_age
+        stats['nhit'] = self.nhit
+        stats['nmiss'] = self.nmiss
+        stats['nput'] = self.nput
+        stats['nevict'] = self.nevict
+        stats['nbyte_evicted'] = self.nbyte_evicted
+        return (stats)
+
+
+    def __add_nbyte (self, nbyte):
+
+#
+#    called in the transaction changing the files
+#
+        self.db.execute ('update totals set value = value + ? ' + \
+            'where name = ?', (nbyte, 'nbyte'))
+        return
+
+
+    def __unref (self, checksum, size):
+
+#
+#    remove the object of checksum once no koaid refers to it (called in
+#    the transaction removing the reference); returns True if it was
+#    removed
+#
+        nref = self.db.execute ('select count (*) from files ' + \
+            'where checksum = ?', (checksum,)).fetchone ()[0]
+
+        if (nref > 0):
+            return (False)
+
+        try:
+            os.remove (self.object_path (checksum))
+        except FileNotFoundError:
+            pass
+
+        self.__add_nbyte (-size)
+        return (True)
+
+
+    def __checksum (self, path, algorithm):
+
+        h = hashlib.new (algorithm)
+
+        with open (path, 'rb') as fp:
+            while True:
+                data = fp.read (1048576)
+                if (len(data) == 0):
+                    break
+                h.update (data)
+
+        return (h.hexdigest())
+
+
+    def __use (self, koaid):
+
+        with self.lock:
+            self.inuse[koaid] = self.inuse.get (koaid, 0) + 1
+        return
+
+
+    def __release (self, koaid):
+
+        with self.lock:
+            self.inuse[koaid] = self.inuse[koaid] - 1
+            if (self.inuse[koaid] == 0):
+                del self.inuse[koaid]
+        return
+
+
+    def close (self):
+
+        with self.lock:
+            self.db.close ()
+        return
@@ -0,0 +1,383 @@
+import time
+import logging
+import threading
+import contextlib
+import urllib.parse
+
+from . import conf
+
+
+#
+#    rate of a paused window
+#
+PAUSE = -1.
+
+def parse_rate (value):
+
+    """
+    Bytes per second of a rate given as a number or a string with an
+    optional K, M or G (decimal) suffix, e.g. '10M'; 'pause' is PAUSE,
+    0 means no limit.
+    """
+
+    if (not isinstance (value, str)):
+        return (float (value))
+
+    value = value.strip().upper()
+
+    if (value == 'PAUSE'):
+        return (PAUSE)
+
+    scale = 1.
+    if ((len(value) > 0) and (value[-1] in 'KMG')):
+        scale = {'K': 1.e3, 'M': 1.e6, 'G': 1.e9}[value[-1]]
+        value = value[0:-1]
+
+    return (float (value) * scale)
+
+
+def parse_schedule (schedule):
+
+    """
+    Parse a time-of-day schedule: comma separated 'HH:MM-HH:MM=rate'
+    windows (local time; a window may span midnight), e.g.
+
+        '08:00-20:00=2M, 20:00-08:00=0'
+
+    Returns a list of (start, end, rate) with start and end in minutes.
+    """
+
+    windows = []
+
+    for entry in schedule.split (','):
+
+        entry = entry.strip()
+        if (len(entry) == 0):
+            continue
+
+        try:
+            (span, rate) = entry.split ('=')
+            (start, end) = span.split ('-')
+
+            minutes = []
+            for hhmm in (start, end):
+                (hh, mm) = hhmm.strip().split (':')
+                minutes.append (int(hh)*60 + int(mm))
+
+            windows.append ((minutes[0], minutes[1], parse_rate (rate)))
+
+        except ValueError:
+            raise Exception (f'Invalid bandwidth schedule entry: {entry:s}')
+
+    return (windows)
+
+
+class TokenBucket:
+
+    """
+    TokenBucket class limits a byte rate: consume(n) blocks until the n
+    bytes fit in the rate.  The bucket holds at most one second of
+    tokens (burst); a chunk larger than the tokens available is taken on
+    credit and the caller waits until the debt is repaid, so the average
+    rate holds whatever the chunk size.
+
+    rate <= 0: no limit.
+    """
+
+    def __init__ (self, rate):
+
+        self.rate = float (rate)
+        self.tokens = max (0., self.rate)
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock ()
+        return
+
+
+    def set_rate (self, rate):
+
+        with self.lock:
+            self.rate = float (rate)
+            self.tokens = min (self.tokens, max (0., self.rate))
+        return
+
+
+    def consume (self, nbyte):
+
+        with self.lock:
+
+            if (self.rate <= 0.):
+                return
+
+            now = time.monotonic()
+            self.tokens = min (self.rate, \
+                self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+
+            self.tokens = self.tokens - nbyte
+
+            wait = 0.
+            if (self.tokens < 0.):
+                wait = -self.tokens / self.rate
+
+        if (wait > 0.):
+            time.sleep (wait)
+        return
+
+
+class HostSlots:
+
+#
+#    the connection slots of one host: a counting semaphore whose limit
+#    can change while slots are held (the slots held are kept, new
+#    acquisitions wait until the count is below the new limit)
+#
+    def __init__ (self, limit):
+
+        self.limit = limit
+        self.nheld = 0
+        self.cond = threading.Condition ()
+        return
+
+
+    def resize (self, limit):
+
+        with self.cond:
+            if (limit != self.limit):
+                self.limit = limit
+                self.cond.notify_all ()
+        return
+
+
+    def acquire (self):
+
+        with self.cond:
+            while (self.nheld >= self.limit):
+                self.cond.wait ()
+            self.nheld = self.nheld + 1
+        return
+
+
+    def release (self):
+
+        with self.cond:
+            self.nheld = self.nheld - 1
+            self.cond.notify ()
+        return
+
+
+host_slots = dict()
+host_slots_lock = threading.Lock ()
+
+@contextlib.contextmanager
+def host_slot (url, limit=None):
+
+    """
+    Context manager holding one of the conf.max_per_host connection
+    slots of url's host (no limit when max_per_host is 0).
+    """
+
+    if (limit is None):
+        limit = conf.max_per_host
+
+    if (limit <= 0):
+        yield
+        return
+
+    host = urllib.parse.urlsplit (url).netloc
+
+    with host_slots_lock:
+
+        if (host not in host_slots):
+            host_slots[host] = HostSlots (limit)
+
+        slots = host_slots[host]
+
+    slots.resize (limit)
+
+    slots.acquire ()
+    try:
+        yield
+    finally:
+        slots.release ()
+    return
+
+
+class Throttle:
+
+    """
+    Throttle class limits the bandwidth of the download workers: a global
+    token bucket shared by all workers (of all the downloads of the
+    process with the same limits, see get_throttle), a per-worker bucket,
+    and an optional time-of-day schedule replacing the global rate in its
+    windows, e.g. full speed at night, throttled during the day:
+
+        Throttle (schedule='08:00-20:00=2M')
+
+    A window rate of 'pause' stops new downloads until the window ends
+    (files in progress complete at the base rate).
+
+    Optional input:
+    ---------------
+    bandwidth:        global limit, bytes/s (default conf.bandwidth;
+                      0: no limit);
+
+    worker_bandwidth: limit per worker thread, bytes/s
+                      (default conf.worker_bandwidth; 0: no limit);
+
+    schedule:         time-of-day windows, see parse_schedule
+                      (default conf.bandwidth_schedule);
+
+    debug:            default is no debug written
+    """
+
+    def __init__ (self, **kwargs):
+
+        self.debug = 0
+        if ('debug' in kwargs):
+            self.debug = kwargs.get('debug')
+
+        self.bandwidth = parse_rate (conf.bandwidth)
+        if ('bandwidth' in kwargs):
+            self.bandwidth = parse_rate (kwargs.get('bandwidth'))
+
+        self.worker_bandwidth = parse_rate (conf.worker_bandwidth)
+        if ('worker_bandwidth' in kwargs):
+            self.worker_bandwidth = parse_rate (kwargs.get('worker_bandwidth'))
+
+        schedule = conf.bandwidth_schedule
+        if ('schedule' in kwargs):
+            schedule = kwargs.get('schedule')
+
+        self.windows = parse_schedule (schedule)
+
+        self.bucket = TokenBucket (self.bandwidth)
+        self.workers = threading.local ()
+
+        self.rate = self.bandwidth
+        self.checked = 0.
+
+        if self.debug:
+            logging.debug ('')
+            logging.debug (f'Throttle: bandwidth= {self.bandwidth:.0f} ' + \
+                f'worker_bandwidth= {self.worker_bandwidth:.0f} ' + \
+                f'windows= {str(self.windows):s}')
+        return
+
+
+    def active (self):
+
+        return ((self.bandwidth > 0.) or (self.worker_bandwidth > 0.) or \
+            (len(self.windows) > 0))
+
+
+    def current_rate (self):
+
+        """
+        Global rate at the current local time (PAUSE in a paused window);
+        the schedule is evaluated at most once a second.
+        """
+
+        now = time.monotonic()
+        if (now - self.checked < 1.):
+            return (self.rate)
+
+        self.checked = now
+
+        t = time.localtime()
+        minute = t.tm_hour*60 + t.tm_min
+
+        rate = self.bandwidth
+        for (start, end, window_rate) in self.windows:
+
+            if (start <= end):
+                inside = ((minute >= start) and (minute < end))
+            else:
+                inside = ((minute >= start) or (minute < end))
+
+            if inside:
+                rate = window_rate
+                break
+
+        if (rate != self.rate):
+
+            if self.debug:
+                logging.debug ('')
+                logging.debug (f'Throttle: rate {rate:.0f}')
+
+            self.rate = rate
+            if (rate != PAUSE):
+                self.bucket.set_rate (rate)
+
+        return (self.rate)
+
+
+    def wait_window (self, cancel=None):
+
+        """
+        Block while the schedule pauses the downloads; cancel is a
+        threading.Event aborting the wait when set.
+        """
+
+        while (self.current_rate () == PAUSE):
+
+            wait = min (60., 1. + 60. - time.localtime().tm_sec)
+
+            if (cancel is None):
+                time.sleep (wait)
+
+            elif cancel.wait (wait):
+                raise Exception ('cancelled')
+        return
+
+
+    def consume (self, nbyte):
+
+        """
+        Account for nbyte received by the calling worker; blocks as long
+        as needed to keep to the limits.
+        """
+
+        rate = self.current_rate ()
+
+        if (rate == PAUSE):
+            rate = self.bandwidth
+
+        if (rate != self.bucket.rate):
+            self.bucket.set_rate (rate)
+
+        self.bucket.consume (nbyte)
+
+        if (self.worker_bandwidth > 0.):
+
+            bucket = getattr (self.workers, 'bucket', None)
+            if (bucket is None):
+                bucket = TokenBucket (self.worker_bandwidth)
+                self.workers.bucket = bucket
+
+            bucket.consume (nbyte)
+        return
+
+
+throttles = dict()
+throttles_lock = threading.Lock ()
+
+def get_throttle (**kwargs):
+
+    """
+    Return the Throttle (same input) shared by all the downloads of the
+    process with the same limits: concurrent downloads, of one or
+    several Archive instances, draw from one global bucket, so the 
+    bandwidth limit holds for the process, not for each download.
+    """
+
+    throttle = Throttle (**kwargs)
+
+    key = (throttle.bandwidth, throttle.worker_bandwidth, \
+        tuple (throttle.windows))
+
+    with throttles_lock:
+
+        if (key not in throttles):
+            throttles[key] = throttle
+
+        return (throttles[key])
@@ -0,0 +1,1002 @@
+import io
+import os
+import base64
+import hashlib
+import time
+import logging
+import queue
+import threading
+
+from . import conf
+
+
+class StreamVerifier:
+
+    """
+    StreamVerifier class checks the integrity of a downloaded file while
+    it is being streamed to disk: the data is fed to the verifier chunk by
+    chunk so the file never needs to be read back.
+
+    The following checks are made when the stream is finished:
+
+        size:      the number of bytes received matches the Content-Length
+                   returned by the server;
+
+        checksum:  the local checksum (conf.checksum, default sha256) is
+                   computed for every file; when the server provides a
+                   Content-MD5, Digest or Repr-Digest header, the matching
+                   digest is computed as well and compared;
+
+        FITS:      for '.fits' files, the data starts with a 'SIMPLE  ='
+                   card, the primary header contains an END card and the
+                   file size is a multiple of 2880 bytes.
+
+    Calling Synopsis (example):
+
+    verifier = StreamVerifier (filepath, response.headers)
+
+    for chunk in response.iter_content (chunk_size):
+        fp.write (chunk)
+        verifier.update (chunk)
+
+    result = verifier.verify()
+
+    result is a dictionary:
+
+        status (ok/error), msg, size, algorithm, checksum
+    """
+
+    fits_block = 2880
+    fits_card = 80
+
+#
+#    give up looking for the END card after this many header blocks
+#
+    fits_maxblock = 1000
+
+    def __init__ (self, filepath, headers, **kwargs):
+
+        self.debug = 0
+        if ('debug' in kwargs):
+            self.debug = kwargs.get('debug')
+
+        self.filepath = filepath
+        self.size = 0
+
+        self.algorithm = conf.checksum
+        if ('algorithm' in kwargs):
+            self.algorithm = kwargs.get('algorithm')
+
+        self.hash = hashlib.new (self.algorithm)
+
+        if (headers is None):
+            headers = dict()
+
+        self.content_type = headers.get ('Content-type', '')
+        if (self.content_type is None):
+            self.content_type = ''
+
+        self.content_length = -1
+        try:
+            self.content_length = int (headers.get ('Content-Length', -1))
+        except Exception:
+            pass
+
+#
+#    content-encoding (e.g. gzip) makes Content-Length refer to the
+#    encoded body, don't compare it with the decoded size
+#
+        encoding = headers.get ('Content-Encoding', 'identity')
+        if ((encoding is not None) and (encoding.lower() != 'identity')):
+            self.content_length = -1
+
+#
+#    server provided digests: algorithm -> expected digest (bytes)
+#
+        self.expected = self.__server_digests (headers)
+
+        self.server_hash = dict()
+        for alg in self.expected:
+            if (alg != self.algorithm):
+                self.server_hash[alg] = hashlib.new (alg)
+
+        self.fits = filepath.lower().endswith ('.fits')
+        self.header = bytearray()
+        self.header_done = False
+        self.header_msg = ''
+        self.ncard = 0
+
+        if self.debug:
+            logging.debug ('')
+            logging.debug ('Enter StreamVerifier.init:')
+            logging.debug (f'filepath= {self.filepath:s}')
+            logging.debug (f'content_length= {self.content_length:d}')
+            logging.debug (f'expected digests= {str(list(self.expected)):s}')
+
+        return
+
+
+    def update (self, data):
+
+        self.size = self.size + len(data)
+        self.hash.update (data)
+
+        for h in self.server_hash.values():
+            h.update (data)
+
+        if (self.fits and not self.header_done):
+            self.__scan_header (data)
+
+        return
+
+
+    def verify (self):
+
+        result = dict()
+        result['path'] = self.filepath
+        result['size'] = self.size
+        result['algorithm'] = self.algorithm
+        result['checksum'] = self.hash.hexdigest()
+        result['status'] = 'ok'
+        result['msg'] = ''
+
+        msg = ''
+        if ((self.content_length >= 0) and \
+            (self.size != self.content_length)):
+            msg = f'size mismatch: {self.size:d} bytes received, ' + \
+                f'{self.content_length:d} expected'
+
+        if (len(msg) == 0):
+
+            for alg, digest in self.expected.items():
+
+                if (alg == self.algorithm):
+                    received = self.hash.digest()
+                else:
+                    received = self.server_hash[alg].digest()
+
+                if (received != digest):
+                    msg = f'{alg:s} checksum mismatch'
+                    break
+
+        if ((len(msg) == 0) and self.fits):
+
+            if (self.content_type.lower().startswith ('text/html')):
+                msg = 'HTML page returned instead of FITS data'
+            elif (len(self.header_msg) > 0):
+                msg = self.header_msg
+            elif (not self.header_done):
+                msg = 'FITS END card not found'
+            elif ((self.size % self.fits_block) != 0):
+                msg = 'FITS size is not a multiple of 2880 bytes'
+
+        if (len(msg) > 0):
+            result['status'] = 'error'
+            result['msg'] = 'Verification failed: ' + msg
+
+        if self.debug:
+            logging.debug ('')
+            logging.debug ('StreamVerifier.verify:')
+            logging.debug (result)
+
+        return (result)
+
+
+    def __scan_header (self, data):
+
+#
+#    collect the primary header card by card until the END card
+#
+        need = self.fits_block * self.fits_maxblock - len(self.header)
+        self.header.extend (memoryview(data)[:need])
+
+        if (len(self.header) >= self.fits_card and \
+            not self.header.startswith (b'SIMPLE  =')):
+            self.header_msg = 'data does not start with a FITS SIMPLE card'
+            self.header_done = True
+            return
+
+        ncard = len(self.header) // self.fits_card
+        for i in range (self.ncard, ncard):
+
+            card = self.header[i*self.fits_card:(i+1)*self.fits_card]
+
+            if (card[0:3] == b'END' and card[3:].strip() == b''):
+                self.header_done = True
+                self.header = bytearray()
+                return
+
+        self.ncard = ncard
+
+        if (len(self.header) >= self.fits_block * self.fits_maxblock):
+            self.header_msg = 'FITS END card not found'
+            self.header_done = True
+
+        return
+
+
+    def __server_digests (self, headers):
+
+        expected = dict()
+
+        md5 = headers.get ('Content-MD5')
+        if (md5 is not None):
+            try:
+                expected['md5'] = base64.b64decode (md5.strip())
+            except Exception:
+                pass
+
+#
+#    Digest: md5=<b64>, sha-256=<b64>  (RFC 3230)
+#    Repr-Digest: sha-256=:<b64>:      (RFC 9530)
+#
+        names = {'md5': 'md5', 'sha': 'sha1', 'sha-256': 'sha256', \
+            'sha-512': 'sha512'}
+
+        for key in ('Digest', 'Repr-Digest'):
+
+            value = headers.get (key)
+            if (value is None):
+                continue
+
+            for item in value.split (','):
+
+                ind = item.find ('=')
+                if (ind < 0):
+                    continue
+
+                alg = names.get (item[0:ind].strip().lower())
+                if (alg is None):
+                    continue
+
+                try:
+                    expected[alg] = base64.b64decode ( \
+                        item[ind+1:].strip().strip (':'))
+                except Exception:
+                    pass
+
+        return (expected)
+
+
+buffers = threading.local ()
+
+def get_buffer (size):
+
+    """
+    Return a (thread local) reusable bytearray of at least size bytes;
+    the same buffer is handed out to every download on the thread so no
+    per-chunk allocation takes place.
+    """
+
+    buf = getattr (buffers, 'buf', None)
+
+    if ((buf is None) or (len(buf) < size)):
+        buf = bytearray (size)
+        buffers.buf = buf
+
+    return (buf)
+
+
+def preallocate (fd, length):
+
+    """
+    Reserve length bytes for the open file fd (posix_fallocate where
+    available) so the file system can lay out the file contiguously;
+    errors (e.g. unsupported file system) are ignored.
+    """
+
+    if (length <= 0):
+        return
+
+    if (not hasattr (os, 'posix_fallocate')):
+        return
+
+    try:
+        os.posix_fallocate (fd, 0, length)
+    except OSError:
+        pass
+
+    return
+
+
+def write_all (fd, view):
+
+    nbyte = len(view)
+    nwritten = 0
+    while (nwritten < nbyte):
+        nwritten = nwritten + os.write (fd, view[nwritten:])
+
+    return
+
+
+def get_reader (response):
+
+    """
+    Return a readinto function reading the response body into a
+    caller-provided buffer, or None if the body can only be iterated.
+
+    The body is read through urllib3's readinto (or read), which returns
+    the connection to the pool once the body is complete.  Bodies with a
+    Content-Encoding are decoded by urllib3: use iter_content for those.
+    The body must not have been read already (e.g. response.text).
+    """
+
+    encoding = response.headers.get ('Content-Encoding', 'identity')
+    if ((encoding is not None) and (encoding.lower() != 'identity')):
+        return (None)
+
+    raw = response.raw
+
+    if hasattr (raw, 'readinto'):
+        return (raw.readinto)
+
+    if (not hasattr (raw, 'read')):
+        return (None)
+
+    def readinto (view):
+
+        data = raw.read (len(view))
+        view[0:len(data)] = data
+        return (len(data))
+
+    return (readinto)
+
+
+class WriteHandle:
+
+    """
+    WriteHandle class is the network side of one file being written by
+    a DiskWriter: the reader takes a free buffer (get_buffer), fills it
+    and queues it (put); close() waits until the writer thread has
+    written (and verified) everything queued.
+    """
+
+    def __init__ (self, writer, queue, fd, verifier):
+
+        self.writer = writer
+        self.queue = queue
+        self.fd = fd
+        self.verifier = verifier
+
+        self.error = None
+        self.done = threading.Event ()
+        return
+
+
+    def get_buffer (self):
+
+        if (self.error is not None):
+            raise self.error
+
+        return (self.writer.pool.get ())
+
+
+    def put (self, buf, nbyte, pooled=True):
+
+        if (self.error is not None):
+            
+            if pooled:
+                self.writer.pool.put (buf)
+            raise self.error
+
+        self.queue.put (('write', self, buf, nbyte, pooled))
+        return
+
+
+    def release (self, buf):
+
+        self.writer.pool.put (buf)
+        return
+
+
+    def close (self, truncate=-1):
+
+        """
+        Flush the queued buffers, trim the file to truncate bytes (if
+        >= 0) and close it; raises the first write error.
+        """
+
+        self.queue.put (('close', self, truncate, 0, False))
+        self.done.wait ()
+
+        if (self.error is not None):
+            raise self.error
+        return
+
+
+class DiskWriter:
+
+    """
+    DiskWriter class is a write-behind stage decoupling network reads
+    from disk writes: readers fill buffers from a shared pool and queue
+    them to dedicated disk writer threads, which write them (and feed
+    the StreamVerifier) while the reader is already receiving the next
+    buffer.  A slow file system (Lustre/NFS) then no longer stalls the
+    socket, and throughput is max(network, disk) rather than the two
+    serialized.
+
+    Memory is bounded: nbuffer buffers of chunk_size bytes are shared by
+    all files; a reader blocks when they are all queued for writing.
+    All chunks of one file go to the same writer thread, so they are
+    written in order.
+
+    One DiskWriter is shared by the process, see get_writer().
+
+    Optional input:
+    ---------------
+    nwriter:    number of disk writer threads (default conf.nwriter);
+
+    nbuffer:    number of buffers in the pool (default conf.nbuffer);
+
+    chunk_size: buffer size (default conf.chunk_size)
+    """
+
+    def __init__ (self, **kwargs):
+
+        self.nwriter = max (1, conf.nwriter)
+        if ('nwriter' in kwargs):
+            self.nwriter = max (1, kwargs.get('nwriter'))
+
+        self.nbuffer = max (2, conf.nbuffer)
+        if ('nbuffer' in kwargs):
+            self.nbuffer = max (2, kwargs.get('nbuffer'))
+
+        self.chunk_size = conf.chunk_size
+        if ('chunk_size' in kwargs):
+            self.chunk_size = kwargs.get('chunk_size')
+
+        self.pool = queue.Queue ()
+        for i in range (0, self.nbuffer):
+            self.pool.put (bytearray (self.chunk_size))
+
+        self.queues = []
+        self.threads = []
+        for i in range (0, self.nwriter):
+
+            q = queue.Queue (maxsize=self.nbuffer)
+            t = threading.Thread (target=self.__run, args=(q,), \
+                name=f'koa-writer-{i:d}', daemon=True)
+            t.start ()
+
+            self.queues.append (q)
+            self.threads.append (t)
+
+        self.nopen = 0
+        self.lock = threading.Lock ()
+        return
+
+
+    def open (self, fd, verifier, length=-1):
+
+        """
+        Return a WriteHandle writing to the open file descriptor fd; the
+        file is preallocated to length bytes by the writer thread.
+        """
+
+        with self.lock:
+            q = self.queues[self.nopen % self.nwriter]
+            self.nopen = self.nopen + 1
+
+        handle = WriteHandle (self, q, fd, verifier)
+
+        if (length > 0):
+            q.put (('prealloc', handle, length, 0, False))
+
+        return (handle)
+
+
+    def __run (self, q):
+
+        while True:
+
+            (op, handle, arg, nbyte, pooled) = q.get ()
+
+            try:
+                if (handle.error is not None):
+                    pass
+
+                elif (op == 'write'):
+                    view = memoryview (arg)[:nbyte]
+                    write_all (handle.fd, view)
+                    handle.verifier.update (view)
+                    view.release ()
+
+                elif (op == 'prealloc'):
+                    preallocate (handle.fd, arg)
+
+                elif (op == 'close'):
+                    if (arg >= 0):
+                        os.ftruncate (handle.fd, arg)
+
+            except Exception as e:
+                handle.error = e
+
+            if pooled:
+                self.pool.put (arg)
+
+            if (op == 'close'):
+                handle.done.set ()
+
+        return
+
+
+class StallDetector:
+
+    """
+    StallDetector class aborts a transfer whose throughput stays below
+    min_rate (bytes/s) for a whole window of seconds: update(nbyte) is
+    called for every chunk received and raises an exception when the
+    transfer is found stalled.  Time spent waiting on a Throttle is
+    excluded (see exclude), so a throttled download is not taken for a
+    stalled one.
+
+    A socket receiving nothing at all never returns from its read; the
+    read timeout of the request (conf.stall_time) covers that case.
+    """
+
+    def __init__ (self, min_rate, window):
+
+        self.min_rate = float (min_rate)
+        self.window = float (window)
+
+        self.start = time.monotonic()
+        self.nbyte = 0
+        self.mark = 0
+        return
+
+
+    def active (self):
+
+        return ((self.min_rate > 0.) and (self.window > 0.))
+
+
+    def exclude (self, seconds):
+
+        self.start = self.start + seconds
+        return
+
+
+    def update (self, nbyte):
+
+        self.nbyte = self.nbyte + nbyte
+
+        now = time.monotonic()
+        elapsed = now - self.start
+        if (elapsed < self.window):
+            return
+
+        rate = (self.nbyte - self.mark) / elapsed
+        if (rate < self.min_rate):
+            raise Exception (f'stalled: {rate:.0f} bytes/s over the last ' + \
+                f'{elapsed:.0f} seconds')
+
+        self.start = now
+        self.mark = self.nbyte
+        return
+
+
+#
+#    largest read made between two stall checks
+#
+stall_step = 65536
+
+writer = None
+writer_lock = threading.Lock ()
+
+def get_writer ():
+
+    """
+    Return the process-wide DiskWriter (created on first use), or None
+    when the write-behind stage is disabled (conf.nwriter = 0).
+    """
+
+    global writer
+
+    if (conf.nwriter <= 0):
+        return (None)
+
+    with writer_lock:
+        if (writer is None):
+            writer = DiskWriter ()
+
+    return (writer)
+
+
+def stream_to_file (response, filepath, **kwargs):
+
+    """
+    stream_to_file writes a streamed requests response to filepath while
+    verifying it (see StreamVerifier).
+
+    The body is read with readinto into fixed size buffers and handed to
+    the write-behind DiskWriter (see get_writer), so disk writes and
+    checksums run on the writer threads while the next buffer is being
+    received.  With conf.nwriter = 0 the data is written inline from a
+    reusable per-thread buffer.  No per-chunk bytes object is allocated
+    in either case; the output file is preallocated from the
+    Content-Length.
+
+    The data is written to a temporary 'filepath.part' file which is
+    renamed to filepath only when the verification succeeds, so a
+    truncated or corrupted download never appears under its final name.
+
+    A transfer slower than conf.stall_rate over conf.stall_time seconds
+    is aborted (see StallDetector).  With keep_part, the data received by
+    a failed transfer is kept in the part file: result['partial'] is its
+    size and result['headers'] the headers it was verified against, so
+    the caller can request the rest with a Range request and resume
+    with offset=partial, headers=result['headers'].
+
+    Required input:
+    ---------------
+    response: a requests response opened with stream=True;
+
+    filepath: output file path.
+
+    Optional input:
+    ---------------
+    chunk_size: read buffer size for the inline path (default 
+                conf.chunk_size; the DiskWriter has its own buffers);
+
+    writer:     a DiskWriter, or None to write inline (default 
+                get_writer());
+
+    throttle:   a Throttle limiting the read rate (default: none);
+
+    partpath:   temporary file (default filepath + '.part');
+
+    offset:     resume a transfer: response holds the data from offset
+                on, the first offset bytes are in partpath (default 0);
+
+    headers:    headers of the complete (status 200) response, used to
+                verify a resumed transfer (default response.headers);
+
+    keep_part:  keep the data received by a failed transfer (default 
+                False);
+
+    cancel:     a threading.Event aborting the transfer when set;
+
+    stall_rate, 
+    stall_time: stall detection (default conf.stall_rate and 
+                conf.stall_time; 0: no check);
+
+    debug:      default is no debug written
+
+    Returns the verification result dictionary (see StreamVerifier).
+    """
+
+    debug = 0
+    if ('debug' in kwargs):
+        debug = kwargs.get('debug')
+
+    chunk_size = conf.chunk_size
+    if ('chunk_size' in kwargs):
+        chunk_size = kwargs.get('chunk_size')
+
+    if ('writer' in kwargs):
+        diskwriter = kwargs.get('writer')
+    else:
+        diskwriter = get_writer ()
+
+    throttle = None
+    if ('throttle' in kwargs):
+        throttle = kwargs.get('throttle')
+
+    partpath = filepath + '.part'
+    if ('partpath' in kwargs):
+        partpath = kwargs.get('partpath')
+
+    offset = 0
+    if ('offset' in kwargs):
+        offset = kwargs.get('offset')
+
+    headers = response.headers
+    if (kwargs.get('headers') is not None):
+        headers = kwargs.get('headers')
+
+    keep_part = False
+    if ('keep_part' in kwargs):
+        keep_part = kwargs.get('keep_part')
+
+    cancel = None
+    if ('cancel' in kwargs):
+        cancel = kwargs.get('cancel')
+
+    stall_rate = conf.stall_rate
+    if ('stall_rate' in kwargs):
+        stall_rate = kwargs.get('stall_rate')
+
+    stall_time = conf.stall_time
+    if ('stall_time' in kwargs):
+        stall_time = kwargs.get('stall_time')
+
+    stall = StallDetector (stall_rate, stall_time)
+
+    verifier = StreamVerifier (filepath, headers, debug=debug)
+
+    readinto = get_reader (response)
+
+    if debug:
+        logging.debug ('')
+        logging.debug (f'stream_to_file: chunk_size= {chunk_size:d}')
+        logging.debug (f'readinto: {str(readinto is not None):s}')
+        logging.debug (f'write-behind: {str(diskwriter is not None):s}')
+        logging.debug (f'offset= {offset:d}')
+
+#
+#    after each chunk: throttle (not counted as stalled time), stall
+#    check, cancellation
+#
+    def received (nbyte):
+
+        if (throttle is not None):
+            t = time.monotonic()
+            throttle.consume (nbyte)
+            stall.exclude (time.monotonic() - t)
+
+        if stall.active ():
+            stall.update (nbyte)
+
+        if ((cancel is not None) and cancel.is_set()):
+            raise Exception ('cancelled')
+        return
+
+#
+#    readinto blocks until the buffer is full: with stall detection or
+#    cancellation, a buffer is filled in steps of at most stall_step
+#    bytes so a slow stream is checked while the buffer fills.  Returns
+#    the number of bytes read and the exception that interrupted the
+#    read, if any: the data read before it is still written (and can be
+#    resumed from).
+#
+    step = chunk_size
+    if (stall.active () or (cancel is not None)):
+        step = stall_step
+
+    def fill (view):
+
+        nfill = 0
+        try:
+            while (nfill < len(view)):
+
+                nread = readinto (view[nfill:nfill+step])
+                if (nread == 0):
+                    break
+
+                nfill = nfill + nread
+                received (nread)
+
+        except Exception as e:
+            return (nfill, e)
+
+        return (nfill, None)
+
+    fd = -1
+    handle = None
+    try:
+        if (offset > 0):
+#
+#    resume: the verifier is fed the data already received
+#
+            fd = os.open (partpath, os.O_RDWR)
+
+            nleft = offset
+            while (nleft > 0):
+                data = os.read (fd, min (nleft, chunk_size))
+                if (len(data) == 0):
+                    raise Exception (f'{partpath:s} is shorter than ' + \
+                        f'{offset:d} bytes')
+                verifier.update (data)
+                nleft = nleft - len(data)
+
+            os.lseek (fd, offset, os.SEEK_SET)
+        else:
+            fd = os.open (partpath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, \
+                0o644)
+
+        if (diskwriter is not None):
+            handle = diskwriter.open (fd, verifier, verifier.content_length)
+        else:
+            preallocate (fd, verifier.content_length)
+
+        if ((readinto is not None) and (handle is not None)):
+
+            while True:
+
+                buf = handle.get_buffer ()
+                (nread, error) = fill (memoryview (buf))
+
+                if (nread == 0):
+                    handle.release (buf)
+                else:
+                    handle.put (buf, nread)
+
+                if (error is not None):
+                    raise error
+
+                if (nread == 0):
+                    break
+
+        elif (readinto is not None):
+
+            buf = get_buffer (chunk_size)
+            view = memoryview (buf)[:chunk_size]
+
+            while True:
+
+                (nread, error) = fill (view)
+
+                chunk = view[:nread]
+                write_all (fd, chunk)
+                verifier.update (chunk)
+
+                if (error is not None):
+                    raise error
+
+                if (nread == 0):
+                    break
+        else:
+            for chunk in response.iter_content (chunk_size=chunk_size):
+
+                if (handle is not None):
+                    handle.put (chunk, len(chunk), pooled=False)
+                else:
+                    write_all (fd, chunk)
+                    verifier.update (chunk)
+
+                received (len(chunk))
+
+#
+#    wait for the writer; a file preallocated beyond the received data
+#    (short body) is trimmed
+#
+        if (handle is not None):
+            handle.close ()
+            handle = None
+
+        if (verifier.size < verifier.content_length):
+            os.ftruncate (fd, verifier.size)
+
+        os.close (fd)
+        fd = -1
+
+    except Exception as e:
+
+        if debug:
+            logging.debug ('')
+            logging.debug (f'stream_to_file exception: {str(e):s}')
+
+        if (handle is not None):
+            try:
+                handle.close ()
+            except Exception:
+                pass
+
+#
+#    keep what was received (trimmed to the data actually written) so the
+#    transfer can be resumed; a cancelled transfer is not resumed
+#
+        keep = (keep_part and (verifier.size > 0) and \
+            not ((cancel is not None) and cancel.is_set()))
+
+        if (fd >= 0):
+            if keep:
+                try:
+                    os.ftruncate (fd, verifier.size)
+                except OSError:
+                    keep = False
+            os.close (fd)
+
+        if ((not keep) and os.path.exists (partpath)):
+            os.remove (partpath)
+
+        response.close ()
+
+        result = verifier.verify()
+        result['status'] = 'error'
+        result['msg'] = 'Transfer failed: ' + str(e)
+
+        if keep:
+            result['partial'] = verifier.size
+            result['headers'] = headers
+        return (result)
+
+    response.close ()
+
+    result = verifier.verify()
+
+    if (result['status'] == 'ok'):
+        os.replace (partpath, filepath)
+    else:
+        os.remove (partpath)
+
+    if debug:
+        logging.debug ('')
+        logging.debug (f'stream_to_file: {result["status"]:s} {result["msg"]:s}')
+
+    return (result)
+
+
+class TeeStream (io.RawIOBase):
+
+    """
+    TeeStream class is a binary file object reading from fp (e.g. the raw
+    stream of a TAP result response) that writes a copy of everything
+    read to outpath, so a result can be parsed as it arrives and saved
+    at the same time.
+
+    The copy is written to outpath.part and renamed to outpath when the
+    stream is closed; the part of the stream not read by the caller is
+    copied on close, so outpath always holds the complete stream.
+    abort() closes the stream without reading the rest (the caller
+    failed): the partial copy is removed.
+    """
+
+    def __init__ (self, fp, outpath):
+
+        self.fp = fp
+        self.outpath = outpath
+        self.out = open (outpath + '.part', 'wb')
+        return
+
+
+    def readable (self):
+
+        return (True)
+
+
+    def readinto (self, b):
+
+#
+#    read1: return the data available now rather than block until b is
+#    full (urllib3's read(n) waits for n bytes)
+#
+        if hasattr (self.fp, 'read1'):
+            data = self.fp.read1 (len(b))
+            n = len(data)
+            b[0:n] = data
+        else:
+            n = self.fp.readinto (b)
+
+        if (n is not None) and (n > 0):
+            self.out.write (memoryview (b)[:n])
+
+        return (n)
+
+
+    def close (self):
+
+        if self.closed:
+            return
+
+        try:
+            if (not self.out.closed):
+
+                buf = bytearray (conf.chunk_size)
+                while True:
+                    n = self.readinto (buf)
+                    if (not n):
+                        break
+
+                self.out.close ()
+                os.replace (self.outpath + '.part', self.outpath)
+        finally:
+            if (not self.out.closed):
+                self.out.close ()
+            super().close ()
+        return
+
+
+    def abort (self):
+
+        if self.closed:
+            return
+
+        try:
+            self.out.close ()
+
+            if (os.path.exists (self.outpath + '.part')):
+                os.remove (self.outpath + '.part')
+        finally:
+            super().close ()
+        return
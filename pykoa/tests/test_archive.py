@@ -0,0 +1,111 @@
+import io
+
+import pytest
+
+from pykoa.koa import Archive, KoaQueryError
+from pykoa.koa.core import KoaTap
+
+
+server = 'https://koa.test'
+
+class Raw (io.RawIOBase):
+
+#
+#    a long result stream: reading it to the end is easy to tell
+#
+    def __init__ (self, nbyte=10**7):
+
+        self.nbyte = nbyte
+        self.nread = 0
+        self.decode_content = False
+
+    def readable (self):
+
+        return (True)
+
+    def readinto (self, b):
+
+        n = min (len(b), self.nbyte - self.nread)
+        b[0:n] = b' ' * n
+        self.nread = self.nread + n
+        return (n)
+
+
+class Response:
+
+    def __init__ (self):
+
+        self.raw = Raw ()
+        self.closed = False
+
+    def close (self):
+
+        self.closed = True
+
+
+def stub_query (monkeypatch, response):
+
+    def send_async (self, query, **kwargs):
+        self.response_result = response
+        return ('ok')
+
+    monkeypatch.setattr (KoaTap, 'send_async', send_async)
+
+
+@pytest.mark.parametrize ('outpath', [False, True])
+def test_query_and_download_error_drops_stream (monkeypatch, tmp_path, \
+    outpath):
+
+    response = Response ()
+    stub_query (monkeypatch, response)
+
+    def download (self, source, format, outdir, **kwargs):
+        source.read (100)
+        raise KeyboardInterrupt ()
+
+    monkeypatch.setattr (Archive, 'download', download)
+
+    kwargs = dict()
+    if outpath:
+        kwargs['outpath'] = str (tmp_path / 'result.tbl')
+
+    archive = Archive (verbose=False)
+    with pytest.raises (KeyboardInterrupt):
+        archive.query_and_download ('select * from koa_hires', \
+            str (tmp_path / 'out'), server=server, **kwargs)
+
+    assert response.closed
+    assert response.raw.nread < 10**6
+    assert list (tmp_path.glob ('result.tbl*')) == []
+
+
+def test_query_and_download_no_result_stream (monkeypatch, tmp_path):
+
+    stub_query (monkeypatch, None)
+
+    archive = Archive (verbose=False)
+    with pytest.raises (KoaQueryError):
+        archive.query_and_download ('select * from koa_hires', \
+            str (tmp_path / 'out'), server=server)
+
+
+def test_query_and_download_without_cookiepath (monkeypatch, tmp_path):
+
+    stub_query (monkeypatch, Response ())
+    monkeypatch.setattr (Archive, 'download', \
+        lambda self, source, format, outdir, **kwargs: 'plan')
+
+    taps = []
+    init = KoaTap.__init__
+
+    def spy (self, url, **kwargs):
+        taps.append (kwargs)
+        init (self, url, **kwargs)
+
+    monkeypatch.setattr (KoaTap, '__init__', spy)
+
+    archive = Archive (verbose=False)
+
+    assert archive.query_and_download ('select * from koa_hires', \
+        str (tmp_path / 'out'), server=server) == 'plan'
+    assert 'cookiefile' not in taps[0]
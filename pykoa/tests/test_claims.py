@@ -0,0 +1,123 @@
+import os
+import time
+
+import pytest
+
+from pykoa.koa.claims import ClaimDir, shard_of
+
+
+@pytest.fixture
+def claims (tmp_path):
+
+    claimdirs = []
+
+    def make (ttl=60.):
+        claimdir = ClaimDir (str (tmp_path / '.koaclaims'), ttl=ttl)
+        claimdirs.append (claimdir)
+        return (claimdir)
+
+    yield (make)
+
+    for claimdir in claimdirs:
+        claimdir.close ()
+
+
+def age (path, seconds):
+
+    when = time.time() - seconds
+    os.utime (path, (when, when))
+
+
+def test_claim_is_exclusive (claims):
+
+    first = claims ()
+    second = claims ()
+
+    assert first.claim ('HIRES/lev0/HI.20180316.00001.fits')
+    assert not second.claim ('HIRES/lev0/HI.20180316.00001.fits')
+    assert second.claim ('HIRES/lev0/HI.20180316.00002.fits')
+
+
+def test_release_frees_claim (claims):
+
+    first = claims ()
+    second = claims ()
+
+    relpath = 'HIRES/lev0/HI.20180316.00001.fits'
+
+    assert first.claim (relpath)
+    first.release (relpath)
+
+    assert not os.path.exists (first.claim_path (relpath))
+    assert second.claim (relpath)
+
+
+def test_stale_claim_is_broken (claims):
+
+    first = claims (ttl=60.)
+    second = claims (ttl=60.)
+
+    relpath = 'HIRES/lev0/HI.20180316.00001.fits'
+    assert first.claim (relpath)
+
+#
+#    the first worker crashed: its claim is no longer refreshed
+#
+    first.stopped.set ()
+    age (first.claim_path (relpath), 120.)
+
+    assert second.claim (relpath)
+
+    with open (second.claim_path (relpath)) as fp:
+        assert fp.read().startswith (second.owner)
+
+    leftovers = [name for name in os.listdir (second.claimdir) \
+        if ('.stale.' in name)]
+    assert leftovers == []
+
+
+def test_live_claim_is_not_broken (claims):
+
+    first = claims (ttl=60.)
+    second = claims (ttl=60.)
+
+    relpath = 'HIRES/lev0/HI.20180316.00001.fits'
+    assert first.claim (relpath)
+
+    age (first.claim_path (relpath), 30.)
+
+    assert not second.claim (relpath)
+    assert os.path.exists (first.claim_path (relpath))
+
+
+def test_heartbeat_refreshes_claim (claims):
+
+    first = claims (ttl=0.4)
+    second = claims (ttl=0.4)
+
+    relpath = 'HIRES/lev0/HI.20180316.00001.fits'
+    assert first.claim (relpath)
+
+    time.sleep (1.)
+
+    assert not second.claim (relpath)
+
+
+def test_close_releases_claims (claims):
+
+    first = claims ()
+
+    relpath = 'HIRES/lev0/HI.20180316.00001.fits'
+    assert first.claim (relpath)
+
+    first.close ()
+
+    assert not os.path.exists (first.claim_path (relpath))
+
+
+def test_shard_is_stable ():
+
+    assert shard_of ('HI.20180316.00001.fits', 8) == \
+        shard_of ('HI.20180316.00001.fits', 8)
+    assert {shard_of (f'HI.20180316.{i:05d}.fits', 4) \
+        for i in range (100)} == {0, 1, 2, 3}
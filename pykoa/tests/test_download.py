@@ -0,0 +1,260 @@
+import time
+import threading
+
+import pytest
+
+from pykoa.koa.download import DownloadPlan, Concurrency, get_order, \
+    koa_date, sharded_layout, format_size
+
+
+def make_plan (tmp_path):
+
+#
+#    (koaid, row, calib, size, stored, exists)
+#
+    files = [
+        ('HI.20180317.00001.fits', 0, 0, 300, False, False),
+        ('CAL.20180316.00001.fits', 0, 1, 100, False, False),
+        ('HI.20180316.00002.fits', 1, 0, -1, False, False),
+        ('HI.20180316.00003.fits', 2, 0, 500, True, False),
+        ('CAL.20180315.00002.fits', 2, 1, 200, False, False),
+        ('HI.20180315.00004.fits', 3, 0, 400, False, True),
+        ('HI.20180315.00005.fits', 4, 0, 50, False, False),
+    ]
+
+    plan = DownloadPlan (str (tmp_path))
+
+    for (koaid, row, calib, size, stored, exists) in files:
+        plan.add ({'koaid': koaid, 'instrument': 'HIRES', \
+            'filepath': str (tmp_path / koaid), 'relpath': koaid, \
+            'row': row, 'calib': calib, 'size': size, 'stored': stored, \
+            'exists': exists})
+
+    return (plan)
+
+
+def koaids (items):
+
+    return ([item['koaid'] for item in items])
+
+
+def test_table_order_is_default (tmp_path):
+
+    plan = make_plan (tmp_path)
+
+    assert koaids (plan.pending ()) == koaids (plan.pending ('table'))
+    assert koaids (plan.pending ()) == [
+        'HI.20180317.00001.fits', 'CAL.20180316.00001.fits',
+        'HI.20180316.00002.fits', 'HI.20180316.00003.fits',
+        'CAL.20180315.00002.fits', 'HI.20180315.00005.fits']
+
+
+def test_existing_files_are_not_pending (tmp_path):
+
+    plan = make_plan (tmp_path)
+
+    for order in ('table', 'largest', 'smallest', 'date', 'calib'):
+        assert 'HI.20180315.00004.fits' not in koaids (plan.pending (order))
+
+
+def test_largest_order (tmp_path):
+
+    plan = make_plan (tmp_path)
+
+    assert koaids (plan.pending ('largest')) == [
+        'HI.20180316.00003.fits', 'HI.20180317.00001.fits',
+        'CAL.20180315.00002.fits', 'CAL.20180316.00001.fits',
+        'HI.20180315.00005.fits', 'HI.20180316.00002.fits']
+
+
+def test_smallest_order (tmp_path):
+
+    plan = make_plan (tmp_path)
+
+    assert koaids (plan.pending ('smallest')) == [
+        'HI.20180315.00005.fits', 'CAL.20180316.00001.fits',
+        'CAL.20180315.00002.fits', 'HI.20180317.00001.fits',
+        'HI.20180316.00003.fits', 'HI.20180316.00002.fits']
+
+
+def test_date_order (tmp_path):
+
+    plan = make_plan (tmp_path)
+
+    assert koaids (plan.pending ('date')) == [
+        'CAL.20180315.00002.fits', 'HI.20180315.00005.fits',
+        'CAL.20180316.00001.fits', 'HI.20180316.00002.fits',
+        'HI.20180316.00003.fits', 'HI.20180317.00001.fits']
+
+
+def test_calib_order (tmp_path):
+
+    plan = make_plan (tmp_path)
+
+    assert koaids (plan.pending ('calib')) == [
+        'CAL.20180315.00002.fits', 'CAL.20180316.00001.fits',
+        'HI.20180315.00005.fits', 'HI.20180316.00002.fits',
+        'HI.20180316.00003.fits', 'HI.20180317.00001.fits']
+
+
+def test_callable_order (tmp_path):
+
+    plan = make_plan (tmp_path)
+
+    items = plan.pending (lambda item: item['koaid'])
+
+    assert koaids (items) == sorted (koaids (items))
+
+
+def test_unknown_order (tmp_path):
+
+    plan = make_plan (tmp_path)
+
+    with pytest.raises (Exception, match='Unknown order'):
+        plan.pending ('random')
+
+    assert callable (get_order ('table'))
+
+
+def test_plan_add_once (tmp_path):
+
+    plan = make_plan (tmp_path)
+
+    item = dict (plan.items[0])
+    assert not plan.add (item)
+    assert len (plan.items) == 7
+
+
+def test_koa_date_and_layout ():
+
+    assert koa_date ('HI.20180316.12345.fits') == '20180316'
+    assert koa_date ('notakoaid.fits') == ''
+
+    item = {'koaid': 'HI.20180316.12345.fits', 'instrument': ''}
+    assert sharded_layout (item) == 'HI/20180316/HI.20180316.12345.fits'
+
+
+def test_format_size ():
+
+    assert format_size (512) == '512 B'
+    assert format_size (1500000) == '1.5 MB'
+
+
+def interval_done (concurrency, nbyte, duration=0.1, error=None):
+
+#
+#    report a file completing once the decision interval has elapsed
+#    (throughput: nbyte per interval)
+#
+    concurrency.stamp = time.monotonic() - concurrency.interval
+    concurrency.report (nbyte, duration, error)
+
+
+def busy (concurrency):
+
+    for i in range (concurrency.limit - concurrency.active):
+        concurrency.acquire ()
+
+
+def test_concurrency_increases_while_busy ():
+
+    concurrency = Concurrency (nworker=2, nmax=4, interval=1.)
+
+    busy (concurrency)
+    interval_done (concurrency, 10**6)
+    assert concurrency.limit == 3
+
+    busy (concurrency)
+    interval_done (concurrency, 2 * 10**6)
+    assert concurrency.limit == 4
+
+#
+#    nmax reached
+#
+    busy (concurrency)
+    interval_done (concurrency, 3 * 10**6)
+    assert concurrency.limit == 4
+
+    assert [h[1] for h in concurrency.history] == [3, 4]
+    assert concurrency.history[0][3] == 'throughput up'
+    assert concurrency.nincrease == 2
+
+
+def test_concurrency_keeps_limit_when_idle_or_slower ():
+
+    concurrency = Concurrency (nworker=2, nmax=8, interval=1.)
+
+#
+#    a free slot: more workers would not help
+#
+    concurrency.acquire ()
+    interval_done (concurrency, 10**6)
+    assert concurrency.limit == 2
+
+    busy (concurrency)
+    interval_done (concurrency, 10**6)
+    assert concurrency.limit == 3
+
+#
+#    the throughput at 3 is not 5% above the one at 2
+#
+    busy (concurrency)
+    interval_done (concurrency, 10**6)
+    assert concurrency.limit == 3
+
+
+@pytest.mark.parametrize ('signal', ['retry', 'error', 'spike'])
+def test_concurrency_halves_on_congestion (signal):
+
+    concurrency = Concurrency (nworker=8, nmax=8, interval=1.)
+
+#
+#    1 s per MB: the usual latency
+#
+    interval_done (concurrency, 10**6, 1.)
+    assert concurrency.limit == 8
+
+    if (signal == 'retry'):
+        concurrency.congested ('status 503')
+        interval_done (concurrency, 10**6, 1.)
+    elif (signal == 'error'):
+        interval_done (concurrency, 0, 1., Exception ('connection reset'))
+    else:
+        interval_done (concurrency, 10**6, 5.)
+
+    assert concurrency.limit == 4
+    assert concurrency.ndecrease == 1
+    assert concurrency.history[-1][1] == 4
+
+#
+#    the signals of the interval following the decrease are ignored
+#
+    concurrency.congested ('status 503')
+    interval_done (concurrency, 10**6, 1.)
+    assert concurrency.limit == 4
+
+    concurrency.quiet_until = time.monotonic()
+    concurrency.congested ('status 503')
+    interval_done (concurrency, 10**6, 1.)
+    assert concurrency.limit == 2
+
+
+def test_concurrency_acquire_blocks_at_limit ():
+
+    concurrency = Concurrency (nworker=1, nmax=1)
+    concurrency.acquire ()
+
+    acquired = threading.Event ()
+
+    def worker ():
+        concurrency.acquire ()
+        acquired.set ()
+
+    t = threading.Thread (target=worker, daemon=True)
+    t.start ()
+
+    assert not acquired.wait (0.2)
+
+    concurrency.release ()
+    assert acquired.wait (5.)
+    t.join ()
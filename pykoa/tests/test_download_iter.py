@@ -0,0 +1,291 @@
+import os
+import json
+import time
+import threading
+
+import pytest
+from astropy.table import Table
+from requests.structures import CaseInsensitiveDict
+
+from pykoa.koa import Archive, KoaFileError
+from pykoa.koa.flights import flights
+from pykoa.koa.servers import ServerPool
+
+
+server = 'https://koa.test'
+
+def fits_body (koaid):
+
+    cards = ['SIMPLE  =                    T', \
+        'NAXIS   =                    0', f"OBJECT  = '{koaid[:20]:s}'", 'END']
+    header = ''.join (card.ljust (80) for card in cards).ljust (2880)
+    return (header.encode() + bytes (2880 * 3))
+
+
+class Response:
+
+#
+#    a streamed file response: the body is sent one FITS block at a time,
+#    delay seconds apart
+#
+    def __init__ (self, body, delay, content_type='application/fits', \
+        status_code=200):
+
+        self.status_code = status_code
+        self.headers = CaseInsensitiveDict ({ \
+            'Content-type': content_type, \
+            'Content-Length': str (len(body))})
+        self.raw = None
+        self.body = body
+        self.delay = delay
+        self.closed = False
+
+    def iter_content (self, chunk_size=2880):
+
+        for i in range (0, len(self.body), 2880):
+            if self.closed:
+                return
+            time.sleep (self.delay)
+            yield (self.body[i:i+2880])
+
+    @property
+    def text (self):
+
+        return (self.body.decode ())
+
+    def close (self):
+
+        self.closed = True
+
+
+class Transport:
+
+#
+#    the network side of the downloads: every file request is answered
+#    locally and recorded
+#
+    def __init__ (self):
+
+        self.delay = 0.
+        self.requests = []
+        self.responses = []
+        self.answers = dict()
+        self.lock = threading.Lock ()
+
+    def request (self, retry, method, url, **kwargs):
+
+        koaid = os.path.basename (url)
+
+        if (koaid in self.answers):
+            response = self.answers[koaid] ()
+        else:
+            response = Response (fits_body (koaid), self.delay)
+
+        with self.lock:
+            self.requests.append (koaid)
+            self.responses.append (response)
+
+        return (response)
+
+
+@pytest.fixture
+def transport (monkeypatch):
+
+    stub = Transport ()
+
+    monkeypatch.setattr (ServerPool, 'request', \
+        lambda pool, retry, method, url, **kwargs: \
+        stub.request (retry, method, url, **kwargs))
+    return (stub)
+
+
+@pytest.fixture
+def metapath (tmp_path):
+
+    table = Table ()
+    table['koaid'] = [f'HI.20180316.{i:05d}.fits' for i in range (12)]
+    table['instrume'] = ['HIRES'] * 12
+    table['filehand'] = [f'/koadata/HIRES/20180316/lev0/' + \
+        f'HI.20180316.{i:05d}.fits' for i in range (12)]
+
+    path = str (tmp_path / 'meta.tbl')
+    table.write (path, format='ascii.ipac')
+    return (path)
+
+
+def download_threads ():
+
+    return ([t for t in threading.enumerate () \
+        if t.name.startswith ('koa-download')])
+
+
+def test_download_iter_complete (transport, metapath, tmp_path):
+
+    outdir = str (tmp_path / 'out')
+    archive = Archive (verbose=False)
+
+    records = list (archive.download_iter (metapath, 'ipac', outdir, \
+        server=server, nworker=3, failures=None))
+
+    assert len (records) == 12
+    assert all (record['status'] == 'ok' for record in records)
+    assert len (transport.requests) == 12
+    assert archive.plan.stats is not None
+
+    for record in records:
+        with open (record['path'], 'rb') as fp:
+            assert fp.read () == fits_body (record['koaid'])
+
+
+@pytest.mark.parametrize ('stream', [False, True])
+def test_download_iter_close_stops_workers (transport, metapath, tmp_path, \
+    stream):
+
+    transport.delay = 0.05
+
+    outdir = str (tmp_path / 'out')
+    archive = Archive (verbose=False)
+
+    records = archive.download_iter (metapath, 'ipac', outdir, \
+        server=server, nworker=2, claim=True, stream=stream, failures=None)
+
+    record = next (records)
+    assert record['status'] == 'ok'
+
+    records.close ()
+
+#
+#    the workers are joined, the transfers in flight cancelled: nothing
+#    is requested or written after close
+#
+    assert download_threads () == []
+
+    nrequest = len (transport.requests)
+    files = sorted (os.listdir (outdir))
+
+    time.sleep (0.5)
+
+    assert len (transport.requests) == nrequest
+    assert sorted (os.listdir (outdir)) == files
+    assert nrequest < 12
+
+    assert [name for name in files if name.endswith ('.part')] == []
+    assert os.listdir (os.path.join (outdir, '.koaclaims')) in ([], \
+        ['.clock'])
+    assert archive.plan.stats is not None
+
+
+def json_response (jsondata):
+
+    return (Response (json.dumps (jsondata).encode (), 0., \
+        content_type='application/json'))
+
+
+def test_download_iter_refused_files (transport, metapath, tmp_path):
+
+    transport.answers['HI.20180316.00001.fits'] = lambda: json_response ( \
+        {'status': 'error', 'msg': 'file not found'})
+    transport.answers['HI.20180316.00002.fits'] = lambda: json_response ( \
+        {'status': 'ok', 'msg': ''})
+    transport.answers['HI.20180316.00003.fits'] = lambda: Response ( \
+        b'not found', 0., content_type='text/plain', status_code=404)
+
+    outdir = str (tmp_path / 'out')
+    archive = Archive (verbose=False)
+
+    records = list (archive.download_iter (metapath, 'ipac', outdir, \
+        server=server, nworker=3, failures=None))
+
+    errors = dict ((record['koaid'], record['msg']) for record in records \
+        if (record['status'] == 'error'))
+
+    assert sorted (errors) == ['HI.20180316.00001.fits', \
+        'HI.20180316.00002.fits', 'HI.20180316.00003.fits']
+    assert 'file not found' in errors['HI.20180316.00001.fits']
+    assert 'Unexpected server response' in errors['HI.20180316.00002.fits']
+
+#
+#    a JSON answer is never written as the file; every response is
+#    closed, so its connection goes back to the pool
+#
+    assert not os.path.exists (os.path.join (outdir, \
+        'HI.20180316.00002.fits'))
+    assert all (response.closed for response in transport.responses)
+
+
+def test_download_iter_failure_cache_is_opt_in (transport, metapath, \
+    tmp_path):
+
+    transport.answers['HI.20180316.00001.fits'] = lambda: Response ( \
+        b'not found', 0., content_type='text/plain', status_code=404)
+    transport.answers['HI.20180316.00002.fits'] = lambda: json_response ( \
+        {'status': 'error', 'msg': 'Database temporarily unavailable'})
+
+    outdir = str (tmp_path / 'out')
+    archive = Archive (verbose=False)
+
+    list (archive.download_iter (metapath, 'ipac', outdir, server=server, \
+        nworker=3))
+    assert not os.path.exists (os.path.join (outdir, '.koafailures.sqlite'))
+
+#
+#    with the cache, only the definite refusal is skipped on the next run
+#
+    for run in range (2):
+
+        del transport.requests[:]
+        records = list (archive.download_iter (metapath, 'ipac', outdir, \
+            server=server, nworker=3, failures=True))
+
+        assert 'HI.20180316.00002.fits' in transport.requests
+        assert ('HI.20180316.00001.fits' in transport.requests) == \
+            (run == 0)
+
+    assert os.path.exists (os.path.join (outdir, '.koafailures.sqlite'))
+    assert archive.nskipped == 1
+
+
+@pytest.mark.parametrize ('error, fetched', [
+    (Exception ('transfer cancelled'), True),
+    (KoaFileError ('Database temporarily unavailable', 'refused'), True),
+    (KoaFileError ('File not found', 'missing'), False)])
+def test_download_iter_waiter_outlives_leader_failure (transport, metapath, \
+    tmp_path, error, fetched):
+
+    koaid = 'HI.20180316.00000.fits'
+    key = ('file', koaid, '')
+
+#
+#    another download's fetch of the same file, failing once the download
+#    under test waits for it
+#
+    def fetch ():
+        start = time.time()
+        while ((flights.flights[key].nwaiter == 0) and \
+            (time.time() - start < 5.)):
+            time.sleep (0.01)
+        raise error
+
+    def lead ():
+        try:
+            flights.do (key, fetch)
+        except Exception:
+            pass
+
+    leader = threading.Thread (target=lead)
+    leader.start ()
+    while (key not in flights.flights):
+        time.sleep (0.01)
+
+    outdir = str (tmp_path / 'out')
+    archive = Archive (verbose=False)
+
+    records = list (archive.download_iter (metapath, 'ipac', outdir, \
+        server=server, nworker=3, failures=None))
+    leader.join ()
+
+    record = [record for record in records if (record['koaid'] == koaid)][0]
+
+    assert (record['status'] == 'ok') == fetched
+    assert (koaid in transport.requests) == fetched
+    assert len (records) == 12
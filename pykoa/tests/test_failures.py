@@ -0,0 +1,103 @@
+import time
+import sqlite3
+
+import pytest
+
+from pykoa.koa.failures import FailureCache, classify
+
+
+@pytest.mark.parametrize ('msg, status, kind', [
+    ('', 404, 'missing'),
+    ('', 410, 'missing'),
+    ('', 403, 'proprietary'),
+    ('File HI.20180316.00001.fits not found', 200, 'missing'),
+    ('The file is proprietary', 200, 'proprietary'),
+    ('Please login to access the file', 200, 'proprietary'),
+    ('', 400, 'refused'),
+    ('Database temporarily unavailable', 200, 'refused')])
+def test_classify (msg, status, kind):
+
+    assert classify (msg, status) == kind
+
+
+@pytest.fixture
+def failures (tmp_path):
+
+    failures = FailureCache (str (tmp_path / 'failures.sqlite'), ttl=60.)
+    yield (failures)
+    failures.close ()
+
+
+def test_add_only_definite_kinds (failures):
+
+    assert failures.add ('HI.20180316.00001.fits', 'missing', 'not found')
+    assert failures.add ('HI.20180316.00002.fits', 'proprietary', 'login')
+    assert not failures.add ('HI.20180316.00003.fits', 'refused', \
+        'Database temporarily unavailable')
+
+    assert failures.lookup ('HI.20180316.00001.fits')['kind'] == 'missing'
+    assert failures.lookup ('HI.20180316.00002.fits')['kind'] == \
+        'proprietary'
+    assert failures.lookup ('HI.20180316.00003.fits') is None
+
+
+def test_key_has_identity (failures):
+
+    failures.add ('HI.20180316.00001.fits', 'proprietary', 'login', '')
+
+#
+#    refused to the anonymous user, not to a login
+#
+    assert failures.lookup ('HI.20180316.00001.fits') is not None
+    assert failures.lookup ('HI.20180316.00001.fits', \
+        '/home/me/cookies.txt') is None
+
+    failures.add ('HI.20180316.00001.fits', 'missing', 'not found', \
+        '/home/me/cookies.txt')
+    failures.remove ('HI.20180316.00001.fits')
+
+    assert failures.lookup ('HI.20180316.00001.fits') is None
+    assert failures.lookup ('HI.20180316.00001.fits', \
+        '/home/me/cookies.txt') is not None
+
+
+def test_entry_expires (failures):
+
+    failures.add ('HI.20180316.00001.fits', 'missing', 'not found')
+
+    with failures.db:
+        failures.db.execute ('update failures set added = added - 120')
+
+    assert failures.lookup ('HI.20180316.00001.fits') is None
+    assert failures.db.execute ('select count(*) from failures').fetchone () \
+        == (0,)
+
+
+def test_refresh (failures):
+
+    failures.add ('HI.20180316.00001.fits', 'missing', 'not found')
+    failures.add ('HI.20180316.00002.fits', 'proprietary', 'login', 'me')
+
+    assert failures.refresh ('proprietary') == 1
+    assert failures.lookup ('HI.20180316.00001.fits') is not None
+    assert failures.lookup ('HI.20180316.00002.fits', 'me') is None
+
+
+def test_former_layout_is_dropped (tmp_path):
+
+    path = str (tmp_path / 'failures.sqlite')
+
+    db = sqlite3.connect (path)
+    with db:
+        db.execute ('create table failures (koaid text primary key, ' + \
+            'kind text, msg text, added real)')
+        db.execute ('insert into failures values (?, ?, ?, ?)', \
+            ('HI.20180316.00001.fits', 'refused', 'error', time.time()))
+    db.close ()
+
+    failures = FailureCache (path)
+
+    assert failures.lookup ('HI.20180316.00001.fits') is None
+    assert failures.add ('HI.20180316.00001.fits', 'missing', 'not found')
+    assert failures.lookup ('HI.20180316.00001.fits') is not None
+    failures.close ()
@@ -0,0 +1,250 @@
+import time
+import threading
+import concurrent.futures
+
+import pytest
+
+from pykoa.koa.flights import SingleFlight, normalize_adql
+from pykoa.koa.exceptions import KoaTimeoutError
+
+
+def test_normalize_whitespace_and_case ():
+
+    assert normalize_adql ('SELECT  koaid,\n\tut FROM koa_hires ') == \
+        normalize_adql ('select koaid, ut from KOA_HIRES')
+
+
+def test_normalize_keeps_quoted_strings ():
+
+    query = "SELECT * FROM koa_hires  WHERE object = 'HD  1234' " + \
+        "AND \"Mixed Case\" > 1"
+
+    assert normalize_adql (query) == \
+        "select * from koa_hires where object = 'HD  1234' " + \
+        "and \"Mixed Case\" > 1"
+
+    assert normalize_adql ("select * from t where a = 'x'") != \
+        normalize_adql ("select * from t where a = 'X'")
+
+
+def test_normalize_escaped_quote ():
+
+    query = "select * from t where object = 'O''Brien  A'   and  B = 1"
+
+    assert normalize_adql (query) == \
+        "select * from t where object = 'O''Brien  A' and b = 1"
+
+
+def run_threads (n, target):
+
+    results = [None] * n
+
+    def run (i):
+        results[i] = target ()
+
+    threads = [threading.Thread (target=run, args=(i,)) for i in range (n)]
+    for t in threads:
+        t.start ()
+    for t in threads:
+        t.join (10.)
+
+    return (results)
+
+
+def test_do_coalesces ():
+
+    flights = SingleFlight ()
+    calls = []
+
+    def fetch ():
+        calls.append (1)
+        time.sleep (0.3)
+        return ('rows')
+
+    results = run_threads (4, lambda: flights.do ('q', fetch))
+
+    assert len (calls) == 1
+    assert sorted (leader for (result, leader) in results) == \
+        [False, False, False, True]
+    assert all (result == 'rows' for (result, leader) in results)
+    assert flights.ncoalesced == 3
+
+
+def test_do_forgets_completed_key ():
+
+    flights = SingleFlight ()
+    calls = []
+
+    def fetch ():
+        calls.append (1)
+        return (len (calls))
+
+    assert flights.do ('q', fetch) == (1, True)
+    assert flights.do ('q', fetch) == (2, True)
+
+
+def test_do_shares_error ():
+
+    flights = SingleFlight ()
+    started = threading.Event ()
+
+    def fetch ():
+        started.set ()
+        time.sleep (0.3)
+        raise ValueError ('server error')
+
+    errors = []
+
+    def waiter ():
+        started.wait ()
+        try:
+            flights.do ('q', fetch)
+        except ValueError as e:
+            errors.append (e)
+
+    t = threading.Thread (target=waiter)
+    t.start ()
+
+    with pytest.raises (ValueError):
+        flights.do ('q', fetch)
+    t.join ()
+
+    assert len (errors) == 1
+
+
+def test_do_waiter_deadline ():
+
+    flights = SingleFlight ()
+    started = threading.Event ()
+    release = threading.Event ()
+
+    def fetch ():
+        started.set ()
+        release.wait (5.)
+        return ('rows')
+
+    t = threading.Thread (target=flights.do, args=('q', fetch))
+    t.start ()
+    started.wait ()
+
+    with pytest.raises (KoaTimeoutError):
+        flights.do ('q', fetch, deadline=time.time() + 0.2)
+
+    release.set ()
+    t.join ()
+
+
+def test_share_runs_once_and_delivers_each_caller ():
+
+    flights = SingleFlight ()
+    calls = []
+    delivered = []
+    cleaned = []
+
+    def fetch (abandon, publish):
+        calls.append (1)
+        publish ('job1')
+        time.sleep (0.3)
+        return ('result')
+
+    def deliver (result, last):
+        with lock:
+            delivered.append (last)
+        return (result + '-copy')
+
+    lock = threading.Lock ()
+    notified = []
+
+    results = run_threads (3, lambda: flights.share ('q', fetch, \
+        deliver=deliver, cleanup=cleaned.append, notify=notified.append))
+
+    assert len (calls) == 1
+    assert all (result == 'result-copy' for (result, leader) in results)
+    assert sorted (delivered) == [False, False, True]
+    assert cleaned == ['result']
+    assert notified == ['job1'] * 3
+
+
+def test_share_cancel_leaves_only_its_wait ():
+
+    flights = SingleFlight ()
+    started = threading.Event ()
+    release = threading.Event ()
+    abandoned = []
+
+    def fetch (abandon, publish):
+        started.set ()
+        release.wait (5.)
+        abandoned.append (abandon.is_set())
+        return ('result')
+
+    results = []
+
+    def other ():
+        results.append (flights.share ('q', fetch))
+
+    cancel = threading.Event ()
+    cancel.set ()
+
+    t = threading.Thread (target=other)
+    t.start ()
+    started.wait ()
+
+    with pytest.raises (concurrent.futures.CancelledError):
+        flights.share ('q', fetch, cancel=cancel)
+
+    release.set ()
+    t.join (5.)
+
+    assert abandoned == [False]
+    assert results == [('result', True)]
+
+
+def test_share_abandoned_when_every_caller_leaves ():
+
+    flights = SingleFlight ()
+    started = threading.Event ()
+    stopped = []
+
+    def fetch (abandon, publish):
+        started.set ()
+        stopped.append (abandon.wait (5.))
+        raise concurrent.futures.CancelledError ('aborted')
+
+    def waiter ():
+        started.wait ()
+        with pytest.raises (KoaTimeoutError):
+            flights.share ('q', fetch, deadline=time.time() + 0.2)
+
+    t = threading.Thread (target=waiter)
+    t.start ()
+
+    with pytest.raises (KoaTimeoutError):
+        flights.share ('q', fetch, deadline=time.time() + 0.4)
+    t.join (5.)
+
+    assert stopped == [True]
+    assert flights.flights == dict()
+
+
+def test_share_abandoned_flight_is_not_joined ():
+
+    flights = SingleFlight ()
+    flights.abandon_wait = 0.
+    release = threading.Event ()
+    calls = []
+
+    def fetch (abandon, publish):
+        calls.append (1)
+        if (len (calls) == 1):
+            release.wait (5.)
+            return ('stale')
+        return ('fresh')
+
+    with pytest.raises (KoaTimeoutError):
+        flights.share ('q', fetch, deadline=time.time() + 0.2)
+
+    assert flights.share ('q', fetch) == ('fresh', True)
+
+    release.set ()
+    assert len (calls) == 2
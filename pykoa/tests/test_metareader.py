@@ -0,0 +1,118 @@
+import io
+
+import pytest
+from astropy.table import Table
+
+from pykoa.koa import MetaReader
+
+
+formats = {
+    'ipac': 'ascii.ipac',
+    'csv': 'ascii.csv',
+    'tsv': 'ascii.tab',
+    'votable': 'votable',
+}
+
+def make_table ():
+
+    table = Table ()
+    table['koaid'] = [f'HI.20180316.{i:05d}.fits' for i in range (5)]
+    table['instrume'] = ['HIRES'] * 5
+    table['ut'] = ['06:00:00'] * 5
+    table['filehand'] = [f'/koadata/HIRES/HI.20180316.{i:05d}.fits' \
+        for i in range (5)]
+    table['elaptime'] = [1.5 * i for i in range (5)]
+    return (table)
+
+
+def astropy_rows (path, format, columns):
+
+    table = Table.read (path, format=formats[format])
+    return ([tuple (str (table[col][i]).strip() for col in columns) \
+        for i in range (len(table))])
+
+
+@pytest.mark.parametrize ('format', list (formats))
+def test_rows_match_astropy (tmp_path, format):
+
+    path = str (tmp_path / f'meta.{format:s}')
+    make_table ().write (path, format=formats[format])
+
+    columns = ['koaid', 'instrume', 'filehand']
+    reader = MetaReader (path, format, columns=columns)
+
+    assert list (reader) == astropy_rows (path, format, columns)
+    assert reader.nrow == 5
+    assert 'ut' in reader.colnames
+
+
+@pytest.mark.parametrize ('format', list (formats))
+def test_column_order_and_case (tmp_path, format):
+
+    path = str (tmp_path / f'meta.{format:s}')
+    make_table ().write (path, format=formats[format])
+
+    reader = MetaReader (path, format, columns=['FILEHAND', 'KoaId'])
+
+    assert list (reader) == astropy_rows (path, format, \
+        ['filehand', 'koaid'])
+
+
+def test_read_dictionary (tmp_path):
+
+    path = str (tmp_path / 'meta.tbl')
+    make_table ().write (path, format='ascii.ipac')
+
+    data = MetaReader (path, 'ipac', columns=['koaid', 'ut']).read ()
+
+    assert list (data) == ['koaid', 'ut']
+    assert data['koaid'][4] == 'HI.20180316.00004.fits'
+    assert data['ut'] == ['06:00:00'] * 5
+
+
+def test_ipac_null_is_empty (tmp_path):
+
+    table = make_table ()
+    table['ut'] = Table.MaskedColumn (table['ut'], \
+        mask=[False, True, False, False, False])
+
+    path = str (tmp_path / 'meta.tbl')
+    table.write (path, format='ascii.ipac')
+
+    data = MetaReader (path, 'ipac', columns=['ut']).read ()
+
+    assert data['ut'][1] == ''
+    assert data['ut'][0] == '06:00:00'
+
+
+def test_binary_votable_falls_back_to_astropy (tmp_path):
+
+    path = str (tmp_path / 'meta.xml')
+    make_table ().write (path, format='votable', tabledata_format='binary')
+
+    columns = ['koaid', 'filehand']
+    reader = MetaReader (path, 'votable', columns=columns)
+
+    assert list (reader) == astropy_rows (path, 'votable', columns)
+
+
+def test_stream_source (tmp_path):
+
+    path = str (tmp_path / 'meta.xml')
+    make_table ().write (path, format='votable')
+
+    with open (path, 'rb') as fp:
+        stream = io.BufferedReader (io.BytesIO (fp.read ()))
+
+    rows = list (MetaReader (stream, 'votable', columns=['koaid']))
+    assert rows[0] == ('HI.20180316.00000.fits',)
+    assert len(rows) == 5
+
+
+def test_missing_column (tmp_path):
+
+    path = str (tmp_path / 'meta.tbl')
+    make_table ().write (path, format='ascii.ipac')
+
+    with pytest.raises (Exception, match='date_obs'):
+        list (MetaReader (path, 'ipac', columns=['date_obs']))
@@ -0,0 +1,184 @@
+import numpy as np
+import pytest
+from astropy.table import Table
+
+from pykoa.koa import conf
+from pykoa.koa.querycache import QueryCache, contains, parse_criteria, \
+    separation
+
+
+def criteria (datetime='', pos=''):
+
+    param = {'instrument': 'hires'}
+    if (len(datetime) > 0):
+        param['datetime'] = datetime
+    if (len(pos) > 0):
+        param['pos'] = pos
+
+    return (parse_criteria (param))
+
+
+def test_parse_criteria ():
+
+    parsed = criteria ('2018-03-16 00:00:00/2018-03-17 12:00:00', \
+        'circle 230.0 45.0 0.5')
+
+    assert parsed['datetime'] == ( \
+        np.datetime64 ('2018-03-16T00:00:00', 'ms'), \
+        np.datetime64 ('2018-03-17T12:00:00', 'ms'))
+    assert parsed['pos'] == (230., 45., 0.5)
+
+    assert parse_criteria ({'instrument': 'hires'}) == \
+        {'datetime': None, 'pos': None}
+
+
+@pytest.mark.parametrize ('param', [
+    {'instrument': 'hires', 'target': 'm31'},
+    {'instrument': 'hires', 'pos': 'box 230 45 1 1'},
+    {'instrument': 'hires', 'pos': 'circle 230 45'},
+    {'instrument': 'hires', 'datetime': '2018-03-16'},
+    {'instrument': 'hires', 'datetime': 'yesterday/today'}])
+def test_parse_criteria_not_local (param):
+
+    assert parse_criteria (param) is None
+
+
+def test_contains_datetime ():
+
+    outer = criteria ('2018-03-01 00:00:00/2018-03-31 00:00:00')
+
+    assert contains (outer, criteria ('2018-03-10 00:00:00/' + \
+        '2018-03-12 00:00:00'))
+    assert contains (outer, outer)
+    assert not contains (outer, criteria ('2018-02-28 00:00:00/' + \
+        '2018-03-12 00:00:00'))
+    assert not contains (outer, criteria ('2018-03-10 00:00:00/' + \
+        '2018-04-01 00:00:00'))
+    assert not contains (outer, criteria ())
+
+
+def test_contains_circle ():
+
+    outer = criteria (pos='circle 230.0 45.0 1.0')
+
+    assert contains (outer, criteria (pos='circle 230.0 45.0 0.5'))
+    assert contains (outer, criteria (pos='circle 230.0 45.4 0.5'))
+    assert not contains (outer, criteria (pos='circle 230.0 45.6 0.5'))
+    assert not contains (outer, criteria (pos='circle 230.0 45.0 1.5'))
+    assert not contains (outer, criteria ())
+
+
+def test_contains_unconstrained ():
+
+    outer = criteria ()
+
+    assert contains (outer, criteria (pos='circle 230.0 45.0 0.5'))
+    assert contains (outer, criteria ('2018-03-10 00:00:00/' + \
+        '2018-03-12 00:00:00'))
+
+
+def test_separation ():
+
+    assert separation (10., 0., 11., 0.) == pytest.approx (1.)
+    assert separation (0., 89.5, 180., 89.5) == pytest.approx (1.)
+    assert separation (359.9, 0., 0.1, 0.) == pytest.approx (0.2)
+
+
+@pytest.fixture
+def result (tmp_path):
+
+    table = Table ()
+    table['koaid'] = [f'HI.201803{d:02d}.00001.fits' for d in (10, 16, 20)]
+    table['date_obs'] = ['2018-03-10', '2018-03-16', '2018-03-20']
+    table['ut'] = ['05:00:00.00', '06:30:00.00', '07:00:00.00']
+    table['ra'] = [230.0, 230.2, 231.5]
+    table['dec'] = [45.0, 45.1, 45.0]
+
+    path = str (tmp_path / 'result.tbl')
+    table.write (path, format='ascii.ipac')
+    return (path)
+
+
+@pytest.fixture
+def cache ():
+
+    with conf.set_temp ('query_cache_ttl', 60.):
+        yield (QueryCache ())
+
+
+scope = ('hires', 'anonymous', 'https://koa.ipac.caltech.edu', 'ipac')
+
+def test_lookup_filters_rows (cache, result):
+
+    outer = criteria ('2018-03-01 00:00:00/2018-03-31 00:00:00')
+    cache.add (scope, outer, result, 'ipac')
+
+    rows = cache.lookup (scope, criteria ( \
+        '2018-03-15 00:00:00/2018-03-25 00:00:00'))
+    assert list (rows['koaid']) == ['HI.20180316.00001.fits', \
+        'HI.20180320.00001.fits']
+
+    rows = cache.lookup (scope, criteria ( \
+        '2018-03-16 06:30:00/2018-03-16 06:30:00'))
+    assert list (rows['koaid']) == ['HI.20180316.00001.fits']
+
+    rows = cache.lookup (scope, criteria ( \
+        '2018-03-12 00:00:00/2018-03-31 00:00:00', 'circle 230.0 45.0 0.3'))
+    assert list (rows['koaid']) == ['HI.20180316.00001.fits']
+
+    assert cache.nhit == 3
+
+
+def test_lookup_miss (cache, result):
+
+    outer = criteria ('2018-03-01 00:00:00/2018-03-31 00:00:00')
+    cache.add (scope, outer, result, 'ipac')
+
+    assert cache.lookup (scope, criteria ( \
+        '2018-02-01 00:00:00/2018-03-02 00:00:00')) is None
+    assert cache.lookup (('keck_lris',) + scope[1:], criteria ( \
+        '2018-03-10 00:00:00/2018-03-12 00:00:00')) is None
+    assert cache.lookup (scope, criteria ()) is None
+
+    assert cache.nmiss == 3
+
+
+def test_lookup_needs_columns (cache, tmp_path):
+
+    table = Table ()
+    table['koaid'] = ['HI.20180316.00001.fits']
+    table['ra'] = [230.0]
+    table['dec'] = [45.0]
+
+    path = str (tmp_path / 'nodate.tbl')
+    table.write (path, format='ascii.ipac')
+
+    cache.add (scope, criteria (), path, 'ipac')
+
+    assert cache.lookup (scope, criteria ( \
+        '2018-03-10 00:00:00/2018-03-12 00:00:00')) is None
+    assert len (cache.lookup (scope, criteria ( \
+        pos='circle 230.0 45.0 0.1'))) == 1
+
+
+def test_ttl_disabled (result):
+
+    with conf.set_temp ('query_cache_ttl', 0.):
+
+        cache = QueryCache ()
+        assert not cache.enabled ()
+
+        cache.add (scope, criteria (), result, 'ipac')
+        assert cache.lookup (scope, criteria ()) is None
+
+
+def test_size_limit (cache, result):
+
+    with conf.set_temp ('query_cache_size', 2):
+
+        for instrument in ('hires', 'nirc2', 'osiris'):
+            cache.add ((instrument,) + scope[1:], criteria (), result, \
+                'ipac')
+
+        assert len (cache.entries) == 2
+        assert cache.lookup (scope, criteria ()) is None
@@ -0,0 +1,200 @@
+import time
+import email.utils
+
+import pytest
+import requests
+
+from pykoa.koa import retry
+from pykoa.koa.retry import RetryPolicy, CircuitBreaker, loggable, \
+    loggable_error
+
+
+class Response:
+
+    def __init__ (self, status_code=200, headers=None):
+
+        self.status_code = status_code
+        self.headers = headers or dict()
+        self.closed = False
+
+    def close (self):
+
+        self.closed = True
+
+
+def test_delay_retry_after_seconds ():
+
+    policy = RetryPolicy (backoff=1., backoff_max=60.)
+
+    assert policy.delay (0, Response (503, {'Retry-After': '7'})) == 7.
+    assert policy.delay (3, Response (503, {'Retry-After': '-5'})) == 0.
+
+
+def test_delay_retry_after_date ():
+
+    policy = RetryPolicy (backoff=1., backoff_max=60.)
+
+    when = email.utils.formatdate (time.time() + 20., usegmt=True)
+    delay = policy.delay (0, Response (503, {'Retry-After': when}))
+
+    assert 15. <= delay <= 20.
+
+
+def test_delay_retry_after_capped ():
+
+    policy = RetryPolicy (backoff=1., backoff_max=10.)
+
+    assert policy.delay (0, Response (429, {'Retry-After': '3600'})) == 10.
+
+
+def test_delay_invalid_retry_after_falls_back_to_backoff ():
+
+    policy = RetryPolicy (backoff=1., backoff_max=10.)
+
+    for i in range (50):
+        delay = policy.delay (2, Response (503, {'Retry-After': 'soon'}))
+        assert 0. <= delay <= 4.
+
+
+@pytest.mark.parametrize ('attempt, cap', [(0, 0.5), (2, 2.), (10, 8.)])
+def test_delay_jitter (attempt, cap):
+
+    policy = RetryPolicy (backoff=0.5, backoff_max=8.)
+
+    delays = [policy.delay (attempt) for i in range (200)]
+
+    assert all (0. <= delay <= cap for delay in delays)
+    assert max (delays) > cap / 2.
+
+
+def test_breaker_opens_after_threshold ():
+
+    breaker = CircuitBreaker (threshold=3, cooldown=10.)
+
+    breaker.failure ()
+    breaker.failure ()
+    assert breaker.state == 'closed'
+    assert breaker.available ()
+
+    breaker.failure ()
+    assert breaker.state == 'open'
+    assert not breaker.available ()
+
+
+def test_breaker_success_resets_count ():
+
+    breaker = CircuitBreaker (threshold=2, cooldown=10.)
+
+    breaker.failure ()
+    breaker.success ()
+    breaker.failure ()
+
+    assert breaker.state == 'closed'
+
+
+def open_breaker (breaker):
+
+    for i in range (breaker.threshold):
+        breaker.failure ()
+
+#
+#    skip the cooldown
+#
+    breaker.opened_until = time.monotonic() - 1.
+    return
+
+
+def test_breaker_probe_success_closes ():
+
+    breaker = CircuitBreaker (threshold=1, cooldown=10.)
+    open_breaker (breaker)
+
+    assert breaker.available ()
+
+    breaker.wait ()
+    assert breaker.state == 'half-open'
+    assert breaker.probing
+
+    breaker.success ()
+    assert breaker.state == 'closed'
+    assert breaker.cooldown == 10.
+
+
+def test_breaker_probe_failure_doubles_cooldown ():
+
+    breaker = CircuitBreaker (threshold=1, cooldown=10.)
+    open_breaker (breaker)
+
+    breaker.wait ()
+    breaker.failure ()
+
+    assert breaker.state == 'open'
+    assert breaker.cooldown == 20.
+    assert breaker.opened_until - time.monotonic() > 19.
+
+    for i in range (10):
+        breaker.opened_until = time.monotonic() - 1.
+        breaker.wait ()
+        breaker.failure ()
+
+    assert breaker.cooldown == breaker.cooldown_max
+
+
+def test_breaker_open_blocks_wait ():
+
+    breaker = CircuitBreaker (threshold=1, cooldown=0.3)
+    breaker.failure ()
+
+    start = time.monotonic()
+    breaker.wait ()
+
+    assert time.monotonic() - start >= 0.25
+    assert breaker.state == 'half-open'
+
+
+def test_request_retries_transient_status (monkeypatch):
+
+    responses = [Response (503, {'Retry-After': '0'}), Response (200)]
+    urls = []
+
+    def request (method, url, **kwargs):
+        urls.append (url)
+        return (responses.pop (0))
+
+    monkeypatch.setattr (requests, 'request', request)
+    monkeypatch.setattr (retry, 'breakers', dict())
+
+    policy = RetryPolicy (retries=2)
+    response = policy.request ('GET', 'http://koa.test/a?b=1')
+
+    assert response.status_code == 200
+    assert len (urls) == 2
+
+
+def test_request_does_not_resend_post (monkeypatch):
+
+    calls = []
+
+    def request (method, url, **kwargs):
+        calls.append (method)
+        return (Response (500))
+
+    monkeypatch.setattr (requests, 'request', request)
+    monkeypatch.setattr (retry, 'breakers', dict())
+
+    policy = RetryPolicy (retries=3)
+    response = policy.request ('POST', 'http://koa.test/sync')
+
+    assert response.status_code == 500
+    assert calls == ['POST']
+
+
+def test_loggable_drops_query ():
+
+    url = 'https://koa.test/cgi-bin/login?userid=me&password=secret'
+
+    assert loggable (url) == 'https://koa.test/cgi-bin/login'
+
+    e = requests.exceptions.ConnectionError (f'Max retries exceeded ' + \
+        f'with url: /cgi-bin/login?userid=me&password=secret')
+    assert 'secret' not in loggable_error (e, url)
@@ -0,0 +1,49 @@
+import logging
+
+import requests
+
+from pykoa.koa import retry
+from pykoa.koa.retry import RetryPolicy
+from pykoa.koa.servers import ServerPool
+
+
+class Response:
+
+    def __init__ (self, status_code=200):
+
+        self.status_code = status_code
+
+    def close (self):
+
+        return
+
+
+def test_failover_log_has_no_password (monkeypatch, caplog):
+
+    urls = []
+
+    def request (method, url, **kwargs):
+        urls.append (url)
+        if url.startswith ('https://koa1.test'):
+            raise requests.exceptions.ConnectionError ( \
+                'Max retries exceeded with url: ' + \
+                '/cgi-bin/login?userid=me&password=secret')
+        return (Response ())
+
+    monkeypatch.setattr (requests, 'request', request)
+    monkeypatch.setattr (retry, 'breakers', dict())
+
+    pool = ServerPool ('https://koa1.test,https://koa2.test')
+    monkeypatch.setattr (ServerPool, 'ranked', \
+        lambda pool: list (pool.servers))
+
+    url = 'https://koa1.test/cgi-bin/login?userid=me&password=secret'
+
+    with caplog.at_level (logging.WARNING):
+        response = pool.request (RetryPolicy (retries=0), 'GET', url)
+
+    assert response.status_code == 200
+    assert urls[-1].startswith ('https://koa2.test')
+
+    assert 'trying the next server' in caplog.text
+    assert 'secret' not in caplog.text
@@ -0,0 +1,29 @@
+import urllib.parse
+
+import pytest
+import requests
+
+from pykoa.koa import retry, KoaLoginError
+from pykoa.koa.sessions import KoaSession
+
+
+def test_login_error_has_no_password (monkeypatch, tmp_path):
+
+    def request (method, url, **kwargs):
+        parts = urllib.parse.urlsplit (url)
+        raise requests.exceptions.ConnectionError ( \
+            f'Max retries exceeded with url: {parts.path:s}?{parts.query:s}')
+
+    monkeypatch.setattr (requests, 'request', request)
+    monkeypatch.setattr (retry, 'breakers', dict())
+
+    session = KoaSession (str (tmp_path / 'cookies.txt'), \
+        server='https://koa.test')
+    session.retry = retry.RetryPolicy (retries=0)
+
+    with pytest.raises (KoaLoginError) as e:
+        session.login ('me', 'secret')
+
+    assert 'Failed to login' in str (e.value)
+    assert 'nph-koaLogin' in str (e.value)
+    assert 'secret' not in str (e.value)
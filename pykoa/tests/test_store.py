@@ -0,0 +1,165 @@
+import os
+import stat
+import hashlib
+
+import pytest
+
+from pykoa.koa.store import FileStore
+
+
+def make_file (path, data):
+
+    with open (path, 'wb') as fp:
+        fp.write (data)
+
+    return (hashlib.sha256 (data).hexdigest())
+
+
+@pytest.fixture
+def store (tmp_path):
+
+    store = FileStore (str (tmp_path / 'store'), max_bytes=0, max_age=0)
+    yield (store)
+    store.close ()
+
+
+def test_put_leaves_downloaded_file_alone (store, tmp_path):
+
+    path = str (tmp_path / 'HI.20180316.00001.fits')
+    checksum = make_file (path, b'x' * 1000)
+
+    mode = os.stat (path).st_mode
+    objpath = store.put ('HI.20180316.00001.fits', path, checksum, 1000)
+
+    assert os.stat (path).st_mode == mode
+    assert os.stat (path).st_ino != os.stat (objpath).st_ino
+    assert not (os.stat (objpath).st_mode & stat.S_IWUSR)
+
+    with open (path, 'ab') as fp:
+        fp.write (b'more')
+
+
+def test_materialize (store, tmp_path):
+
+    path = str (tmp_path / 'HI.20180316.00001.fits')
+    checksum = make_file (path, b'x' * 1000)
+    store.put ('HI.20180316.00001.fits', path, checksum, 1000)
+
+    outdir = tmp_path / 'out'
+    outdir.mkdir ()
+    filepath = str (outdir / 'HI.20180316.00001.fits')
+
+    assert store.materialize ('HI.20180316.00001.fits', filepath) in \
+        ('link', 'reflink', 'copy')
+    with open (filepath, 'rb') as fp:
+        assert fp.read () == b'x' * 1000
+
+    assert store.materialize ('HI.20180316.00002.fits', filepath) is None
+    assert (store.nhit, store.nmiss) == (1, 1)
+
+
+def put (store, tmp_path, koaid, data):
+
+    path = str (tmp_path / koaid)
+    checksum = make_file (path, data)
+    store.put (koaid, path, checksum, len(data))
+    return (checksum)
+
+
+def test_nbyte_counts_each_object_once (store, tmp_path):
+
+    put (store, tmp_path, 'HI.20180316.00001.fits', b'a' * 100)
+    put (store, tmp_path, 'HI.20180316.00002.fits', b'a' * 100)
+    put (store, tmp_path, 'HI.20180316.00003.fits', b'b' * 300)
+
+    assert store.nbyte () == 400
+
+#
+#    koaid replaced by another content: the old object is dropped
+#
+    put (store, tmp_path, 'HI.20180316.00003.fits', b'c' * 50)
+    assert store.nbyte () == 150
+    assert store.stats ()['nfile'] == 3
+
+
+def test_nbyte_survives_reopen (store, tmp_path):
+
+    put (store, tmp_path, 'HI.20180316.00001.fits', b'a' * 100)
+    put (store, tmp_path, 'HI.20180316.00002.fits', b'b' * 200)
+
+    other = FileStore (store.root)
+    assert other.nbyte () == 300
+    other.close ()
+
+
+def test_quota_evicts_least_recently_used (store, tmp_path):
+
+    store.max_bytes = 250
+
+    for i in range (5):
+        put (store, tmp_path, f'HI.20180316.{i:05d}.fits', bytes ([i]) * 100)
+
+    assert store.nbyte () <= 250
+    assert store.lookup ('HI.20180316.00004.fits') is not None
+    assert store.lookup ('HI.20180316.00000.fits') is None
+    assert store.nevict == 3
+
+    objects = [name for (dirpath, dirs, names) in os.walk (store.objdir) \
+        for name in names]
+    assert len (objects) == 2
+
+
+def test_pinned_files_are_kept (store, tmp_path):
+
+    put (store, tmp_path, 'HI.20180316.00000.fits', b'a' * 100)
+    store.pin ('HI.20180316.00000.fits')
+
+    store.max_bytes = 150
+    put (store, tmp_path, 'HI.20180316.00001.fits', b'b' * 100)
+
+#
+#    the file being put is in use: the store stays over quota until the
+#    next eviction
+#
+    assert store.nbyte () == 200
+    assert store.evict () == 1
+
+    assert store.lookup ('HI.20180316.00000.fits') is not None
+    assert store.lookup ('HI.20180316.00001.fits') is None
+    assert store.nbyte () == 100
+
+
+def test_evict_max_age (store, tmp_path):
+
+    put (store, tmp_path, 'HI.20180316.00000.fits', b'a' * 100)
+    put (store, tmp_path, 'HI.20180316.00001.fits', b'b' * 100)
+
+    with store.db:
+        store.db.execute ('update files set used = used - 10*86400 ' + \
+            'where koaid = ?', ('HI.20180316.00000.fits',))
+
+    assert store.evict (max_age=5) == 1
+    assert store.nbyte () == 100
+    assert store.lookup ('HI.20180316.00001.fits') is not None
+
+
+def test_lookup_verify (tmp_path):
+
+    store = FileStore (str (tmp_path / 'store'), verify=True)
+    put (store, tmp_path, 'HI.20180316.00001.fits', b'a' * 100)
+
+    objpath = store.lookup ('HI.20180316.00001.fits')
+    assert objpath is not None
+
+#
+#    same size, other content: caught only by the checksum
+#
+    os.chmod (objpath, 0o644)
+    with open (objpath, 'r+b') as fp:
+        fp.write (b'b')
+
+    assert store.lookup ('HI.20180316.00001.fits') is None
+
+    store.verify = False
+    assert store.lookup ('HI.20180316.00001.fits') == objpath
+    store.close ()
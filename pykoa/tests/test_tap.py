@@ -0,0 +1,186 @@
+import time
+import threading
+import concurrent.futures
+
+import pytest
+import requests
+
+from pykoa.koa import retry, KoaTimeoutError
+from pykoa.koa.core import KoaTap, KoaJob
+
+
+tap_url = 'https://koa.test/TAP'
+statusurl = tap_url + '/async/job1'
+
+def uws_job (phase):
+
+    return ('<?xml version="1.0" encoding="UTF-8"?>' + \
+        '<uws:job xmlns:uws="http://www.ivoa.net/xml/UWS/v1.0">' + \
+        '<uws:jobId>job1</uws:jobId>' + \
+        f'<uws:phase>{phase:s}</uws:phase>' + \
+        '<uws:parameters></uws:parameters>' + \
+        '</uws:job>')
+
+
+class Response:
+
+    def __init__ (self, status_code=200, text='', headers=None):
+
+        self.status_code = status_code
+        self.text = text
+        self.headers = headers or dict()
+        self.encoding = None
+
+    def close (self):
+
+        return
+
+
+class Service:
+
+#
+#    the TAP service side of an async query: the job stays in phase until
+#    it is aborted; every request is recorded with its timeout
+#
+    def __init__ (self):
+
+        self.phase = 'EXECUTING'
+        self.requests = []
+
+    def request (self, method, url, **kwargs):
+
+        self.requests.append ((method, url, kwargs.get('timeout')))
+
+        if (url == tap_url + '/async'):
+            return (Response (303, headers={'Location': statusurl}))
+
+        if ((method == 'POST') and (url == statusurl + '/phase')):
+            self.phase = 'ABORTED'
+            return (Response (303))
+
+        if (method == 'DELETE'):
+            return (Response (204))
+
+        return (Response (200, uws_job (self.phase)))
+
+    def polls (self):
+
+        return ([request for request in self.requests \
+            if ((request[0] == 'GET') and (request[1] == statusurl))])
+
+    def aborts (self):
+
+        return ([request for request in self.requests \
+            if (request[1] == statusurl + '/phase')])
+
+
+@pytest.fixture
+def service (monkeypatch):
+
+    stub = Service ()
+
+    monkeypatch.setattr (requests, 'request', \
+        lambda method, url, **kwargs: stub.request (method, url, **kwargs))
+    monkeypatch.setattr (retry, 'breakers', dict())
+    return (stub)
+
+
+def started_tap ():
+
+    tap = KoaTap (tap_url)
+    tap.koajob = KoaJob (statusurl)
+    tap.async_job = 1
+    return (tap)
+
+
+def within (timeout, limit):
+
+    return (all (t <= limit for t in timeout))
+
+
+def test_send_async_deadline_aborts_job (service):
+
+    tap = KoaTap (tap_url)
+
+    start = time.time()
+    with pytest.raises (KoaTimeoutError):
+        tap.send_async ('select * from koa_hires', timeout=2.5)
+
+    assert time.time() - start < 8.
+
+#
+#    every poll (after the job's creation) is limited to the time left,
+#    the abort to a few seconds
+#
+    assert len (service.polls ()) >= 2
+    assert all (within (poll[2], 2.5) for poll in service.polls ()[1:])
+
+    assert len (service.aborts ()) == 1
+    assert within (service.aborts ()[0][2], KoaJob.abort_time)
+
+
+def test_get_data_deadline_aborts_job (service, tmp_path):
+
+    tap = started_tap ()
+
+    start = time.time()
+    with pytest.raises (KoaTimeoutError):
+        tap.get_data (str (tmp_path / 'result.tbl'), timeout=2.5)
+
+    assert time.time() - start < 8.
+    assert len (service.aborts ()) == 1
+    assert len (service.polls ()) >= 2
+    assert all (within (poll[2], 2.5) for poll in service.polls ()[1:])
+
+
+def test_get_data_cancel_aborts_job (service, tmp_path):
+
+    tap = started_tap ()
+
+    cancel = threading.Event ()
+    threading.Timer (0.2, cancel.set).start ()
+
+    with pytest.raises (concurrent.futures.CancelledError):
+        tap.get_data (str (tmp_path / 'result.tbl'), cancel=cancel, \
+            timeout=0)
+
+    assert len (service.aborts ()) == 1
+
+
+def test_get_data_stops_on_aborted_job (service, tmp_path):
+
+    tap = started_tap ()
+    service.phase = 'ABORTED'
+
+    msg = tap.get_data (str (tmp_path / 'result.tbl'), timeout=0)
+
+    assert msg == 'Error: the query job was aborted.'
+    assert service.aborts () == []
+
+
+def test_request_deadline_caps_timeout (monkeypatch):
+
+    timeouts = []
+
+    def request (method, url, **kwargs):
+        timeouts.append (kwargs.get('timeout'))
+        raise requests.exceptions.ConnectionError ('connection reset')
+
+    monkeypatch.setattr (requests, 'request', request)
+    monkeypatch.setattr (retry, 'breakers', dict())
+
+    policy = retry.RetryPolicy (retries=5, backoff=0.2, timeout=(60., 600.))
+
+#
+#    a retry would start past the deadline: it is not made
+#
+    start = time.time()
+    with pytest.raises (requests.exceptions.RequestException):
+        policy.request ('GET', statusurl, deadline=time.time() + 0.3)
+
+    assert time.time() - start < 1.
+    assert 1 <= len (timeouts) < 6
+    assert within (timeouts[0], 0.3)
+
+    with pytest.raises (requests.exceptions.Timeout):
+        policy.request ('GET', statusurl, deadline=time.time() - 1.)
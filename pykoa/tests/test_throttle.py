@@ -0,0 +1,161 @@
+import time
+import threading
+
+import pytest
+
+from pykoa.koa import throttle
+from pykoa.koa.throttle import PAUSE, Throttle, TokenBucket, \
+    get_throttle, host_slot, parse_rate, parse_schedule
+
+
+@pytest.mark.parametrize ('value, rate', [
+    (0, 0.), (1500, 1500.), ('250', 250.), ('10K', 1.e4), ('2m', 2.e6),
+    (' 1.5G ', 1.5e9), ('pause', PAUSE), ('PAUSE', PAUSE)])
+def test_parse_rate (value, rate):
+
+    assert parse_rate (value) == rate
+
+
+def test_parse_rate_invalid ():
+
+    with pytest.raises (ValueError):
+        parse_rate ('fast')
+
+
+def test_parse_schedule ():
+
+    windows = parse_schedule ('08:00-20:00=2M, 20:00-08:00=0')
+
+    assert windows == [(480, 1200, 2.e6), (1200, 480, 0.)]
+
+
+def test_parse_schedule_pause_and_empty_entries ():
+
+    assert parse_schedule ('') == []
+    assert parse_schedule ('12:30-13:15=pause,') == [(750, 795, PAUSE)]
+
+
+@pytest.mark.parametrize ('schedule', [
+    '08:00=2M', '08:00-20:00', '8-20=2M', '08:00-20:00=fast'])
+def test_parse_schedule_invalid (schedule):
+
+    with pytest.raises (Exception, match='Invalid bandwidth schedule'):
+        parse_schedule (schedule)
+
+
+def at (monkeypatch, hour, minute):
+
+    clock = time.struct_time ((2026, 1, 1, hour, minute, 0, 3, 1, 0))
+    monkeypatch.setattr (throttle.time, 'localtime', lambda: clock)
+
+
+@pytest.mark.parametrize ('hour, rate', [
+    (7, 0.), (8, 2.e6), (19, 2.e6), (20, 0.), (23, 0.), (0, 0.)])
+def test_current_rate_spans_midnight (monkeypatch, hour, rate):
+
+    at (monkeypatch, hour, 30)
+
+    limiter = Throttle (bandwidth=1000, worker_bandwidth=0, \
+        schedule='08:00-20:00=2M, 20:00-08:00=0')
+
+    assert limiter.current_rate () == rate
+
+
+def test_current_rate_outside_windows (monkeypatch):
+
+    at (monkeypatch, 3, 0)
+
+    limiter = Throttle (bandwidth='5K', worker_bandwidth=0, \
+        schedule='08:00-20:00=pause')
+
+    assert limiter.current_rate () == 5000.
+
+
+def test_wait_window_cancel (monkeypatch):
+
+    at (monkeypatch, 12, 0)
+
+    limiter = Throttle (bandwidth=0, worker_bandwidth=0, \
+        schedule='00:00-23:59=pause')
+
+    cancel = threading.Event ()
+    threading.Timer (0.2, cancel.set).start ()
+
+    start = time.monotonic()
+    with pytest.raises (Exception, match='cancelled'):
+        limiter.wait_window (cancel)
+
+    assert time.monotonic() - start < 5.
+
+
+def test_token_bucket_rate ():
+
+    bucket = TokenBucket (100000)
+
+    start = time.monotonic()
+    for i in range (30):
+        bucket.consume (10000)
+    elapsed = time.monotonic() - start
+
+#
+#    one second of burst, then 200 KB at 100 KB/s
+#
+    assert 1.7 < elapsed < 3.
+
+
+def test_token_bucket_large_chunk_on_credit ():
+
+    bucket = TokenBucket (100000)
+    bucket.consume (100000)
+
+    start = time.monotonic()
+    bucket.consume (50000)
+
+    assert 0.4 < time.monotonic() - start < 1.
+
+
+def test_token_bucket_no_limit ():
+
+    bucket = TokenBucket (0)
+
+    start = time.monotonic()
+    bucket.consume (10**12)
+
+    assert time.monotonic() - start < 0.1
+
+
+def test_get_throttle_is_shared ():
+
+    first = get_throttle (bandwidth='1M', worker_bandwidth=0, schedule='')
+    second = get_throttle (bandwidth=1.e6, worker_bandwidth=0, schedule='')
+    other = get_throttle (bandwidth='2M', worker_bandwidth=0, schedule='')
+
+    assert first is second
+    assert first is not other
+    assert first.bucket is second.bucket
+
+
+def test_host_slot_limit ():
+
+    url = 'https://koa-slots.test/cgi-bin/getKOA/nph-getKOA'
+
+    lock = threading.Lock ()
+    count = {'now': 0, 'max': 0}
+
+    def fetch ():
+        with host_slot (url, 2):
+            with lock:
+                count['now'] = count['now'] + 1
+                count['max'] = max (count['max'], count['now'])
+            time.sleep (0.05)
+            with lock:
+                count['now'] = count['now'] - 1
+
+    threads = [threading.Thread (target=fetch) for i in range (8)]
+    for t in threads:
+        t.start ()
+    for t in threads:
+        t.join ()
+
+    assert count['max'] == 2
+    assert throttle.host_slots['koa-slots.test'].nheld == 0
@@ -0,0 +1,368 @@
+import io
+import os
+import time
+import base64
+import hashlib
+import threading
+import http.server
+
+import pytest
+import requests
+from requests.structures import CaseInsensitiveDict
+
+from pykoa.koa.transfer import StreamVerifier, StallDetector, TeeStream, \
+    stream_to_file
+
+
+def fits_data (nblock=2, end=True):
+
+    cards = ['SIMPLE  =                    T', \
+        'BITPIX  =                    8', \
+        'NAXIS   =                    0']
+    if end:
+        cards.append ('END')
+
+    header = ''.join (card.ljust (80) for card in cards).ljust (2880)
+    return (header.encode() + bytes (2880 * (nblock-1)))
+
+
+def verify (data, path='HI.20180316.00001.fits', headers=None, \
+    chunk=1000):
+
+    verifier = StreamVerifier (path, headers, algorithm='sha256')
+    for i in range (0, len(data), chunk):
+        verifier.update (data[i:i+chunk])
+
+    return (verifier.verify ())
+
+
+def test_valid_fits ():
+
+    data = fits_data ()
+    result = verify (data, headers={'Content-Length': str (len(data))})
+
+    assert result['status'] == 'ok'
+    assert result['size'] == len(data)
+    assert result['checksum'] == hashlib.sha256 (data).hexdigest()
+
+
+@pytest.mark.parametrize ('chunk', [1, 79, 80, 2880, 100000])
+def test_end_card_across_chunks (chunk):
+
+    assert verify (fits_data (), chunk=chunk)['status'] == 'ok'
+
+
+def test_missing_end_card ():
+
+    result = verify (fits_data (end=False))
+
+    assert result['status'] == 'error'
+    assert 'END card' in result['msg']
+
+
+def test_end_keyword_prefix_is_not_end_card ():
+
+    data = fits_data (end=False)
+    card = 'ENDTIME = 1.0'.ljust (80).encode()
+    data = data[:240] + card + data[320:]
+
+    assert verify (data)['status'] == 'error'
+
+
+def test_size_not_multiple_of_block ():
+
+    result = verify (fits_data () + b'\0' * 100)
+
+    assert result['status'] == 'error'
+    assert '2880' in result['msg']
+
+
+def test_not_fits ():
+
+    result = verify (b'<html>not found</html>'.ljust (2880))
+
+    assert result['status'] == 'error'
+    assert 'SIMPLE' in result['msg']
+
+
+def test_fits_checks_only_for_fits_files ():
+
+    assert verify (b'some text', path='HI.20180316.00001.txt')['status'] \
+        == 'ok'
+
+
+def test_size_mismatch ():
+
+    data = fits_data ()
+    result = verify (data[:2880], \
+        headers={'Content-Length': str (len(data))})
+
+    assert result['status'] == 'error'
+    assert 'size mismatch' in result['msg']
+
+
+def test_content_encoding_skips_size ():
+
+    data = fits_data ()
+    result = verify (data, headers={'Content-Length': '10', \
+        'Content-Encoding': 'gzip'})
+
+    assert result['status'] == 'ok'
+
+
+def test_content_md5 ():
+
+    data = fits_data ()
+    md5 = base64.b64encode (hashlib.md5 (data).digest()).decode()
+
+    assert verify (data, headers={'Content-MD5': md5})['status'] == 'ok'
+
+    other = base64.b64encode (hashlib.md5 (b'other').digest()).decode()
+    result = verify (data, headers={'Content-MD5': other})
+
+    assert result['status'] == 'error'
+    assert 'md5 checksum mismatch' in result['msg']
+
+
+def test_repr_digest ():
+
+    data = fits_data ()
+    digest = base64.b64encode (hashlib.sha256 (data).digest()).decode()
+
+    result = verify (data, headers={'Repr-Digest': f'sha-256=:{digest:s}:'})
+    assert result['status'] == 'ok'
+
+    result = verify (data + bytes (2880), \
+        headers={'Repr-Digest': f'sha-256=:{digest:s}:'})
+    assert 'sha256 checksum mismatch' in result['msg']
+
+
+class Handler (http.server.BaseHTTPRequestHandler):
+
+#
+#    serves fits_data (20) at any path; the server records the client
+#    address of every request (one per pooled connection)
+#
+    protocol_version = 'HTTP/1.1'
+
+    def log_message (self, *args):
+        pass
+
+    def do_GET (self):
+
+        self.server.clients.append (self.client_address)
+
+        body = fits_data (20)
+
+        self.send_response (200)
+        self.send_header ('Content-type', 'application/fits')
+        self.send_header ('Content-Length', str (len(body)))
+        self.end_headers ()
+        self.wfile.write (body)
+
+
+@pytest.fixture
+def server ():
+
+    httpd = http.server.ThreadingHTTPServer (('127.0.0.1', 0), Handler)
+    httpd.daemon_threads = True
+    httpd.clients = []
+
+    t = threading.Thread (target=httpd.serve_forever, daemon=True)
+    t.start ()
+
+    yield (httpd)
+
+    httpd.shutdown ()
+    httpd.server_close ()
+
+
+@pytest.mark.parametrize ('writer', [None, 'default'])
+def test_stream_to_file_reuses_connection (server, tmp_path, writer):
+
+    url = f'http://127.0.0.1:{server.server_port:d}/HI.20180316.00001.fits'
+
+    kwargs = dict()
+    if (writer is None):
+        kwargs['writer'] = None
+
+    with requests.Session () as session:
+
+        for i in range (3):
+
+            path = str (tmp_path / f'HI.20180316.{i:05d}.fits')
+            response = session.get (url, stream=True)
+
+            result = stream_to_file (response, path, **kwargs)
+
+            assert result['status'] == 'ok'
+            with open (path, 'rb') as fp:
+                assert fp.read () == fits_data (20)
+
+#
+#    each body read to the end returns its connection to the pool
+#
+    assert len (set (server.clients)) == 1
+
+
+class Source (io.RawIOBase):
+
+#
+#    a result stream of nbyte bytes; counts the bytes read
+#
+    def __init__ (self, nbyte):
+
+        self.nbyte = nbyte
+        self.nread = 0
+
+    def readable (self):
+
+        return (True)
+
+    def readinto (self, b):
+
+        n = min (len(b), self.nbyte - self.nread)
+        b[0:n] = b'r' * n
+        self.nread = self.nread + n
+        return (n)
+
+
+def test_tee_close_copies_the_rest (tmp_path):
+
+    outpath = str (tmp_path / 'result.tbl')
+    source = Source (100000)
+
+    tee = io.BufferedReader (TeeStream (source, outpath))
+    assert tee.read (10) == b'r' * 10
+    tee.close ()
+
+    assert source.nread == 100000
+    assert os.path.getsize (outpath) == 100000
+    assert not os.path.exists (outpath + '.part')
+
+
+def test_tee_abort_drops_the_rest (tmp_path):
+
+    outpath = str (tmp_path / 'result.tbl')
+    source = Source (10**7)
+
+    stream = TeeStream (source, outpath)
+    tee = io.BufferedReader (stream)
+    tee.read (10)
+
+    stream.abort ()
+    tee.close ()
+
+    assert source.nread < 10**6
+    assert not os.path.exists (outpath)
+    assert not os.path.exists (outpath + '.part')
+
+
+def test_stall_detector ():
+
+    stall = StallDetector (1000., 0.1)
+    assert stall.active ()
+    assert not StallDetector (0., 10.).active ()
+
+    stall.update (500)
+    time.sleep (0.15)
+    stall.update (200)
+
+    time.sleep (0.15)
+    with pytest.raises (Exception, match='stalled'):
+        stall.update (10)
+
+
+def test_stall_detector_excludes_throttled_time ():
+
+    stall = StallDetector (1000., 0.1)
+
+    time.sleep (0.15)
+    stall.exclude (0.15)
+    stall.update (10)
+
+
+class Trickle (io.RawIOBase):
+
+#
+#    a response body: nfast bytes at once, then one card every delay
+#    seconds
+#
+    def __init__ (self, data, nfast, delay):
+
+        self.data = data
+        self.nfast = nfast
+        self.delay = delay
+        self.pos = 0
+
+    def readable (self):
+
+        return (True)
+
+    def readinto (self, b):
+
+        n = min (len(b), len(self.data) - self.pos)
+        if (self.pos >= self.nfast):
+            time.sleep (self.delay)
+            n = min (n, 80)
+        else:
+            n = min (n, self.nfast - self.pos)
+
+        b[0:n] = self.data[self.pos:self.pos+n]
+        self.pos = self.pos + n
+        return (n)
+
+
+class StubResponse:
+
+    def __init__ (self, raw, headers):
+
+        self.raw = raw
+        self.headers = CaseInsensitiveDict (headers)
+        self.closed = False
+
+    def close (self):
+
+        self.closed = True
+
+
+@pytest.mark.parametrize ('writer', [None, 'default'])
+def test_stream_to_file_stall_and_resume (tmp_path, writer):
+
+    data = fits_data (20)
+    path = str (tmp_path / 'HI.20180316.00001.fits')
+
+    kwargs = dict()
+    if (writer is None):
+        kwargs['writer'] = None
+
+    response = StubResponse (Trickle (data, 2880 * 5, 0.05), \
+        {'Content-Length': str (len(data))})
+
+    result = stream_to_file (response, path, keep_part=True, \
+        stall_rate=10**6, stall_time=0.3, **kwargs)
+
+#
+#    the data received before the stall is kept for a Range request
+#
+    assert result['status'] == 'error'
+    assert 'stalled' in result['msg']
+    assert response.closed
+
+    partial = result['partial']
+    assert 2880 * 5 <= partial < len(data)
+    assert os.path.getsize (path + '.part') == partial
+    assert not os.path.exists (path)
+
+    response = StubResponse (Trickle (data[partial:], len(data), 0.), \
+        {'Content-Length': str (len(data) - partial), \
+        'Content-Range': f'bytes {partial:d}-{len(data)-1:d}/{len(data):d}'})
+
+    result = stream_to_file (response, path, offset=partial, \
+        headers=result['headers'], stall_rate=0, **kwargs)
+
+    assert result['status'] == 'ok'
+    assert result['size'] == len(data)
+    with open (path, 'rb') as fp:
+        assert fp.read () == data
+    assert not os.path.exists (path + '.part')